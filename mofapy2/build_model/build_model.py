@@ -12,13 +12,14 @@ from mofapy2.build_model.init_model import initModel
 from mofapy2.build_model.utils import *
 
 class buildModel(object):
-    def __init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views):
+    def __init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views, dtype=np.float64):
         self.data = data
         self.data_opts = data_opts
         self.model_opts = model_opts
         self.dim = dimensionalities
         self.seed = seed
         self.weight_views = weight_views
+        self.dtype = dtype
 
     def createMarkovBlankets(self):
         """ Define the markov blankets """
@@ -38,15 +39,22 @@ class buildModel(object):
 
 
 class buildBiofam(buildModel):
-    def  __init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views):
-        buildModel.__init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views)
+    def  __init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views, dtype=np.float64, expectations=None):
+        buildModel.__init__(self, data, data_opts, model_opts, dimensionalities, seed, weight_views, dtype)
 
         # create an instance of initModel
-        self.init_model = initModel(self.dim, self.data, self.model_opts["likelihoods"], seed=seed)
+        self.init_model = initModel(self.dim, self.data, self.model_opts["likelihoods"], seed=seed, dtype=dtype)
 
         # Build all nodes
         self.build_nodes()
 
+        # Initialise the nodes from the expectations of a previous model (see load_expectations)
+        if expectations is not None:
+            self.init_model.initFromExpectations(expectations)
+
+        # Set the floating point precision of the nodes
+        self.init_model.setDtype()
+
         # Define markov blankets
         self.createMarkovBlankets()
 
@@ -81,14 +89,16 @@ class buildBiofam(buildModel):
 
     def build_Z(self):
         """ Build node Z for the factors or latent variables """
+        # the models of the shards of a distributed training get their factors from the main process (no PCA)
+        qmean = self.model_opts.get('init_factors', "pca")
         if self.model_opts['spikeslab_factors']:
             # self.init_model.initSZ(qmean_T1=0)
             # self.init_model.initSZ(qmean_T1="random")
-            self.init_model.initSZ(qmean_T1="pca", Y=self.data, impute=True, weight_views = self.weight_views)
+            self.init_model.initSZ(qmean_T1=qmean, Y=self.data, impute=True, weight_views = self.weight_views, groups=self.data_opts['samples_groups'])
         else:
             # self.init_model.initZ(qmean=0)
             # self.init_model.initZ(qmean="random")
-            self.init_model.initZ(qmean="pca", Y=self.data, impute=True, weight_views = self.weight_views)
+            self.init_model.initZ(qmean=qmean, Y=self.data, impute=True, weight_views = self.weight_views, groups=self.data_opts['samples_groups'])
 
     def build_W(self):
         """ Build node W for the weights """
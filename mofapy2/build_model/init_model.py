@@ -8,11 +8,15 @@ import scipy.stats as stats
 from sys import path
 import sklearn.decomposition
 from sklearn.impute import SimpleImputer
+from scipy.sparse import issparse, csr_matrix, hstack
+from scipy.sparse.linalg import LinearOperator, svds
+from sklearn.utils.extmath import svd_flip
+from mofapy2.core.disk_data import DiskView
 
 from mofapy2.core.nodes import *
 
 class initModel(object):
-    def __init__(self, dim, data, lik, seed):
+    def __init__(self, dim, data, lik, seed, dtype=np.float64):
         """
         PARAMETERS
         dim: dictionary with keyworded dimensionalities:
@@ -24,6 +28,10 @@ class initModel(object):
         data: list of length M with numpy arrays of dimensionality (N,Dm)
         lik: list of strings with length M
             likelihood for each view, choose from ('gaussian','poisson','bernoulli')
+        seed: int
+            seed of the random number generator
+        dtype: numpy dtype
+            floating point precision of the nodes (np.float32 or np.float64)
         """
 
         s.random.seed(seed)
@@ -34,10 +42,11 @@ class initModel(object):
         self.K = dim["K"]
         self.M = dim["M"]
         self.D = dim["D"]
+        self.dtype = dtype
 
         self.nodes = {}
 
-    def initZ(self, pmean=0., pvar=1., qmean="random", qvar=1., qE=None, qE2=None, Y=None, impute=False, weight_views=False):
+    def initZ(self, pmean=0., pvar=1., qmean="random", qvar=1., qE=None, qE2=None, Y=None, impute=False, weight_views=False, groups=None):
         """Method to initialise the latent variables
 
         PARAMETERS
@@ -54,6 +63,7 @@ class initModel(object):
         Y: matrix to run PCA on (when qmean="pca")
         impute: logical value if to perform imputation before running PCA,
             this is only applicable when qmean="pca" and missing values (np.NaN) are present in the data
+        groups: group of each sample, used to center the sparse gaussian views per group in the PCA
         """
 
         ## Initialise prior distribution (P)
@@ -81,6 +91,12 @@ class initModel(object):
                     qmean = pca.components_.T
 
                 # PCA initialisation
+                elif qmean == "pca" and any([isinstance(y, DiskView) for y in Y]):
+                    qmean = self.disk_pca(Y)
+
+                elif qmean == "pca" and any([issparse(y) for y in Y]):
+                    qmean = self.sparse_pca(Y, groups)
+
                 elif qmean == "pca":
                     # whiten=True scales the principal components to match the prior N(0,1)
                     pca = sklearn.decomposition.PCA(n_components=self.K, whiten=True)
@@ -118,7 +134,7 @@ class initModel(object):
         )
 
     def initSZ(self, pmean_T0=0., pmean_T1=0., pvar_T0=1., pvar_T1=1., ptheta=1., qmean_T0=0., qmean_T1="random", qvar_T0=1.,
-        qvar_T1=1., qtheta=1., qEZ_T0=None, qEZ_T1=None, qET=None, Y=None, impute=False, weight_views = False):
+        qvar_T1=1., qtheta=1., qEZ_T0=None, qEZ_T1=None, qET=None, Y=None, impute=False, weight_views = False, groups=None):
         """Method to initialise sparse factors with a spike and slab prior
 
         PARAMETERS
@@ -137,6 +153,10 @@ class initModel(object):
 
             if qmean_T1 == "random":
                 qmean_T1 = stats.norm.rvs(loc=0, scale=1, size=(self.N, self.K))
+            elif qmean_T1 == "pca" and any([isinstance(y, DiskView) for y in Y]):
+                qmean_T1 = self.disk_pca(Y)
+            elif qmean_T1 == "pca" and any([issparse(y) for y in Y]):
+                qmean_T1 = self.sparse_pca(Y, groups)
             elif qmean_T1 == "pca":
                 pca = sklearn.decomposition.PCA(n_components=self.K, whiten=True)
                 Ytmp = s.concatenate(Y, axis=1)
@@ -403,7 +423,10 @@ class initModel(object):
 
             # Poisson noise model for count data
             if self.lik[m] == "poisson":
-                tmp = 0.25 + 0.17*s.nanmax(self.data[m],axis=0)
+                if issparse(self.data[m]):
+                    tmp = 0.25 + 0.17*self.data[m].max(axis=0).toarray().flatten()
+                else:
+                    tmp = 0.25 + 0.17*s.nanmax(self.data[m],axis=0)
                 tmp = s.repeat(tmp[None,:], self.N, axis=0)
                 tau_list[m] = Tau_Seeger(dim=(self.N, self.D[m]), value=tmp)
 
@@ -423,12 +446,96 @@ class initModel(object):
 
         self.nodes["Tau"] = Multiview_Mixed_Node(self.M, *tau_list)
 
+    def sparse_pca(self, Y, groups=None):
+        """Method to run the PCA initialisation when some views are scipy.sparse matrices.
+
+        The sparse gaussian views are centered implicitly with the feature means of each group, as the nodes do, and the
+        other views with the feature means (as the PCA of dense views). The SVD is computed on a linear operator, so that
+        the sparse views are never densified.
+
+        PARAMETERS
+        ----------
+        Y: list of length M with numpy arrays or sparse matrices of dimensionality (N,Dm)
+        groups: group of each sample
+        """
+        groups = np.zeros(self.N, dtype=int) if groups is None else np.unique(groups, return_inverse=True)[1]
+        G = groups.max() + 1
+        indicator = csr_matrix((np.ones(self.N), (np.arange(self.N), groups)), shape=(self.N, G))
+        counts = np.bincount(groups, minlength=G).astype(float)
+
+        Ytmp, offsets = [], []
+        for m, y in enumerate(Y):
+            if not issparse(y) and np.any(np.isnan(y)):
+                imp = SimpleImputer(missing_values=np.NaN, strategy="mean")
+                y = imp.fit_transform(y)
+            y = csr_matrix(y, dtype=np.float64)
+            if issparse(Y[m]) and self.lik[m] == "gaussian":
+                # feature means of each group
+                offsets.append(np.asarray(indicator.T.dot(y).todense()) / counts[:,None])
+            else:
+                offsets.append(np.repeat(np.asarray(y.mean(axis=0)), G, axis=0))
+            Ytmp.append(y)
+        X = hstack(Ytmp).tocsr()
+        offsets = np.concatenate(offsets, axis=1)
+
+        # centered data, X - indicator·offsets
+        A = LinearOperator(X.shape, dtype=np.float64,
+            matvec=lambda v: X.dot(v) - indicator.dot(offsets.dot(v)),
+            rmatvec=lambda u: X.T.dot(u) - offsets.T.dot(indicator.T.dot(u)))
+        if self.K < min(X.shape):
+            v0 = np.ones(min(X.shape)) / np.sqrt(min(X.shape))
+            U, S, Vt = svds(A, k=self.K, v0=v0)
+            order = np.argsort(-S)
+            U, Vt = U[:,order], Vt[order,:]
+        else:
+            U, S, Vt = np.linalg.svd(X.toarray() - indicator.dot(offsets), full_matrices=False)
+            U, Vt = U[:,:self.K], Vt[:self.K,:]
+
+        # same signs and scale as the whitened principal components of the dense PCA
+        U, Vt = svd_flip(U, Vt)
+        return U * np.sqrt(self.N - 1)
+
+    def disk_pca(self, Y):
+        """Method to run the PCA initialisation when some views are stored on disk.
+        An incremental PCA is fitted on blocks of samples so that the data is never loaded in memory.
+
+        PARAMETERS
+        ----------
+        Y: list of length M with numpy arrays, sparse matrices or DiskViews of dimensionality (N,Dm)
+        """
+        # missing values of the views in memory are imputed with the feature means
+        means = [ None if issparse(y) or isinstance(y, DiskView) else np.nan_to_num(np.nanmean(y, axis=0)) for y in Y ]
+        def read(ix):
+            Ytmp = []
+            for m,y in enumerate(Y):
+                if isinstance(y, DiskView):
+                    Ytmp.append(y.read(ix))
+                elif issparse(y):
+                    Ytmp.append(y[ix,:].toarray())
+                else:
+                    Ytmp.append(s.where(np.isnan(y[ix,:]), means[m], y[ix,:]))
+            return s.concatenate(Ytmp, axis=1)
+
+        # blocks of samples, the last one with at least K samples
+        block_size = max(self.K, min([ y.block_size for y in Y if isinstance(y, DiskView) ]))
+        bounds = list(range(0, self.N, block_size))[1:]
+        if len(bounds) > 0 and self.N - bounds[-1] < self.K: bounds.pop()
+        blocks = [ slice(i,j) for i,j in zip([0]+bounds, bounds+[self.N]) ]
+
+        pca = sklearn.decomposition.IncrementalPCA(n_components=self.K, whiten=True)
+        for ix in blocks:
+            pca.partial_fit(read(ix))
+        return s.concatenate([ pca.transform(read(ix)) for ix in blocks ])
+
     def initY(self):
         """Method to initialise the observations"""
         Y_list = [None]*self.M
         for m in range(self.M):
             if self.lik[m]=="gaussian":
                 Y_list[m] = Y_Node(dim=(self.N,self.D[m]), value=self.data[m])
+            elif self.lik[m]=="poisson" and issparse(self.data[m]):
+                # the pseudodata is initialised in the first update
+                Y_list[m] = Poisson_PseudoY(dim=(self.N,self.D[m]), obs=self.data[m], E=None)
             elif self.lik[m]=="poisson":
                 Y_list[m] = Poisson_PseudoY(dim=(self.N,self.D[m]), obs=self.data[m], E=self.data[m])
             elif self.lik[m]=="bernoulli":
@@ -493,6 +600,54 @@ class initModel(object):
             Theta_list[m] = ThetaW_Node(dim=(self.K,), pa=pa, pb=pb, qa=qa, qb=qb, qE=qE)
         self.nodes["ThetaW"] = Multiview_Variational_Node(self.M, *Theta_list)
 
+    def initFromExpectations(self, expectations):
+        """Method to initialise the nodes from the expectations of a previous model (warm start)
+
+        PARAMETERS
+        ----------
+        expectations: dictionary with the expectations of the nodes (see load_expectations), with one array per view for
+            the multi-view nodes. Missing values keep the default initialisation of the node.
+        """
+        for name, E in expectations.items():
+            if name not in self.nodes: continue
+            if isinstance(self.nodes[name], Multiview_Node):
+                for m in range(self.M):
+                    if E[m] is not None: self.setExpectation(self.nodes[name].nodes[m], E[m])
+            else:
+                self.setExpectation(self.nodes[name], E)
+
+    def setExpectation(self, node, E):
+        """Method to set the parameters of the variational distribution of a node to match a given expectation
+
+        PARAMETERS
+        ----------
+        node: Z, W, TauD, Alpha or Theta node
+        E: array with the expectation, with missing values for the entries that keep their current parameters
+        """
+        found = ~s.isnan(E)
+        Q = node.Q.getParameters()
+        if isinstance(node, (Z_Node, W_Node)):
+            Q['mean'][found] = E[found]
+        elif isinstance(node, (SZ_Node, SW_Node)):
+            # the spike and slab variables are initialised with an expectation of one
+            Q['mean_B1'][found] = E[found]
+        elif isinstance(node, (TauD_Node, AlphaZ_Node, AlphaW_Node)):
+            # keep the shape parameter and set the rate to match the expectation a/b
+            Q['b'][found] = Q['a'][found] / E[found]
+        elif isinstance(node, (ThetaZ_Node, ThetaW_Node)):
+            # a/(a+b) matches the expectation, with a+b=2 as in the default initialisation
+            E = s.clip(E[found], 1e-3, 1.-1e-3)
+            Q['a'][found] = 2.*E
+            Q['b'][found] = 2.*(1.-E)
+        else:
+            return
+        node.Q.updateExpectations()
+
+    def setDtype(self):
+        """ Method to cast the parameters and expectations of all nodes to the floating point precision of the model """
+        for node in self.nodes.values():
+            node.astype(self.dtype)
+
     def initExpectations(self, *nodes):
         """ Method to initialise all expectations """
         for node in nodes:
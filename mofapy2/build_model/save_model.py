@@ -5,8 +5,11 @@ import pandas as pd
 import numpy.ma as ma
 import os
 import h5py
+from scipy.sparse import issparse
+from mofapy2.core.disk_data import DiskView
 from mofapy2.core.nodes import *
 from mofapy2.core.nodes import *
+from mofapy2.core.utils import group_slices
 
 # To keep same order of views and groups in the hdf5 file
 # h5py.get_config().track_order = True
@@ -34,6 +37,9 @@ class saveModel():
         assert len(samples_groups) == data[0].shape[0], "length of samples groups does not match the number of samples in the data"
         self.samples_groups = samples_groups
 
+        # Samples of each group, slices if the samples are stored group-contiguously
+        self.samples_idx = dict(zip(groups_names, group_slices(samples_groups, names=groups_names)))
+
         # Initialise intercepts
         self.intercepts = intercepts
 
@@ -57,7 +63,7 @@ class saveModel():
             order_factors = np.argsort( np.array(self.r2).sum(axis=(0,1)) )[::-1]
             self.r2 = [x[:,order_factors] for x in self.r2]
         else:
-            order_factors = self.r2[0].shape[1]
+            order_factors = s.arange(self.r2[0].shape[1])
         return order_factors
 
     def saveNames(self):
@@ -94,11 +100,16 @@ class saveModel():
             for g in range(len(self.groups_names)):
 
                 # Subset group
-                samples_idx = np.where(np.array(self.samples_groups) == self.groups_names[g])[0]
-                tmp = self.data[m][samples_idx,:]
+                samples_idx = self.samples_idx[self.groups_names[g]]
+
+                # Sparse views and views stored on disk are written by blocks of samples, to avoid densifying the whole group
+                if issparse(self.data[m]) or isinstance(self.data[m], DiskView):
+                    self.saveSparseData(data_subgrp, m, g, samples_idx)
+                    intercept_subgrp.create_dataset(self.groups_names[g], data=self.intercepts[m][g])
+                    continue
 
                 # Mask missing values
-                tmp[self.mask[m][samples_idx,:]] = np.nan
+                tmp = s.where(self.mask[m][samples_idx,:], np.nan, self.data[m][samples_idx,:])
                 
                 # Create hdf5 data set for data
                 data_subgrp.create_dataset(self.groups_names[g], data=tmp, compression="gzip", compression_opts=self.compression_level)
@@ -106,6 +117,23 @@ class saveModel():
                 # Create hdf5 data set for intercepts
                 intercept_subgrp.create_dataset(self.groups_names[g], data=self.intercepts[m][g])
 
+    def saveSparseData(self, data_subgrp, m, g, samples_idx, block_size=1000):
+        """ Method to save the training data of a sparse view or of a view stored on disk, in the same (dense) format as the other views """
+        Y = self.model.getNodes()["Y"].getNodes()[m]
+        samples_idx = s.arange(self.data[m].shape[0])[samples_idx]
+        dset = data_subgrp.create_dataset(self.groups_names[g], shape=(len(samples_idx), self.data[m].shape[1]), dtype=self.data[m].dtype,
+            compression="gzip", compression_opts=self.compression_level)
+        for i in range(0, len(samples_idx), block_size):
+            idx = samples_idx[i:i+block_size]
+            if isinstance(self.data[m], DiskView):
+                # missing samples of views stored on disk
+                dset[i:i+block_size,:] = s.where(self.mask[m][idx,:], np.nan, self.data[m][idx,:])
+            elif hasattr(Y, "stats") and Y.stats is not None:
+                # gaussian views are centered implicitly
+                dset[i:i+block_size,:] = Y.stats.getDense(idx)
+            else:
+                dset[i:i+block_size,:] = self.data[m][idx,:].toarray()
+
     def saveImputedData(self, mean, variance):
         """ Method to save the training data"""
         
@@ -118,7 +146,7 @@ class saveModel():
             for g in range(len(self.groups_names)):
 
                 # Subset group
-                samples_idx = np.where(np.array(self.samples_groups) == self.groups_names[g])[0]
+                samples_idx = self.samples_idx[self.groups_names[g]]
 
                 # Create HDF5 subgroup
                 group_subgrp = view_subgrp.create_group(self.groups_names[g])
@@ -166,18 +194,16 @@ class saveModel():
                         
                         for g in self.groups_names:
 
-                            # Add missing values to Tau and Y nodes
-                            exp[m][self.mask[m]] = np.nan
-
-                            # create hdf5 data set for the expectation
-                            samp_indices = np.where(np.array(self.samples_groups) == g)[0]
+                            # create hdf5 data set for the expectation, with missing values in Tau and Y nodes
+                            samp_indices = self.samples_idx[g]
+                            foo = s.where(self.mask[m][samp_indices,:], np.nan, exp[m][samp_indices,:])
 
-                            view_subgrp.create_dataset(g, data=exp[m][samp_indices,:], compression="gzip", compression_opts=self.compression_level)
+                            view_subgrp.create_dataset(g, data=foo, compression="gzip", compression_opts=self.compression_level)
 
-                    # Single-groups nodes (W)
+                    # Single-groups nodes (W, AlphaW and ThetaW)
                     else:
                         foo = exp[m].T
-                        node_subgrp.create_dataset(self.views_names[m], data=foo[self.order_factors,:], compression="gzip", compression_opts=self.compression_level)
+                        node_subgrp.create_dataset(self.views_names[m], data=foo[self.order_factors], compression="gzip", compression_opts=self.compression_level)
 
             # Single-view nodes
             else:
@@ -185,13 +211,14 @@ class saveModel():
                 # Multi-group nodes (Z)
                 if n in multigroup_nodes:
                     for g in self.groups_names:
-                        samp_indices = np.where(np.array(self.samples_groups) == g)[0]
+                        samp_indices = self.samples_idx[g]
                         foo = exp[samp_indices,:].T
                         node_subgrp.create_dataset(g, data=foo[self.order_factors,:], compression="gzip", compression_opts=self.compression_level)
 
-                # Single-group nodes (???)
+                # Single-group nodes (AlphaZ and ThetaZ), with the factors in the same order as Z and W
                 else:
-                    node_subgrp.create_dataset("E", data=exp.T, compression="gzip", compression_opts=self.compression_level)
+                    foo = exp.T
+                    node_subgrp.create_dataset("E", data=foo[self.order_factors], compression="gzip", compression_opts=self.compression_level)
 
         pass
 
@@ -235,7 +262,7 @@ class saveModel():
                             grp_subgrp = view_subgrp.create_group(g)
 
                             # create hdf5 data set for the parameter
-                            samp_indices = np.where(np.array(self.samples_groups) == g)[0]
+                            samp_indices = self.samples_idx[g]
 
                             for k in par[m].keys():
                                 tmp = par[m][k][samp_indices,:]
@@ -255,7 +282,7 @@ class saveModel():
                 if n in multigroup_nodes:
                     for g in self.groups_names:
                         grp_subgrp = node_subgrp.create_group(g)
-                        samp_indices = np.where(np.array(self.samples_groups) == g)[0]
+                        samp_indices = self.samples_idx[g]
 
                         for k in par.keys():
                             tmp = par[k][samp_indices,:].T
@@ -5,11 +5,15 @@ import numpy as np
 import scipy as s
 import pandas as pd
 import numpy.ma as ma
+from scipy.sparse import issparse, diags
 import os
 import sys
+from itertools import chain
 import h5py
 
 from mofapy2.core.nodes import *
+from mofapy2.core.utils import group_slices, group_counts
+from mofapy2.core.disk_data import DiskView, is_disk
 
 def mask_data(data, mask_fraction):
     """ Method to mask data values, mainly used to evaluate imputation
@@ -48,10 +52,121 @@ def gaussianise(Y_m, axis=0):
 
     return Y_norm
 
+def feature_means(X):
+    """ Method to compute the mean of each feature, ignoring missing values (zeros of sparse matrices are observed values) """
+    if issparse(X):
+        return np.asarray(X.mean(axis=0)).flatten()
+    if is_disk(X):
+        # matrices stored on disk are read in blocks of samples
+        n, s1, _ = (X if isinstance(X, DiskView) else DiskView([X])).scan()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return s1.sum(axis=0) / n.sum(axis=0)
+    return np.nanmean(X, axis=0)
+
+def _process_sparse_data(Y, likelihood, data_opts, samples_groups):
+    """ Method to process a scipy.sparse view without densifying it
+
+    Gaussian views are not centered here: the nodes subtract the feature means per group implicitly,
+    which keeps the zeros of the matrix. Sparse matrices are only supported for gaussian and poisson views.
+    """
+    Y = Y.tocsr()
+
+    # Removing features with no variance
+    var = np.asarray(Y.multiply(Y).mean(axis=0)).flatten() - s.square(feature_means(Y))
+    if np.any(var==0.):
+        print("Warning: %d features(s) have zero variance, consider removing them before training the model...\n" % (var==0.).sum())
+        sys.stdout.flush()
+
+    if likelihood not in ["gaussian","poisson"]:
+        return Y.toarray()
+
+    if likelihood in ["gaussian"]:
+        # Variance of the data after centering the features per group
+        samples_idx = dict(zip(data_opts['groups_names'], group_slices(samples_groups, names=data_opts['groups_names'])))
+        ss = pd.Series(0., index=data_opts['groups_names'])
+        for g in data_opts['groups_names']:
+            Yg = Y[samples_idx[g],:]
+            ss[g] = Yg.multiply(Yg).sum() - Yg.shape[0]*s.square(feature_means(Yg)).sum()
+
+        # Scale views to unit variance
+        if data_opts['scale_views']:
+            Y = Y / np.sqrt(ss.sum() / np.prod(Y.shape))
+            ss /= ss.sum() / np.prod(Y.shape)
+
+        # Scale groups to unit variance
+        if data_opts['scale_groups']:
+            scale = np.ones(Y.shape[0])
+            for g in data_opts['groups_names']:
+                filt = samples_idx[g]
+                scale[filt] = 1. / np.sqrt(ss[g] / (group_counts([filt])[0]*Y.shape[1]))
+            Y = diags(scale).dot(Y).tocsr()
+
+    return Y
+
+def _process_disk_data(Y, data_opts):
+    """ Method to process a gaussian view stored on disk without loading it in memory
+
+    The features are centered per group and the views and groups are scaled when the blocks of samples are read
+    (see DiskView), using the statistics of a single pass over the data.
+    """
+    n, s1, s2 = Y.scan()
+
+    # Removing features with no variance
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = s2.sum(axis=0)/n.sum(axis=0) - s.square(s1.sum(axis=0)/n.sum(axis=0))
+    if np.any(var==0.):
+        print("Warning: %d features(s) have zero variance, consider removing them before training the model...\n" % (var==0.).sum())
+        sys.stdout.flush()
+
+    # Check that there are no features full of missing values
+    if np.any(n.sum(axis=0)==0):
+        print("Warning: %d features(s) are full of missing values, please consider removing them before training the model...\n" % (n.sum(axis=0)==0).sum())
+        sys.stdout.flush()
+
+    # Center features per group
+    Y.offsets = s1 / np.maximum(n, 1)
+
+    # Sum of squares and number of observations per group after centering
+    ss = (s2 - s1*Y.offsets).sum(axis=1)
+    n_obs = n.sum(axis=1)
+
+    # Scale views to unit variance
+    if data_opts['scale_views']:
+        scale = 1. / np.sqrt(ss.sum() / n_obs.sum())
+        Y.scales *= scale
+        ss *= scale**2
+
+    # Scale groups to unit variance
+    if data_opts['scale_groups']:
+        for g in range(len(ss)):
+            if n_obs[g] > 0: Y.scales[g] /= np.sqrt(ss[g] / n_obs[g])
+
+    return Y
+
 def process_data(data, likelihoods, data_opts, samples_groups):
 
+    # Samples of each group (slices if the samples are stored group-contiguously)
+    samples_idx = dict(zip(data_opts['groups_names'], group_slices(samples_groups, names=data_opts['groups_names'])))
+
     for m in range(len(data)):
 
+        if issparse(data[m]):
+            data[m] = _process_sparse_data(data[m], likelihoods[m], data_opts, samples_groups)
+            continue
+
+        # Views stored on disk are trained out-of-core, except non-gaussian views and views with partially observed
+        # samples that are loaded in memory
+        if isinstance(data[m], DiskView):
+            data[m].scan()
+            if likelihoods[m] == "gaussian" and not data[m].partial:
+                data[m] = _process_disk_data(data[m], data_opts)
+                continue
+            if likelihoods[m] == "gaussian":
+                print("Warning: view %d has missing values in partially observed samples, which cannot be trained out-of-core, loading it in memory...\n" % m)
+            else:
+                print("Warning: only gaussian views can be trained out-of-core, loading view %d in memory...\n" % m)
+            data[m] = data[m].load()
+
         # For some wierd reason, when using reticulate from R, missing values are stored as -2147483648
         data[m][data[m] == -2147483648] = np.nan
 
@@ -73,7 +188,7 @@ def process_data(data, likelihoods, data_opts, samples_groups):
 
             # Center features per group
             for g in data_opts['groups_names']:
-                filt = [gp==g for gp in samples_groups]
+                filt = samples_idx[g]
                 data[m][filt,:] -= np.nanmean(data[m][filt,:],axis=0)
 
             # Scale views to unit variance
@@ -83,7 +198,7 @@ def process_data(data, likelihoods, data_opts, samples_groups):
             # Scale groups to unit variance
             if data_opts['scale_groups']:
                 for g in data_opts['groups_names']:
-                    filt = [gp==g for gp in samples_groups]
+                    filt = samples_idx[g]
                     data[m][filt,:] /= np.nanstd(data[m][filt,:])
 
     return data
@@ -97,11 +212,103 @@ def guess_likelihoods(data):
 
     likelihoods = ["gaussian" for m in range(M)]
     for m in range(M):
-        mask = ~np.isnan(data[m])
-        if np.isin(data[m][mask],[0,1]).all():
+        if isinstance(data[m], DiskView):
+            # single pass over the blocks of samples of views stored on disk
+            binary, integer = True, True
+            for _, X in data[m].blocks(raw=True):
+                X = X[~np.isnan(X)]
+                binary = binary and np.isin(X,[0,1]).all()
+                integer = integer and np.all((X%1)==0)
+            if binary:
+                likelihoods[m] = "bernoulli"
+            elif integer:
+                likelihoods[m] = "poisson"
+            continue
+        if issparse(data[m]):
+            values = data[m].data
+        else:
+            values = data[m][~np.isnan(data[m])]
+        if np.isin(values,[0,1]).all():
             likelihoods[m] = "bernoulli"
         else:
-            if np.all( (data[m][mask]%1)==0):
+            if np.all( (values%1)==0):
                 likelihoods[m] = "poisson"  
 
     return likelihoods
+
+def _match_rows(X, ix, K):
+    """ Method to take the rows ix of a matrix (missing values where ix is -1) and its first K columns (missing values beyond its columns) """
+    out = np.full((len(ix), K), np.nan)
+    k = min(K, X.shape[1])
+    out[ix>=0,:k] = X[ix[ix>=0],:k]
+    return out
+
+def load_expectations(filename, data_opts, model_opts, K):
+    """
+    Method to load the expectations of a model saved with saveModel, to initialise a new model from them (warm start)
+
+    The samples, features, groups and views of the data are matched by name to the ones of the saved model, and the factors
+    in the order of the saved model (sorted by variance explained). Returns a dictionary with the expectations of the Z, W,
+    Tau (gaussian views), AlphaZ, AlphaW, ThetaZ and ThetaW nodes found in the file, in the shape of the nodes of the new
+    model (with one array per view, or None for new views, for the multi-view nodes). The entries of new samples, features,
+    groups or factors are missing values, and keep their default initialisation.
+
+    PARAMETERS
+    ----------
+    filename: hdf5 file created by entry_point.save
+    data_opts: data options of the new model
+    model_opts: model options of the new model
+    K: number of factors of the new model
+    """
+    decode = lambda x: [ i.decode() if isinstance(i, bytes) else str(i) for i in x ]
+    index = lambda names, saved: pd.Index(saved).get_indexer(names)
+
+    with h5py.File(filename, 'r') as f:
+        views = decode(f['views']['views'][()])
+        groups = decode(f['groups']['groups'][()])
+        exp = f['expectations']
+
+        # Match the views, the groups and the features of each view
+        ix_views = index(data_opts['views_names'], views)
+        ix_groups = index(data_opts['groups_names'], groups)
+        ix_features = [ index(data_opts['features_names'][m], decode(f['features'][views[i]][()])) if i>=0 else None for m,i in enumerate(ix_views) ]
+
+        # Match the samples (in the order of the data, which can differ from the order of samples_names across groups)
+        samples_names = np.empty(len(data_opts['samples_groups']), dtype=object)
+        for g, idx in enumerate(group_slices(data_opts['samples_groups'], names=data_opts['groups_names'])):
+            samples_names[idx] = data_opts['samples_names'][g]
+        saved_samples = list(chain(*[ decode(f['samples'][g][()]) for g in groups ]))
+        ix_samples = index(samples_names.astype(str), saved_samples)
+
+        expectations = {}
+
+        # Factors (matched by sample)
+        if 'Z' in exp:
+            Z = np.concatenate([ exp['Z'][g][()].T for g in groups ], axis=0)
+            expectations['Z'] = _match_rows(Z, ix_samples, K)
+
+        # Weights (matched by feature)
+        if 'W' in exp:
+            expectations['W'] = [ _match_rows(exp['W'][views[i]][()].T, ix_features[m], K) if i>=0 else None for m,i in enumerate(ix_views) ]
+
+        # Noise precision of the gaussian views (matched by group and feature)
+        if 'Tau' in exp:
+            expectations['Tau'] = [None] * len(ix_views)
+            for m,i in enumerate(ix_views):
+                if i<0 or model_opts['likelihoods'][m] != "gaussian": continue
+                tau = np.stack([ np.nanmean(exp['Tau'][views[i]][g][()], axis=0) for g in groups ])
+                tau = _match_rows(tau, ix_groups, tau.shape[1])
+                expectations['Tau'][m] = _match_rows(tau.T, ix_features[m], len(ix_groups)).T
+
+        # Sparsity priors on the factors (matched by group) and on the weights
+        for node in ['AlphaZ', 'ThetaZ']:
+            if node in exp:
+                expectations[node] = _match_rows(exp[node]['E'][()].T, ix_groups, K)
+        for node in ['AlphaW', 'ThetaW']:
+            if node in exp:
+                expectations[node] = [ _match_rows(exp[node][views[i]][()][None,:], np.zeros(1, dtype=int), K)[0] if i>=0 else None for m,i in enumerate(ix_views) ]
+
+    print("Initialising the model from %s: %d out of %d samples and %d out of %d features found\n" % (filename,
+        (ix_samples>=0).sum(), len(ix_samples), sum([ (ix>=0).sum() for ix in ix_features if ix is not None ]), sum(len(x) for x in data_opts['features_names'])))
+
+    return expectations
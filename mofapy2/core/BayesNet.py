@@ -6,7 +6,9 @@ and the corresponding attributes/methods to train the model, set algorithmic opt
 
 from __future__ import division
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 import os
+import pickle
 import scipy as s
 import pandas as pd
 import sys
@@ -17,7 +19,9 @@ import numpy as np
 from mofapy2.core.nodes.variational_nodes import Variational_Node
 from mofapy2.core.nodes.multiview_nodes import Multiview_Variational_Node
 from mofapy2.core import gpu_utils
-from .utils import corr, nans, infer_platform
+from mofapy2.core import parallel
+from mofapy2.core.product_cache import ProductCache
+from .utils import corr, nans, infer_platform, group_slices
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -38,6 +42,20 @@ class BayesNet(object):
         self.nodes = nodes
         self.options = None
 
+        # Products E[Z]E[W]^T shared between the nodes
+        self.cache = ProductCache()
+        for node in self.nodes.values():
+            node.setCache(self.cache)
+
+        # Variance explained per factor and group of each view, tracked with the versions of the Z, W and Y nodes
+        self.activity = {}
+
+        # Function called with the iteration and the ELBO every time the ELBO is computed, which stops the training if it returns True
+        self.callback = None
+
+        # Training state saved in the checkpoints, from which the training is resumed (see saveCheckpoint)
+        self.state = None
+
         # Training and simulations flag
         self.trained = False
         self.simulated = False
@@ -45,6 +63,24 @@ class BayesNet(object):
         # Set GPU mode
         # gpu_utils.gpu_mode = options['gpu_mode']
 
+    def __getstate__(self):
+        # the data (see setData) and the caches are not saved with the model (e.g. in the checkpoints)
+        state = self.__dict__.copy()
+        state['activity'], state['callback'] = {}, None
+        return state
+
+    def setData(self, data, masks=None):
+        """ Method to bind the data to the Y nodes of a model saved without it (e.g. loaded from a checkpoint)
+
+        PARAMETERS
+        ----------
+        data: list of the observations of each view, as given to the nodes when the model was built
+        masks (optional): list of the masks of the missing values of each view, if they have already been filled in the data
+        """
+        if masks is None: masks = [None] * len(data)
+        for node, y, mask in zip(self.nodes["Y"].getNodes(), data, masks):
+            node.setData(y, self.options, mask)
+
     def setTrainOptions(self, train_opts):
         """ Method to store training options """
 
@@ -61,9 +97,15 @@ class BayesNet(object):
         assert "start_sparsity" in train_opts, "'start_sparsity' not found in the training options dictionary"
         assert "gpu_mode" in train_opts, "'gpu_mode' not found in the training options dictionary"
         assert "start_elbo" in train_opts, "'gpu_mode' not found in the training options dictionary"
+        assert "observed_entries" in train_opts, "'observed_entries' not found in the training options dictionary"
+        assert "n_threads" in train_opts, "'n_threads' not found in the training options dictionary"
+        assert "checkpoint" in train_opts, "'checkpoint' not found in the training options dictionary"
 
         self.options = train_opts
 
+        # Pool of threads to run the views concurrently
+        parallel.setup(self.options['n_threads'])
+
     def getParameters(self, *nodes):
         """ Method to collect all parameters of a given set of nodes
 
@@ -107,48 +149,125 @@ class BayesNet(object):
 
     def calculate_variance_explained(self, total=False):
 
-        # Collect relevant expectations
-        Z = self.nodes['Z'].getExpectation()
-        W = self.nodes["W"].getExpectation()
-        Y = self.nodes["Y"].getExpectation()
-
-        # Get groups
-        groups = self.nodes["AlphaZ"].groups if "AlphaZ" in self.nodes else s.array([0]*self.dim['N'])
-
         if total:
             r2 = [ s.zeros(self.dim['M']) for g in range(self.dim['G'])]
         else:
             r2 = [ s.zeros([self.dim['M'], self.dim['K']])  for g in range(self.dim['G'])]
 
         for m in range(self.dim['M']):
-            mask = self.nodes["Y"].getNodes()[m].getMask(full=True)
+            # Variance explained per factor, only recomputed when Z, W or Y have changed
+            if not total:
+                versions = self.activity_versions(m)
+                if m not in self.activity or self.activity[m][0] != versions:
+                    Res, SS = self.residual_sum_squares(m)
+                    self.activity[m] = (versions, 1. - Res/SS[:,None])
+                for g in range(self.dim['G']):
+                    r2[g][m] = self.activity[m][1][g]
+                continue
+
+            Res, SS = self.residual_sum_squares(m, total)
             for g in range(self.dim['G']):
-                gg = groups==g
-                SS = s.square(Y[m][gg,:]).sum()
+                r2[g][m] = 1. - Res[g] / SS[g]
+        return r2
 
-                # Total variance explained (using all factors)
-                if total:
-                    Ypred = s.dot(Z[gg,:], W[m].T)
-                    Ypred[mask[gg,:]] = 0.
-                    Res = s.sum((Y[m][gg, :] - Ypred) ** 2.)
-                    r2[g][m] = 1. - Res / SS
+    def residual_sum_squares(self, m, total=False):
+        """ Method to calculate the residual sum of squares of view m in each group, for each factor (G,K) or using all
+        factors (G,), and the sum of squares of the data in each group (G,), from which the variance explained is computed """
+
+        # Collect relevant expectations
+        Z = self.nodes['Z'].getExpectation()
+        W = self.nodes["W"].getNodes()[m].getExpectation()
+        Y = self.nodes["Y"].getNodes()[m].getExpectation()
+        mask = self.nodes["Y"].getNodes()[m].getMask(full=True)
+        stats = self.nodes["Y"].getNodes()[m].stats if hasattr(self.nodes["Y"].getNodes()[m], "stats") else None
 
-                # Variance explained per factor
+        # Get groups
+        groups = self.nodes["AlphaZ"].groups if "AlphaZ" in self.nodes else s.array([0]*self.dim['N'])
+        group_idx = group_slices(groups, self.dim['G'])
+
+        Res, SS = [], []
+        for g in range(self.dim['G']):
+            gg = group_idx[g]
+            if stats is not None and stats.observed is not None and g in stats.partial:
+                # views stored as observed entries
+                res, ss = self.residual_sum_squares_observed(stats, g, Z, W, total)
+            elif not total:
+                res, ss = self.residual_sum_squares_factors(Y, mask, stats, gg, g, Z, W)
+            elif stats is not None and stats.disk and g in stats.complete:
+                # views stored on disk use the sufficient statistics of the data
+                res, ss = stats.sumSquaredResiduals(g, Z, W), stats.YY[g,:].sum()
+            else:
+                if stats is not None and stats.sparse:
+                    # sparse views are centered implicitly, densify one group at a time
+                    Yg = stats.getSamples(g)
                 else:
-                    for k in range(self.dim['K']):
-                        Ypred = s.outer(Z[gg,k], W[m][:,k])
-                        Ypred[mask[gg,:]] = 0.
-                        Res = s.sum((Y[m][gg,:] - Ypred)**2.)
-                        r2[g][m,k] = 1. - Res/SS
-        return r2
+                    Yg = Y[gg,:]
+                ss = s.square(Yg).sum()
 
-    def removeInactiveFactors(self, min_r2=None):
+                # Total variance explained (using all factors)
+                Ypred = s.where(mask[gg,:], 0., self.cache.dotZW(self.nodes["Z"], self.nodes["W"].getNodes()[m])[gg,:])
+                res = s.sum((Yg - Ypred) ** 2.)
+            Res.append(res)
+            SS.append(ss)
+        return s.array(Res), s.array(SS)
+
+    def residual_sum_squares_factors(self, Y, mask, stats, gg, g, Z, W):
+        """ Method to calculate the residual sum of squares of each factor in a group, and the sum of squares of the data
+
+        The residual sum of squares of factor k is expanded as
+            sum(Y^2) - 2*sum_n Z[n,k]*(Y·W)[n,k] + sum_n Z[n,k]^2*(O·W^2)[n,k]
+        where O is the indicator of the observed entries, so that all factors are obtained from a few matrix products
+        """
+        Zg = Z[gg,:]
+        if stats is not None and g in stats.complete:
+            # fully observed groups use the sufficient statistics of the data
+            Zg = Z[stats.samples[g],:]
+            SS = stats.YY[g,:].sum()
+            YW = stats.dotY(g, W)
+            ZZWW = s.square(Zg).sum(axis=0) * s.square(W).sum(axis=0)
+        else:
+            Yg = stats.getSamples(g) if stats is not None and stats.sparse else Y[gg,:]
+            mask_g = mask[gg,:]
+            SS = s.square(Yg).sum()
+            if mask_g.any():
+                YW = s.dot(s.where(mask_g, 0., Yg), W)
+                ZZWW = s.square(Zg) * s.dot(~mask_g, s.square(W))
+                ZZWW = ZZWW.sum(axis=0)
+            else:
+                YW = s.dot(Yg, W)
+                ZZWW = s.square(Zg).sum(axis=0) * s.square(W).sum(axis=0)
+        Res = SS - 2.*(Zg*YW).sum(axis=0) + ZZWW
+        return Res, SS
+
+    def residual_sum_squares_observed(self, stats, g, Z, W, total=False):
+        """ Method to calculate the residual sum of squares in a group stored as a list of observed entries, and the sum
+        of squares of the data """
+        filt = stats.observed_groups==g
+        rows = stats.partial_samples[stats.observed.rows[filt]]
+        cols = stats.observed.cols[filt]
+        Y = stats.observed.values[filt]
+        SS = s.square(Y).sum()
+        if total:
+            Res = s.sum((Y - (Z[rows,:]*W[cols,:]).sum(axis=1))**2.)
+        else:
+            Res = s.sum((Y[:,None] - Z[rows,:]*W[cols,:])**2., axis=0)
+        return Res, SS
+
+    def activity_versions(self, m):
+        """ Method to get the versions of the nodes that determine the variance explained in view m """
+        return (self.nodes["Z"].version, self.nodes["W"].getNodes()[m].version, self.nodes["Y"].getNodes()[m].version)
+
+    def removeInactiveFactors(self, min_r2=None, drop_all=False):
         """Method to remove inactive factors
 
         PARAMETERS
         ----------
         min_r2: float
             threshold to shut down factors based on a minimum variance explained per group and view
+        drop_all: bool
+            drop all inactive factors at once, instead of a single random one
+
+        Returns the indices of the dropped factors
         """
         drop_dic = {}
 
@@ -157,21 +276,76 @@ class BayesNet(object):
 
             tmp = [ s.where( (r2[g]>min_r2).sum(axis=0) == 0)[0] for g in range(self.dim['G']) ]
             drop_dic["min_r2"] = list(set.intersection(*map(set,tmp)))
-            if len(drop_dic["min_r2"]) > 0:
+            if len(drop_dic["min_r2"]) > 0 and not drop_all:
                 drop_dic["min_r2"] = [ s.random.choice(drop_dic["min_r2"]) ]
 
-        # Drop the factors
-        drop = s.unique(s.concatenate(list(drop_dic.values())))
+        # When all inactive factors are dropped at once, keep the one that explains the most variance
+        drop = s.unique(s.concatenate(list(drop_dic.values()))).astype(int)
+        if drop_all and len(drop) == self.dim['K'] and len(drop) > 0:
+            r2_total = s.sum([ r2[g].sum(axis=0) for g in range(self.dim['G']) ], axis=0)
+            drop = s.delete(drop, s.argmax(r2_total[drop]))
         if len(drop) > 0:
+            # the variance explained by each of the remaining factors does not change
+            keep = s.setdiff1d(s.arange(self.dim['K']), drop)
+            valid = [ m for m in self.activity if self.activity[m][0] == self.activity_versions(m) ]
             for node in self.nodes.keys():
                 self.nodes[node].removeFactors(drop)
+            self.activity = { m: (self.activity_versions(m), self.activity[m][1][:,keep]) for m in valid }
         self.dim['K'] -= len(drop)
 
         if self.dim['K']==0:
-            print("All factors shut down, no structure found in the data.")
-            exit()
+            raise ValueError("All factors shut down, no structure found in the data.")
+
+        return drop
+
+    def saveCheckpoint(self, state):
+        """ Method to save the model together with the state of the training loop, to resume it with entry_point.resume
 
-        pass
+        The data is not saved (see __getstate__), it is bound again to the model when the training is resumed.
+        The checkpoint also contains the state of the random number generator, which is used to drop factors and to sample
+        the mini-batches. It is first written to a temporary file that then replaces the previous checkpoint, so that an
+        interrupted job always leaves a complete checkpoint behind.
+
+        PARAMETERS
+        ----------
+        state: dict
+            variables of the training loop, including the next iteration 'i'
+        """
+        outfile = self.options['checkpoint']
+        tmp = outfile + ".tmp"
+        self.state = dict(state, rng=s.random.get_state())
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, outfile)
+        finally:
+            self.state = None
+
+    def checkpoint(self, i, t_checkpoint, **state):
+        """ Method to save a checkpoint at the end of iteration i if one is due
+
+        Checkpoints are saved every 'checkpoint_freq' iterations and/or every 'checkpoint_time' minutes since the last one
+        (started at t_checkpoint). Returns the time of the last checkpoint.
+        """
+        if self.options['checkpoint'] is None:
+            return t_checkpoint
+        due_iter = self.options['checkpoint_freq'] is not None and i%self.options['checkpoint_freq']==0
+        due_time = self.options['checkpoint_time'] is not None and time()-t_checkpoint >= 60.*self.options['checkpoint_time']
+        if due_iter or due_time:
+            self.saveCheckpoint(dict(state, i=i+1))
+            if not self.options['quiet']: print("Checkpoint saved to %s" % self.options['checkpoint'])
+            return time()
+        return t_checkpoint
+
+    def restoreState(self):
+        """ Method to restore the state of a training loop loaded from a checkpoint """
+        state, self.state = self.state, None
+        s.random.set_state(state.pop('rng'))
+        gpu_utils.gpu_mode = self.options['gpu_mode']
+        print("Resuming the training from iteration %d\n" % state['i'])
+        return state
 
     def precompute(self):
         # Precompute terms
@@ -201,13 +375,18 @@ class BayesNet(object):
         number_factors = nans((self.options['maxiter']+1))
         iter_time = nans((self.options['maxiter']+1))
 
-        # Precompute
-        converged = False; convergence_token = 1
-        elbo.iloc[0] = self.precompute()
-        number_factors[0] = self.dim['K']
-        iter_time[0] = 0.
+        # Precompute (or restore the training loop from a checkpoint)
+        converged = False; convergence_token = 1; start = 1
+        if self.state is None:
+            elbo.iloc[0] = self.precompute()
+            number_factors[0] = self.dim['K']
+            iter_time[0] = 0.
+        else:
+            state = self.restoreState()
+            start, elbo, number_factors, iter_time, convergence_token = state['i'], state['elbo'], state['number_factors'], state['iter_time'], state['convergence_token']
+        t_checkpoint = time()
 
-        for i in range(1,self.options['maxiter']):
+        for i in range(start,self.options['maxiter']):
             t = time();
 
             # Remove inactive factors
@@ -218,10 +397,7 @@ class BayesNet(object):
 
             # Update node by node, with E and M step merged
             t_updates = time()
-            for node in self.options['schedule']:
-                if (node=="ThetaW" or node=="ThetaZ") and i<self.options['start_sparsity']:
-                    continue
-                self.nodes[node].update()
+            self.updateNodes(i)
             t_updates = time() - t_updates
 
             # Calculate Evidence Lower Bound
@@ -246,6 +422,13 @@ class BayesNet(object):
                     print("- ELBO decomposition:  " + "".join([ "%s=%.2f  " % (k,v) for k,v in elbo.iloc[i].drop("total").iteritems() ]))
                     print('- Time spent in ELBO computation: %.1f%%' % (100*t_elbo/(t_updates+t_elbo)) )
 
+                # Report the ELBO (e.g. to the process running several restarts), which can stop the training
+                if self.callback is not None and self.callback(i, elbo.iloc[i]["total"]):
+                    number_factors = number_factors[:i]
+                    elbo = elbo[:i]
+                    iter_time = iter_time[:i]
+                    print("\nTraining stopped\n"); break
+
                 # Assess convergence
                 if i>self.options["start_elbo"] and not self.options['forceiter']:
                     convergence_token, converged = self.assess_convergence(delta_elbo, elbo.iloc[0]["total"], convergence_token)
@@ -264,14 +447,27 @@ class BayesNet(object):
                 self.print_verbose_message()
 
             iter_time[i] = time()-t
+
+            # Save the training state
+            t_checkpoint = self.checkpoint(i, t_checkpoint, elbo=elbo, number_factors=number_factors, iter_time=iter_time, convergence_token=convergence_token)
             
             # Flush (we need this to print when running on the cluster)
             sys.stdout.flush()
 
+        # Release the products E[Z]E[W]^T
+        self.cache.clear()
+
         # Finish by collecting the training statistics
         self.train_stats = { 'time':iter_time, 'number_factors':number_factors, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1) }
         self.trained = True
 
+    def updateNodes(self, i):
+        """Method to update the nodes in the order of the schedule (iteration i)"""
+        for node in self.options['schedule']:
+            if (node=="ThetaW" or node=="ThetaZ") and i<self.options['start_sparsity']:
+                continue
+            self.nodes[node].update()
+
     def print_verbose_message(self):
         """Method to print training statistics if Verbose is TRUE"""
 
@@ -290,7 +486,7 @@ class BayesNet(object):
 
         # Correlation between factors
         Z = self.nodes["Z"].getExpectation()
-        Z += s.random.normal(s.zeros(Z.shape),1e-10)
+        Z = Z + s.random.normal(s.zeros(Z.shape),1e-10)
         r = s.absolute(corr(Z.T,Z.T)); s.fill_diagonal(r,0)
         print("- Maximum correlation between factors: %.2f" % (s.nanmax(r)))
 
@@ -353,8 +549,12 @@ class BayesNet(object):
         """ Method to return training data """
         return self.nodes["Y"].getValues()
 
-    def calculateELBO(self, *nodes):
-        """Method to calculate the Evidence Lower Bound of the model"""
+    def calculateELBO(self, *nodes, ix=None):
+        """Method to calculate the Evidence Lower Bound of the model
+
+        If the samples ix of a mini-batch are given, the terms of the nodes that implement estimateELBO (the gaussian
+        views and the factors) are estimated from the mini-batch, and the other terms are computed exactly
+        """
 
         weights = [1] * self.dim['M']        
         if self.options['weight_views'] and self.dim['M'] > 1:
@@ -368,7 +568,9 @@ class BayesNet(object):
         elbo = pd.Series(s.zeros(len(nodes)+1), index=list(nodes)+["total"])
         for node in nodes:
             if isinstance(self.nodes[node], Multiview_Variational_Node):
-                elbo[node] = float(self.nodes[node].calculateELBO(weights = weights))
+                elbo[node] = float(self.nodes[node].calculateELBO(weights = weights, ix = ix))
+            elif ix is not None and hasattr(self.nodes[node], "estimateELBO"):
+                elbo[node] = float(self.nodes[node].estimateELBO(ix))
             else:
                 elbo[node] = float(self.nodes[node].calculateELBO())
             elbo["total"] += elbo[node]
@@ -379,6 +581,15 @@ class StochasticBayesNet(BayesNet):
     def __init__(self, dim, nodes):
         super().__init__(dim=dim, nodes=nodes)
 
+        # Shuffled samples of the current epoch (and of the next one once it is needed)
+        self.shuffled_ix = {}
+
+        # Group of each sample, used to stratify the mini-batches
+        groups = [ self.nodes[n] for n in ("AlphaZ", "ThetaZ") if n in self.nodes ] + list(self.nodes["Tau"].getNodes())
+        groups = [ node.groups for node in groups if hasattr(node, "groups") ]
+        self.groups = groups[0] if len(groups) > 0 else s.zeros(self.dim['N'], dtype=int)
+        self.n_per_group = s.bincount(self.groups, minlength=self.dim['G'])
+
     def step_size(self, i):
         # return the step size for the considered iteration
         return (i + self.options['learning_rate'])**(-self.options['forgetting_rate'])
@@ -394,8 +605,11 @@ class StochasticBayesNet(BayesNet):
         self.define_mini_batch(ix)
         return ix
 
-    def sample_mini_batch_no_replace(self, i):
-        """ Method to define mini batches"""
+    def mini_batch_samples(self, i):
+        """ Method to get the samples of a mini-batch, the samples of an epoch are shuffled the first time they are needed
+
+        Returns the indices of the samples, their position in the shuffled samples of the epoch and the epoch
+        """
 
         i -= 1 # This is because we start at iteration 1 in the main loop
 
@@ -404,26 +618,105 @@ class StochasticBayesNet(BayesNet):
         S = self.options['batch_size'] * self.dim['N']
         batch_ix = i % n_batches
         epoch = int(i / n_batches)
-        if batch_ix == 0:
-            print("\n## Epoch %s ##" % str(epoch+1))
-            print("-------------------------------------------------------------------------------------------")
-            self.shuffled_ix = s.random.choice(range(self.dim['N']), size=self.dim['N'], replace=False)
+        if self.options['stratified']:
+            return self.stratified_mini_batch_samples(batch_ix, n_batches, epoch)
+        if epoch not in self.shuffled_ix:
+            ix = s.random.choice(range(self.dim['N']), size=self.dim['N'], replace=False)
+
+            # The samples of each mini-batch are sorted, so that their rows are gathered in order
+            # and the groups are contiguous within the mini-batch
+            bounds = np.minimum((S*s.arange(n_batches+1)).astype(int), self.dim['N'])
+            ix = s.concatenate([ np.sort(ix[bounds[b]:bounds[b+1]]) for b in range(n_batches) ])
+            self.shuffled_ix = { e:v for e,v in self.shuffled_ix.items() if e == epoch-1 }
+            self.shuffled_ix[epoch] = ix
 
         min = int(S * batch_ix)
         max = int(S * (batch_ix + 1))
 
         if max>self.dim['N']: print("Error in stochastic"); exit()
 
+        return self.shuffled_ix[epoch][min:max], slice(min, max), epoch
+
+    def batch_quotas(self, n_batches):
+        """ Method to compute the number of samples of each group in each mini-batch of a stratified epoch, (G,n_batches)
+
+        The samples of each group are spread evenly over the mini-batches, and the remainders of the groups are assigned
+        to different mini-batches so that the sizes of the mini-batches differ by at most one sample
+        """
+        quotas = s.repeat((self.n_per_group // n_batches)[:,None], n_batches, axis=1)
+        start = 0
+        for g in range(len(self.n_per_group)):
+            r = self.n_per_group[g] % n_batches
+            quotas[g, (start + s.arange(r)) % n_batches] += 1
+            start += r
+        return quotas
+
+    def stratified_mini_batch_samples(self, batch_ix, n_batches, epoch):
+        """ Method to get the samples of a mini-batch stratified by group (see mini_batch_samples)
+
+        Every group with at least as many samples as mini-batches is represented in every mini-batch
+        """
+        quotas = self.batch_quotas(n_batches)
+        bounds = s.concatenate([[0], s.cumsum(quotas.sum(axis=0))])
+        if epoch not in self.shuffled_ix:
+            # shuffle the samples of each group and split them according to the quotas
+            splits = [ np.split(s.random.permutation(s.where(self.groups==g)[0]), s.cumsum(quotas[g,:-1])) for g in range(len(self.n_per_group)) ]
+            ix = s.concatenate([ np.sort(s.concatenate([ splits[g][b] for g in range(len(splits)) ])) for b in range(n_batches) ])
+            self.shuffled_ix = { e:v for e,v in self.shuffled_ix.items() if e == epoch-1 }
+            self.shuffled_ix[epoch] = ix
+
+        rows = slice(int(bounds[batch_ix]), int(bounds[batch_ix+1]))
+        return self.shuffled_ix[epoch][rows], rows, epoch
+
+    def sample_weights(self, ix):
+        """ Method to compute the weights of the samples of a mini-batch stratified by group
+
+        Each sample stands for N_g/n_g samples of its group (n_g being the number of samples of group g in the mini-batch),
+        the weights are relative to the rescaling N/len(ix) used by the nodes
+        """
+        n_batch = s.bincount(self.groups[ix], minlength=len(self.n_per_group))
+        coeff = self.n_per_group / s.maximum(n_batch, 1)
+        return coeff[self.groups[ix]] * len(ix) / self.dim['N']
+
+    def sample_mini_batch_no_replace(self, i):
+        """ Method to define mini batches"""
+        ix, rows, epoch = self.mini_batch_samples(i)
+        if rows.start == 0:
+            print("\n## Epoch %s ##" % str(epoch+1))
+            print("-------------------------------------------------------------------------------------------")
+
+            # Lay out the data in the order of the epoch, so that the mini-batches are contiguous slices
+            if self.options['contiguous_batches']:
+                for node in self.nodes["Y"].getNodes():
+                    if hasattr(node, "permuteSamples"): node.permuteSamples(self.shuffled_ix[epoch])
+
         # Define mini batch
-        ix = self.shuffled_ix[min:max]
-        self.define_mini_batch(ix)
+        self.define_mini_batch(ix, rows)
 
         return ix, epoch
+
+    def prefetch_mini_batch(self, ix, buffers):
+        """ Method to read the data of a mini-batch in advance (run in a background thread)
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        buffers: suffix of the buffers of each view where the rows are gathered (None for the views not read in advance)
+
+        Returns the mini-batch read for each view (or None), to be stored in the nodes by the main thread
+        """
+        return [ node.prefetchMiniBatch(ix, b) if b is not None else None for node, b in zip(self.nodes["Y"].getNodes(), buffers) ]
     
-    def define_mini_batch(self, ix):
-        # Define mini-batch for each node
-        self.nodes['Z'].define_mini_batch(ix)
-        self.nodes['Y'].define_mini_batch(ix)
+    def define_mini_batch(self, ix, rows=None):
+        """ Method to define the mini-batch of each node
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        rows: position of the mini-batch in the samples of the epoch (to take contiguous mini-batches of the data)
+        """
+        self.nodes['Z'].define_mini_batch(ix, self.sample_weights(ix) if self.options['stratified'] else None)
+        self.nodes['Y'].define_mini_batch(ix, rows)
         self.nodes['Tau'].define_mini_batch(ix)
         if 'AlphaZ' in self.nodes:
             self.nodes['AlphaZ'].define_mini_batch(ix)
@@ -439,12 +732,24 @@ class StochasticBayesNet(BayesNet):
         number_factors = nans((self.options['maxiter']+1))
         iter_time = nans((self.options['maxiter']+1))
 
-        # Precompute
-        converged = False; convergence_token = 1
-        elbo.iloc[0] = self.precompute()
-        number_factors[0] = self.dim['K']
-        iter_time[0] = 0.
-        iter_count = 0
+        # ELBO used to assess convergence, smoothed if it is estimated from the mini-batches
+        smoothed_elbo = nans((self.options['maxiter']+1))
+
+        # Precompute (or restore the training loop from a checkpoint, the epoch and the position in the shuffled samples
+        # follow from the iteration and the shuffled samples of the current epoch are stored in the model)
+        converged = False; convergence_token = 1; start = 1
+        if self.state is None:
+            elbo.iloc[0] = self.precompute()
+            number_factors[0] = self.dim['K']
+            iter_time[0] = 0.
+            smoothed_elbo[0] = elbo.iloc[0]["total"]
+            iter_count = 0
+        else:
+            state = self.restoreState()
+            start, elbo, number_factors, iter_time, convergence_token, iter_count = state['i'], state['elbo'], state['number_factors'], state['iter_time'], state['convergence_token'], state['iter_count']
+            smoothed_elbo = state['smoothed_elbo']
+        t_checkpoint = time()
+        n_batches = math.ceil(1./self.options['batch_size'])
 
         # Print stochastic settings before training
         print("Using stochastic variational inference with the following parameters:")
@@ -452,11 +757,20 @@ class StochasticBayesNet(BayesNet):
             (100*self.options['batch_size'], self.options['forgetting_rate'], self.options['learning_rate'], self.options['start_stochastic']) )
         ix = None
 
-        for i in range(1, self.options['maxiter']):
+        # Thread reading the data of the next mini-batch while the current one is processed
+        prefetcher = ThreadPoolExecutor(max_workers=1) if self.options['prefetch'] else None
+        prefetched = None
+
+        for i in range(start, self.options['maxiter']):
             t = time();
 
             # Sample mini-batch and define step size for stochastic inference
             if i>=self.options["start_stochastic"]:
+                # the mini-batch read in advance is stored in the nodes once it is complete, before any mini-batch is defined
+                if prefetched is not None:
+                    for node, x in zip(self.nodes["Y"].getNodes(), prefetched.result()):
+                        if x is not None: node.prefetched = x
+                    prefetched = None
                 ix, epoch = self.sample_mini_batch_no_replace(i-(self.options["start_stochastic"]-1))
                 ro = self.step_size2(epoch)
             else:
@@ -470,9 +784,20 @@ class StochasticBayesNet(BayesNet):
             # Remove inactive factors
             if (i>=self.options["start_drop"]) and (i%self.options['freq_drop']) == 0:
                 if self.options['drop']["min_r2"] is not None:
+                    K = self.dim['K']
                     self.removeInactiveFactors(**self.options['drop'])
+
+                    # the mini-batch expectations have to be redefined with the remaining factors
+                    if ix is not None and self.dim['K'] < K:
+                        self.define_mini_batch(ix)
                 number_factors[i] = self.dim["K"]
 
+            # Start reading the next mini-batch (after dropping the factors, which draws from the random number generator
+            # before the samples of the next epoch are shuffled, as without reading in advance)
+            if prefetcher is not None and ix is not None and i+1 < self.options['maxiter']:
+                buffers = [ node.prefetchBuffer() if hasattr(node, "prefetchMiniBatch") else None for node in self.nodes["Y"].getNodes() ]
+                prefetched = prefetcher.submit(self.prefetch_mini_batch, self.mini_batch_samples(i+1-(self.options["start_stochastic"]-1))[0], buffers)
+
             # Update node by node, with E and M step merged
             t_updates = time()
             for node in self.options['schedule']:
@@ -481,20 +806,29 @@ class StochasticBayesNet(BayesNet):
                 self.nodes[node].update(ix, ro)
             t_updates = time() - t_updates
 
+            # The ELBO can be estimated from the mini-batch, and computed exactly at the end of every 'exact_elbo_epochs' epochs
+            estimate = ix is not None and self.options['minibatch_elbo']
+            exact = estimate and self.options['exact_elbo_epochs'] is not None and i>=self.options["start_elbo"] \
+                and (i-self.options["start_stochastic"]+1) % (n_batches*self.options['exact_elbo_epochs']) == 0
+
             # Calculate Evidence Lower Bound
-            if (i>=self.options["start_elbo"]) and ((i-self.options["start_elbo"])%self.options['freqELBO']==0):
+            if (i>=self.options["start_elbo"]) and ((i-self.options["start_elbo"])%self.options['freqELBO']==0 or exact):
                 t_elbo = time()
-                elbo.iloc[i] = self.calculateELBO()
+                elbo.iloc[i] = self.calculateELBO(ix = ix if estimate and not exact else None)
                 t_elbo = time() - t_elbo
 
-                # Check convergence using the ELBO
-                if i==self.options["start_elbo"]: 
-                    delta_elbo = elbo.iloc[i]["total"]-elbo.iloc[0]["total"]
+                # Check convergence using the ELBO, with an exponential moving average of the estimates
+                previous = smoothed_elbo[:i][~s.isnan(smoothed_elbo[:i])][-1]
+                if estimate:
+                    smoothed_elbo[i] = self.options['elbo_smoothing'] * previous + (1.-self.options['elbo_smoothing']) * elbo.iloc[i]["total"]
                 else:
-                    delta_elbo = elbo.iloc[i]["total"]-elbo.iloc[i-self.options['freqELBO']]["total"]
+                    smoothed_elbo[i] = elbo.iloc[i]["total"]
+                delta_elbo = smoothed_elbo[i] - previous
 
                 # Print ELBO monitoring
                 print("Iteration %d: time=%.2f, ELBO=%.2f, deltaELBO=%.3f (%.9f%%), Factors=%d" % (i, time()-t, elbo.iloc[i]["total"], delta_elbo, 100*abs(delta_elbo/elbo.iloc[0]["total"]), (self.dim['K'])))
+                if estimate:
+                    print("- %s ELBO, smoothed ELBO=%.2f" % ("Exact" if exact else "Mini-batch estimate of the", smoothed_elbo[i]))
                 if delta_elbo<0 and not self.options['stochastic']: print("Warning, lower bound is decreasing...\a")
 
                 # Print ELBO decomposed by node and variance explained
@@ -502,6 +836,13 @@ class StochasticBayesNet(BayesNet):
                     print("- ELBO decomposition:  " + "".join([ "%s=%.2f  " % (k,v) for k,v in elbo.iloc[i].drop("total").iteritems() ]))
                     print('- Time spent in ELBO computation: %.1f%%' % (100*t_elbo/(t_updates+t_elbo)) )
 
+                # Report the ELBO (e.g. to the process running several restarts), which can stop the training
+                if self.callback is not None and self.callback(i, elbo.iloc[i]["total"]):
+                    number_factors = number_factors[:i]
+                    elbo = elbo[:i]
+                    iter_time = iter_time[:i]
+                    print("\nTraining stopped\n"); break
+
                 # Assess convergence
                 if i>self.options["start_elbo"] and not self.options['forceiter']:
                     convergence_token, converged = self.assess_convergence(delta_elbo, elbo.iloc[0]["total"], convergence_token)
@@ -525,6 +866,9 @@ class StochasticBayesNet(BayesNet):
 
             iter_time[i] = time()-t
             iter_count += 1
+
+            # Save the training state
+            t_checkpoint = self.checkpoint(i, t_checkpoint, elbo=elbo, number_factors=number_factors, iter_time=iter_time, convergence_token=convergence_token, iter_count=iter_count, smoothed_elbo=smoothed_elbo)
             
             # Flush (we need this to print when running on the cluster)
             sys.stdout.flush()
@@ -532,6 +876,13 @@ class StochasticBayesNet(BayesNet):
         if iter_count+1 == self.options['maxiter']:
             print("\nMaximum number of iterations reached: {}\n".format(self.options['maxiter']))
 
+        # Stop reading mini-batches
+        if prefetcher is not None:
+            prefetcher.shutdown()
+
+        # Release the products E[Z]E[W]^T
+        self.cache.clear()
+
         # Finish by collecting the training statistics
         self.train_stats = { 'time':iter_time, 'number_factors':number_factors, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1) }
         self.trained = True
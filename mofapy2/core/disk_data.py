@@ -0,0 +1,171 @@
+"""
+Module to train the model on views stored on disk (out-of-core)
+
+The groups of a view can be memory-mapped arrays (e.g. np.load(file, mmap_mode="r")) or HDF5 datasets, which are
+wrapped in a DiskView. A DiskView reads blocks of samples on demand and returns them as they would be in memory after
+processing the data (centered per group, scaled, with missing values set to zero). The nodes only keep (N,K) and (D,K)
+state in memory, and the computations that involve the data stream over blocks of samples (see SufficientStatistics).
+
+Missing values are only supported for entire samples (e.g. a view that was not measured in some samples or groups).
+"""
+
+import numpy as np
+import h5py
+
+# Size of the blocks of samples read at once (in bytes)
+block_bytes = 2**26
+
+
+def is_disk(X):
+    """ Method to check if a matrix is stored on disk """
+    return isinstance(X, (np.memmap, h5py.Dataset, DiskView))
+
+
+def _reference(X):
+    """ Method to describe an array stored on disk, to reopen it after pickling """
+    if isinstance(X, np.memmap):
+        return ("memmap", X.filename, X.offset, X.shape, X.dtype.str, "F" if X.flags.f_contiguous and not X.flags.c_contiguous else "C")
+    if isinstance(X, h5py.Dataset):
+        return ("hdf5", X.file.filename, X.name)
+    return ("array", X)
+
+def _open(ref):
+    """ Method to reopen an array described by _reference """
+    if ref[0] == "memmap":
+        _, filename, offset, shape, dtype, order = ref
+        return np.memmap(filename, dtype=np.dtype(dtype), mode="r", offset=offset, shape=shape, order=order)
+    if ref[0] == "hdf5":
+        return h5py.File(ref[1], "r")[ref[2]]
+    return ref[1]
+
+
+class DiskView(object):
+    """ View stored on disk as one array per group of samples
+
+    PARAMETERS
+    ----------
+    arrays: list of arrays (N_g,D), one per group, stored on disk (np.memmap or h5py.Dataset) or in memory
+    dtype: floating point precision of the blocks that are read
+    """
+    ndim = 2
+
+    def __init__(self, arrays, dtype=np.float64):
+        self.arrays = list(arrays)
+        self.dtype = np.dtype(dtype)
+        self.starts = np.concatenate([[0], np.cumsum([ X.shape[0] for X in self.arrays ])]).astype(int)
+        self.shape = (int(self.starts[-1]), int(self.arrays[0].shape[1]))
+
+        # Offsets and scales of each group, applied when reading (see build_model.utils._process_disk_data)
+        self.offsets = np.zeros((len(self.arrays), self.shape[1]))
+        self.scales = np.ones(len(self.arrays))
+
+        # Samples without observations, whether some samples are partially observed and moments of the raw data (see scan)
+        self.missing = None
+        self.partial = False
+        self.moments = None
+
+    @property
+    def block_size(self):
+        return max(1, block_bytes // (self.shape[1] * 8))
+
+    def astype(self, dtype, copy=False):
+        """ Method to read the blocks with a given floating point precision """
+        out = object.__new__(DiskView)
+        out.__dict__.update(self.__dict__)
+        out.dtype = np.dtype(dtype)
+        return out
+
+    def __getstate__(self):
+        # the arrays stored on disk are pickled by reference
+        state = self.__dict__.copy()
+        state['arrays'] = [ _reference(X) for X in self.arrays ]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.arrays = [ _open(ref) for ref in self.arrays ]
+
+    def _indices(self, ix):
+        """ Method to convert a subset of samples (slice, array of indices or boolean mask) to an array of indices """
+        if isinstance(ix, slice):
+            return np.arange(*ix.indices(self.shape[0]))
+        ix = np.asarray(ix)
+        if ix.dtype == bool:
+            return np.flatnonzero(ix)
+        return ix.astype(int, copy=False)
+
+    def _read(self, g, rows, raw=False):
+        """ Method to read some rows of a group (sorted indices) """
+        X = self.arrays[g]
+        if len(rows) > 0 and rows[-1]-rows[0]+1 == len(rows):
+            X = X[rows[0]:rows[-1]+1]
+        else:
+            X = X[rows]
+        X = np.array(X, dtype=self.dtype)
+        if raw:
+            return X
+        X -= self.offsets[g,:]
+        if self.scales[g] != 1.:
+            X *= self.scales[g]
+        X[np.isnan(X)] = 0.
+        return X
+
+    def read(self, ix, raw=False):
+        """ Method to read a subset of samples (slice or array of indices) as a dense array
+
+        The samples are centered and scaled, with missing values set to zero (unless raw is True)
+        """
+        ix = self._indices(ix)
+        out = np.empty((len(ix), self.shape[1]), dtype=self.dtype)
+        if len(ix) == 0:
+            return out
+        order = np.argsort(ix, kind="stable")
+        sorted_ix = ix[order]
+        bounds = np.searchsorted(sorted_ix, self.starts)
+        for g in range(len(self.arrays)):
+            if bounds[g] == bounds[g+1]: continue
+            pos = order[bounds[g]:bounds[g+1]]
+            rows, inverse = np.unique(sorted_ix[bounds[g]:bounds[g+1]] - self.starts[g], return_inverse=True)
+            out[pos] = self._read(g, rows, raw)[inverse]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            assert len(key)==2 and key[1]==slice(None), "only subsets of samples can be read from a DiskView"
+            key = key[0]
+        return self.read(key)
+
+    def blocks(self, ix=slice(None), raw=False):
+        """ Method to iterate over blocks of a subset of samples, yielding the position of each block in the subset and its data """
+        ix = self._indices(ix)
+        for i in range(0, len(ix), self.block_size):
+            yield slice(i, i+self.block_size), self.read(ix[i:i+self.block_size], raw)
+
+    def scan(self):
+        """ Method to compute the number of observations, the sums and the sums of squares per group and feature
+        (ignoring missing values), and to find the samples without observations and whether some samples are
+        partially observed (such views cannot be trained out-of-core, see build_model.utils.process_data)
+
+        The data is only read once, the moments of the raw data are kept for later calls
+        """
+        if self.moments is not None:
+            return self.moments
+        G, D = len(self.arrays), self.shape[1]
+        n, s1, s2 = np.zeros((G,D)), np.zeros((G,D)), np.zeros((G,D))
+        self.missing = np.zeros(self.shape[0], dtype=bool)
+        for g in range(G):
+            for b, X in self.blocks(slice(self.starts[g], self.starts[g+1]), raw=True):
+                nan = np.isnan(X)
+                n_missing = nan.sum(axis=1)
+                self.partial = self.partial or bool(np.any((n_missing > 0) & (n_missing < D)))
+                self.missing[self.starts[g]:self.starts[g+1]][b] = n_missing == D
+                X[nan] = 0.
+                n[g,:] += (~nan).sum(axis=0)
+                s1[g,:] += X.sum(axis=0)
+                s2[g,:] += np.square(X).sum(axis=0)
+        self.moments = (n, s1, s2)
+        return self.moments
+
+    def load(self):
+        """ Method to load the (raw) view in memory """
+        return np.concatenate([ self._read(g, np.arange(self.arrays[g].shape[0]), raw=True) for g in range(len(self.arrays)) ])
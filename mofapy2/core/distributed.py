@@ -0,0 +1,853 @@
+"""
+Module to train a model in several processes, each holding a shard of the data in shared memory (see shared_data)
+
+- DistributedBayesNet (full-batch inference): each worker updates the factors of a shard of samples, and the coordinator
+  updates the other nodes from the sums over the samples reduced over the workers, as BayesNet does.
+
+- FeatureShardedBayesNet (full-batch inference, for very wide views): each worker updates the weights and Tau of a shard
+  of the features of every view, and the coordinator updates the factors from the sums over the features.
+
+- AsyncStochasticBayesNet (stochastic inference): each worker trains the local nodes (Z, AlphaZ, ThetaZ) of a shard of
+  samples on mini-batches and pushes the targets of the global nodes (W and Tau) computed with a step size of one. The
+  coordinator applies the pushes as they arrive with the step size of the iteration (stale synchronous parallel).
+"""
+
+import os
+import sys
+import gc
+import math
+import contextlib
+import traceback
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from time import time
+import numpy as np
+import scipy as s
+import pandas as pd
+
+from mofapy2.core.BayesNet import BayesNet, StochasticBayesNet
+from mofapy2.core.nodes.multiview_nodes import Multiview_Node
+from mofapy2.core.nodes.Tau_nodes import TauD_Node
+from mofapy2.core.residuals import get_residuals
+from mofapy2.core import parallel, shared_data
+from .utils import nans, group_sum
+
+# Global nodes updated with the step size of the iteration, and global nodes that only depend on W
+STOCHASTIC_NODES = ["W", "Tau"]
+W_NODES = ["AlphaW", "ThetaW"]
+
+
+def get_views(node):
+    """ Method to get the single-view nodes of a (multiview) node """
+    if isinstance(node, Multiview_Node):
+        return [ node.getNodes()[m] for m in node.activeM ]
+    return [node]
+
+def get_parameters(node, copy=True):
+    """ Method to get the parameters of the variational distribution of each view of a node (None for the views without) """
+    params = []
+    for view in get_views(node):
+        Q = getattr(view, "Q", None)
+        if Q is None:
+            params.append(None)
+        else:
+            params.append({ k:(s.array(v) if copy else v) for k,v in Q.getParameters().items() })
+    return params
+
+def set_parameters(node, params):
+    """ Method to set the parameters of the variational distribution of each view of a node and update its expectations """
+    for view, p in zip(get_views(node), params):
+        if p is not None:
+            view.Q.setParameters(**p)
+        view.updateExpectations()
+
+def blend(params, targets, ro):
+    """ Method to take a natural gradient step of size ro from the parameters towards the targets """
+    return [ None if p is None else { k:(1.-ro)*p[k] + ro*t[k] for k in p } for p, t in zip(params, targets) ]
+
+def shard_samples(groups, n_shards):
+    """ Method to split the samples into shards with the same fraction of each group
+
+    Returns a list with the (sorted) indices of the samples of each shard
+    """
+    splits = [ np.array_split(s.where(groups==g)[0], n_shards) for g in np.unique(groups) ]
+    return [ np.sort(s.concatenate([ x[w] for x in splits ])) for w in range(n_shards) ]
+
+def get_offsets(model):
+    """ Method to get the offsets of the sparse views of a model (the means of the groups), None for the other views """
+    stats = [ getattr(view, "stats", None) for view in model.nodes["Y"].getNodes() ]
+    return [ x.offsets if x is not None and x.sparse else None for x in stats ]
+
+
+class ShardBayesNet(StochasticBayesNet):
+    """ Model of a shard of samples (or of features), held by a worker process """
+    def __init__(self, dim, nodes, n_per_group):
+        super().__init__(dim=dim, nodes=nodes)
+
+        # Number of samples of each group in all the shards
+        self.total_per_group = s.asarray(n_per_group, dtype=float)
+
+        # Residuals of the views during the updates of the coordinator (full-batch inference)
+        self.residuals = {}
+
+    def precompute(self):
+        """ Method to precompute the terms of the nodes, with the number of samples of each group in all the shards """
+        for n in self.nodes:
+            self.nodes[n].precompute(self.options)
+        for node in [ self.nodes[n] for n in ("AlphaZ", "ThetaZ") if n in self.nodes ] + list(self.nodes["Tau"].getNodes()):
+            if hasattr(node, "n_per_group"): node.n_per_group = self.total_per_group.copy()
+
+    def sample_weights(self, ix):
+        """ Method to compute the weights of the samples of a mini-batch, each standing for the samples of its group in
+        all the shards """
+        n_batch = s.bincount(self.groups[ix], minlength=len(self.n_per_group))
+        coeff = self.total_per_group / s.maximum(n_batch, 1)
+        return coeff[self.groups[ix]] * len(ix) / self.dim['N']
+
+    def setOffsets(self, offsets):
+        """ Method to center the sparse views with the means of the groups in all the shards """
+        for view, x in zip(self.nodes["Y"].getNodes(), offsets):
+            if x is not None: view.stats.setOffsets(x)
+
+    def setLocalParameters(self, params):
+        """ Method to set the parameters of nodes from the coordinator """
+        for name, p in params.items():
+            set_parameters(self.nodes[name], p)
+
+    def updateFactors(self):
+        """ Method to update the factors of the shard (full-batch), returns their parameters """
+        self.nodes["Z"].update()
+        return get_parameters(self.nodes["Z"])[0]
+
+    def updateWeights(self):
+        """ Method to update the weights of the shard of features (full-batch), returns their parameters """
+        self.nodes["W"].update()
+        return get_parameters(self.nodes["W"])
+
+    def updateNoise(self):
+        """ Method to update the precision of the noise of the shard of features (full-batch), returns its parameters """
+        self.nodes["Tau"].update()
+        return get_parameters(self.nodes["Tau"])
+
+    def buildResiduals(self, m):
+        """ Method to build the residuals of view m for the update of W (or Z) """
+        Y, Tau = self.nodes["Y"].getNodes()[m], self.nodes["Tau"].getNodes()[m]
+        W = self.nodes["W"].getNodes()[m].getExpectations()["E"]
+        self.residuals[m] = get_residuals(Y, Tau, self.nodes["Z"].getExpectations()["E"], W)
+
+    def tauDotZ(self, m, A):
+        """ Method to compute tau^T·A for the residuals of view m and a (N,K) matrix A of the shard """
+        return self.residuals[m].tauDotZ(A)
+
+    def dotZ(self, m, k):
+        """ Method to project the residuals of view m on the values of factor k """
+        return self.residuals[m].dotZ(k)
+
+    def updateW(self, m, k, w):
+        """ Method to replace the weights of factor k in the residuals of view m """
+        self.residuals[m].updateW(k, w)
+
+    def tauDotW(self, m, A):
+        """ Method to compute tau·A for the residuals of view m and a (D,K) matrix A of the shard """
+        return self.residuals[m].tauDotW(A)
+
+    def dotW(self, m, k):
+        """ Method to project the residuals of view m on the weights of factor k """
+        return self.residuals[m].dotW(k)
+
+    def updateZ(self, m, k, z):
+        """ Method to replace the values of factor k in the residuals of view m """
+        self.residuals[m].updateZ(k, z)
+
+    def releaseResiduals(self):
+        """ Method to release the residuals once W (or Z) has been updated """
+        self.residuals = {}
+
+    def observations(self, m):
+        """ Method to get the number of observations of view m per group and feature (G,D) """
+        return self.nodes["Y"].getNodes()[m].n_obs
+
+    def groupSums(self, m):
+        """ Method to compute the sums of the observations of view m per group and feature (G,D), None if it is not sparse """
+        stats = self.nodes["Y"].getNodes()[m].stats
+        if stats is None or not stats.sparse:
+            return None
+        return s.array([ np.asarray(stats.Y[idx,:].sum(axis=0)).flatten() for idx in stats.samples ])
+
+    def residualSumSquares(self, m, total):
+        """ Method to compute the residual sums of squares of view m in the shard (see BayesNet.residual_sum_squares) """
+        return self.residual_sum_squares(m, total)
+
+    def sumSquaredErrors(self, m):
+        """ Method to compute the expected sum of squared errors of view m per group and feature (G,D) """
+        Y = self.nodes["Y"].getNodes()[m]
+        Z = self.nodes["Z"].getExpectations()
+        W = self.nodes["W"].getNodes()[m].getExpectations()
+        if Y.stats is not None:
+            return Y.stats.sumSquaredErrors(Z["E"], Z["E2"], W["E"], W["E2"])
+        Yv = Y.getExpectation()
+        ZW = s.dot(Z["E"], W["E"].T)
+        tmp = s.square(Yv) + s.dot(Z["E2"], W["E2"].T) - s.dot(s.square(Z["E"]), s.square(W["E"].T)) + s.square(ZW) - 2*ZW*Yv
+        tmp[Y.getMask()] = 0.
+        return group_sum(tmp, Y.group_idx)
+
+    def removeFactors(self, drop):
+        """ Method to drop the factors dropped by the coordinator """
+        for node in self.nodes.values():
+            node.removeFactors(drop)
+        self.dim['K'] -= len(drop)
+
+    def step(self, i, ro, params, sparsity):
+        """ Method to train the shard on one mini-batch, given the global nodes of the coordinator
+
+        PARAMETERS
+        ----------
+        i: number of the mini-batch
+        ro: step size of the iteration
+        params: parameters of the global nodes
+        sparsity: whether to update ThetaW and ThetaZ
+        """
+        for name, p in params.items():
+            set_parameters(self.nodes[name], p)
+
+        ix, epoch = self.sample_mini_batch_no_replace(i)
+        missing = s.bincount(self.groups[ix], minlength=len(self.n_per_group)) == 0
+
+        targets = {}
+        for node in self.options['schedule']:
+            if (node=="ThetaW" or node=="ThetaZ") and not sparsity:
+                continue
+            if node in STOCHASTIC_NODES:
+                # update with a step size of one, and take the step locally as the coordinator will
+                previous = get_parameters(self.nodes[node])
+                self.nodes[node].updateParameters(ix, 1.)
+                targets[node] = get_parameters(self.nodes[node])
+                if node == "Tau":
+                    # the groups missing from the mini-batch are not updated
+                    for p, t in zip(previous, targets[node]):
+                        if t is None: continue
+                        t['a'][missing,:] = p['a'][missing,:]
+                        t['b'][missing,:] = p['b'][missing,:]
+                set_parameters(self.nodes[node], blend(previous, targets[node], ro))
+            else:
+                self.nodes[node].update(ix, ro)
+
+        Z = self.nodes["Z"].Q.getParameters()
+        return ix, { k:v[ix] for k,v in Z.items() }, targets
+
+
+def _train_shard(w, conn, build, state, specs, rows, n_per_group, init, seed, n_workers):
+    """ Method to train the model of a shard in a worker process, on the parameters of the global nodes sent by the
+    coordinator (None to stop) """
+    blocks, data = shared_data.attach(specs)
+    model = None
+    try:
+        with parallel.blas_limits(max(1, (os.cpu_count() or 1) // n_workers)), open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            # the model uses the data of the shard in the shared memory
+            model = build(state, data, rows, n_per_group, init['K'])
+            model.precompute()
+            model.setOffsets(init['offsets'])
+            model.setLocalParameters(init['nodes'])
+            s.random.seed(seed)
+
+            i = 0
+            while True:
+                msg = conn.recv()
+                if msg is None: break
+                version, ro, params, sparsity = msg
+                i += 1
+                ix, Z, targets = model.step(i, ro, params, sparsity)
+                conn.send((version, rows[ix], Z, targets))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        # the arrays backed by the shared memory have to be released before detaching from it
+        model = data = None
+        gc.collect()
+        shared_data.release(blocks)
+        conn.close()
+
+
+class WorkerPool(object):
+    """ Worker processes of an asynchronous training, with the clocks (number of pushes) that bound their staleness """
+    def __init__(self, model, n_workers, staleness):
+        """
+        PARAMETERS
+        ----------
+        model: AsyncStochasticBayesNet of the coordinator, with the shards set up (see AsyncStochasticBayesNet.setShards)
+        n_workers: number of worker processes
+        staleness: maximum number of pushes of a worker ahead of the slowest worker
+        """
+        build, state, specs = model.shards
+        self.staleness = staleness
+        self.conns, self.processes = [], []
+        for w, (rows, _) in enumerate(model.splitShards(n_workers)):
+            init = { 'K':model.dim['K'], 'nodes':model.localParameters(rows), 'offsets':get_offsets(model) }
+            conn, child = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_train_shard, args=(w, child, build, state, specs[w], rows, model.n_per_group, init,
+                model.options['seed']+w+1, n_workers), daemon=True)
+            p.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(p)
+
+        self.clocks = s.zeros(n_workers, dtype=int)
+        self.versions = s.zeros(n_workers, dtype=int)
+        self.busy = set()
+        self.waiting = set(range(n_workers))
+
+    def send(self, w, version, ro, params, sparsity):
+        """ Method to send the parameters of the global nodes to a worker """
+        self.conns[w].send((version, ro, params, sparsity))
+        self.versions[w] = version
+        self.waiting.discard(w)
+        self.busy.add(w)
+
+    def receive(self):
+        """ Method to wait for the next push of a worker """
+        ready = wait([ self.conns[w] for w in self.busy ])
+        w = min([ self.conns.index(c) for c in ready ])
+        try:
+            msg = self.conns[w].recv()
+        except EOFError:
+            msg = ("error", "the process exited")
+        self.busy.remove(w)
+        if msg[0] == "error":
+            raise RuntimeError("Worker %d failed\n%s" % (w, msg[1]))
+        self.waiting.add(w)
+        self.clocks[w] += 1
+        return w, msg[0], msg[1:]
+
+    def ready(self):
+        """ Method to get the waiting workers that are not too far ahead of the slowest worker """
+        return sorted([ w for w in self.waiting if self.clocks[w] - self.clocks.min() <= self.staleness ])
+
+    def close(self):
+        """ Method to stop the workers (the pushes in progress are discarded) """
+        for w in list(self.busy):
+            try:
+                self.conns[w].recv()
+            except EOFError:
+                pass
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for p in self.processes:
+            p.join()
+
+
+class AsyncStochasticBayesNet(StochasticBayesNet):
+    """ Bayesian network trained with stochastic variational inference by several worker processes (see the module) """
+    def __init__(self, dim, nodes):
+        super().__init__(dim=dim, nodes=nodes)
+
+        # Function building the model of a shard, state of the entry point and description of the shared data
+        self.shards = None
+
+    def setShards(self, build=None, state=None, specs=None):
+        """ Method to set how the workers build the models of their shards
+
+        PARAMETERS
+        ----------
+        build: function building the model of a shard (a ShardBayesNet)
+        state: state of the entry point
+        specs: description of the data of each shard in shared memory (see shared_data.share_shards)
+        """
+        self.shards = None if build is None else (build, state, specs)
+
+    def splitShards(self, n_workers):
+        """ Method to split the samples into shards, returns the samples of each shard (and None for all the features) """
+        return [ (rows, None) for rows in shard_samples(self.groups, n_workers) ]
+
+    def localParameters(self, rows):
+        """ Method to get the parameters of the local nodes (Z, AlphaZ and ThetaZ) for the samples of a shard """
+        params = { n:get_parameters(self.nodes[n]) for n in ("AlphaZ", "ThetaZ") if n in self.nodes }
+        params["Z"] = [ { k:v[rows] for k,v in p.items() } for p in get_parameters(self.nodes["Z"], copy=False) ]
+        return params
+
+    def globalParameters(self):
+        """ Method to get the parameters of the global nodes sent to the workers """
+        return { n:get_parameters(self.nodes[n], copy=False) for n in STOCHASTIC_NODES + W_NODES if n in self.nodes }
+
+    def applyUpdate(self, ix, Z, targets, ro, sparsity):
+        """ Method to apply the push of a worker
+
+        PARAMETERS
+        ----------
+        ix: samples of the mini-batch
+        Z: parameters of the factors of the mini-batch
+        targets: targets of the global nodes
+        ro: step size
+        sparsity: whether to update ThetaW
+        """
+        for name, t in targets.items():
+            set_parameters(self.nodes[name], blend(get_parameters(self.nodes[name], copy=False), t, ro))
+        Q = self.nodes["Z"].Q.getParameters()
+        for k in Z:
+            Q[k][ix] = Z[k]
+        for node in W_NODES:
+            if node in self.nodes and (node != "ThetaW" or sparsity):
+                self.nodes[node].update()
+
+    def gatherLocalNodes(self, sparsity):
+        """ Method to update the nodes of all samples that depend on the factors gathered from the workers """
+        self.nodes["Z"].updateExpectations()
+        for node in ("AlphaZ", "ThetaZ"):
+            if node in self.nodes and (node != "ThetaZ" or sparsity):
+                self.nodes[node].update()
+        for y, tau in zip(self.nodes["Y"].getNodes(), self.nodes["Tau"].getNodes()):
+            if not isinstance(tau, TauD_Node):
+                y.update()
+                tau.update()
+
+    def iterate(self):
+        """Method to start iterating and updating the variables, applying the pushes of the workers"""
+
+        # Define some variables to monitor training
+        nodes = list(self.getVariationalNodes().keys())
+        elbo = pd.DataFrame(data = nans((self.options['maxiter']+1, len(nodes)+1 )), columns = nodes+["total"] )
+        number_factors = nans((self.options['maxiter']+1))
+        iter_time = nans((self.options['maxiter']+1))
+
+        # Precompute (or restore the training loop from a checkpoint, the workers start from the state of the coordinator)
+        converged = False; convergence_token = 1; start = 1
+        if self.state is None:
+            elbo.iloc[0] = self.precompute()
+            number_factors[0] = self.dim['K']
+            iter_time[0] = 0.
+            iter_count = 0
+        else:
+            state = self.restoreState()
+            start, elbo, number_factors, iter_time, convergence_token, iter_count = state['i'], state['elbo'], state['number_factors'], state['iter_time'], state['convergence_token'], state['iter_count']
+        t_checkpoint = time()
+        n_batches = math.ceil(1./self.options['batch_size']) * self.options['n_workers']
+
+        # Print stochastic settings before training
+        print("Using asynchronous stochastic variational inference with the following parameters:")
+        print("- Batch size (fraction of the samples of each worker): %.2f\n- Forgetting rate: %.2f\n- Learning rate: %.2f\n- Starts at iteration: %d \n- Workers: %d\n- Staleness: %d\n" %
+            (100*self.options['batch_size'], self.options['forgetting_rate'], self.options['learning_rate'], self.options['start_stochastic'], self.options['n_workers'], self.options['staleness']) )
+        if self.options['drop']["min_r2"] is not None:
+            print("Warning: factors are only dropped before the workers start (at iteration %d)\n" % self.options['start_stochastic'])
+
+        pool = None
+        try:
+            for i in range(start, self.options['maxiter']):
+                t = time();
+                sparsity = i>=self.options['start_sparsity']
+
+                if i<self.options["start_stochastic"]:
+                    # Remove inactive factors
+                    if (i>=self.options["start_drop"]) and (i%self.options['freq_drop']) == 0:
+                        if self.options['drop']["min_r2"] is not None:
+                            self.removeInactiveFactors(**self.options['drop'])
+                        number_factors[i] = self.dim["K"]
+
+                    # Full-batch iteration of the coordinator
+                    for node in self.options['schedule']:
+                        if (node=="ThetaW" or node=="ThetaZ") and not sparsity:
+                            continue
+                        self.nodes[node].update()
+                    ro = 1.
+                else:
+                    if pool is None:
+                        pool = WorkerPool(self, self.options['n_workers'], self.options['staleness'])
+
+                    # Send the current parameters to the workers that can go on
+                    for v in pool.ready():
+                        pool.send(v, i, self.step_size2(int((i-self.options["start_stochastic"])/n_batches)), self.globalParameters(), sparsity)
+
+                    # Apply the next push
+                    w, version, (ix, Z, targets) = pool.receive()
+                    ro = self.step_size2(int((i-self.options["start_stochastic"])/n_batches))
+                    self.applyUpdate(ix, Z, targets, ro, sparsity)
+                    number_factors[i] = self.dim["K"]
+
+                # Calculate Evidence Lower Bound
+                if (i>=self.options["start_elbo"]) and ((i-self.options["start_elbo"])%self.options['freqELBO']==0):
+                    if pool is not None: self.gatherLocalNodes(sparsity)
+                    elbo.iloc[i] = self.calculateELBO()
+                    delta_elbo = elbo.iloc[i]["total"] - elbo.iloc[:i]["total"].dropna().iloc[-1]
+
+                    # Print ELBO monitoring
+                    print("Iteration %d: time=%.2f, ELBO=%.2f, deltaELBO=%.3f (%.9f%%), Factors=%d" % (i, time()-t, elbo.iloc[i]["total"], delta_elbo, 100*abs(delta_elbo/elbo.iloc[0]["total"]), (self.dim['K'])))
+
+                    # Report the ELBO (e.g. to the process running several restarts), which can stop the training
+                    if self.callback is not None and self.callback(i, elbo.iloc[i]["total"]):
+                        number_factors = number_factors[:i]
+                        elbo = elbo[:i]
+                        iter_time = iter_time[:i]
+                        print("\nTraining stopped\n"); break
+
+                    # Assess convergence
+                    if i>self.options["start_elbo"] and not self.options['forceiter']:
+                        convergence_token, converged = self.assess_convergence(delta_elbo, elbo.iloc[0]["total"], convergence_token)
+                        if converged:
+                            number_factors = number_factors[:i]
+                            elbo = elbo[:i]
+                            iter_time = iter_time[:i]
+                            print ("\nConverged!\n"); break
+
+                # Do not calculate lower bound
+                else:
+                    print("Iteration %d: time=%.2f, Factors=%d" % (i,time()-t,self.dim["K"]))
+
+                # Print other statistics
+                if pool is not None:
+                    print("- Step size: %.3f, worker: %d, staleness: %d" % (ro, w, i-version))
+
+                if self.options['verbose']:
+                    if pool is not None: self.gatherLocalNodes(sparsity)
+                    self.print_verbose_message()
+
+                iter_time[i] = time()-t
+                iter_count += 1
+
+                # Save the training state
+                t_checkpoint = self.checkpoint(i, t_checkpoint, elbo=elbo, number_factors=number_factors, iter_time=iter_time, convergence_token=convergence_token, iter_count=iter_count)
+
+                # Flush (we need this to print when running on the cluster)
+                sys.stdout.flush()
+        finally:
+            # Stop the workers
+            if pool is not None:
+                pool.close()
+
+        if iter_count+1 == self.options['maxiter']:
+            print("\nMaximum number of iterations reached: {}\n".format(self.options['maxiter']))
+
+        # Gather the factors of the workers
+        if pool is not None:
+            self.gatherLocalNodes(self.options['maxiter']>self.options['start_sparsity'])
+
+        # Release the products E[Z]E[W]^T
+        self.cache.clear()
+
+        # Finish by collecting the training statistics
+        self.train_stats = { 'time':iter_time, 'number_factors':number_factors, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1) }
+        self.trained = True
+
+
+def _serve_shard(conn, build, state, specs, shard, n_per_group, init, n_workers):
+    """ Method to hold the model of a shard in a worker process, running the methods called by the coordinator (None to stop) """
+    blocks, data = shared_data.attach(specs)
+    model = None
+    try:
+        with parallel.blas_limits(max(1, (os.cpu_count() or 1) // n_workers)), open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            # the model uses the data of the shard in the shared memory
+            model = build(state, data, shard[0], n_per_group, init['K'], shard[1])
+            model.precompute()
+            model.setLocalParameters(init['nodes'])
+
+            while True:
+                msg = conn.recv()
+                if msg is None: break
+                method, args, reply = msg
+                out = getattr(model, method)(*args)
+                if reply: conn.send(("ok", out))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        # the arrays backed by the shared memory have to be released before detaching from it
+        model = data = None
+        gc.collect()
+        shared_data.release(blocks)
+        conn.close()
+
+
+class ShardWorkers(object):
+    """ Worker processes holding the shards of a DistributedBayesNet, which run the same method in lockstep """
+    def __init__(self, model, n_workers):
+        """
+        PARAMETERS
+        ----------
+        model: DistributedBayesNet of the coordinator, with the shards set up (see DistributedBayesNet.setShards)
+        n_workers: number of worker processes
+        """
+        build, state, specs = model.shards
+        self.shards = model.splitShards(n_workers)
+        # the views can be updated in concurrent threads
+        self.lock = threading.Lock()
+        self.conns, self.processes = [], []
+        for shard, spec in zip(self.shards, specs):
+            init = { 'K':model.dim['K'], 'nodes':model.shardParameters(shard) }
+            conn, child = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_serve_shard, args=(child, build, state, spec, shard, model.n_per_group, init, n_workers), daemon=True)
+            p.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(p)
+
+    def fail(self, w, msg=None):
+        """ Method to raise the error of a worker (received from the worker if not given) """
+        if msg is None:
+            try:
+                msg = self.conns[w].recv()
+            except EOFError:
+                msg = ("error", "the process exited")
+        raise RuntimeError("Worker %d failed\n%s" % (w, msg[1]))
+
+    def send(self, method, args, reply):
+        """ Method to send a call to every worker, with the arguments of each worker """
+        for w, conn in enumerate(self.conns):
+            try:
+                conn.send((method, args[w], reply))
+            except (BrokenPipeError, OSError):
+                self.fail(w)
+
+    def post(self, method, *args):
+        """ Method to call a method of the model of every worker, without waiting """
+        with self.lock:
+            self.send(method, [args] * len(self.conns), False)
+
+    def call(self, method, *args, each=None):
+        """ Method to call a method of the model of every worker and return the outputs (each: arguments of each worker) """
+        with self.lock:
+            self.send(method, each if each is not None else [args] * len(self.conns), True)
+            out = []
+            for w, conn in enumerate(self.conns):
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    msg = ("error", "the process exited")
+                if msg[0] == "error":
+                    self.fail(w, msg)
+                out.append(msg[1])
+            return out
+
+    def reduce(self, method, *args, each=None):
+        """ Method to sum the outputs of a method over the workers (always in the same order, element-wise for tuples) """
+        out = self.call(method, *args, each=each)
+        total = out[0]
+        for x in out[1:]:
+            total = tuple( a + b for a, b in zip(total, x) ) if isinstance(total, tuple) else total + x
+        return total
+
+    def concatenate(self, method, *args, axis=0):
+        """ Method to concatenate the outputs of a method over the workers holding shards of features """
+        return s.concatenate(self.call(method, *args), axis=axis)
+
+    def close(self):
+        """ Method to stop the workers """
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for p in self.processes:
+            p.join()
+
+
+class ShardedResiduals(object):
+    """ Tau-weighted residuals of a view split over the shards of the workers (see residuals.Residuals) """
+    def __init__(self, workers, m):
+        self.workers = workers
+        self.m = m
+        self.workers.call("buildResiduals", m)
+
+    def tauDotW(self, A):
+        """ Method to compute tau·A for a (D,K) matrix A, (N,K) """
+        return self.workers.reduce("tauDotW", each=[ (self.m, A[cols[self.m],:]) for _, cols in self.workers.shards ])
+
+    def tauDotZ(self, A):
+        """ Method to compute tau^T·A for a (N,K) matrix A, (D,K) """
+        return self.workers.reduce("tauDotZ", each=[ (self.m, A[rows,:]) for rows, _ in self.workers.shards ])
+
+    def dotW(self, k):
+        """ Method to project the residuals on the weights of factor k, tauR·W[:,k] (N,) """
+        return self.workers.reduce("dotW", self.m, k)
+
+    def dotZ(self, k):
+        """ Method to project the residuals on the values of factor k, Z[:,k]·tauR (D,) """
+        return self.workers.reduce("dotZ", self.m, k)
+
+    def updateZ(self, k, z):
+        """ Method to replace the values of factor k """
+        self.workers.post("updateZ", self.m, k, z)
+
+    def updateW(self, k, w):
+        """ Method to replace the weights of factor k """
+        self.workers.post("updateW", self.m, k, w)
+
+
+class ShardedStatistics(object):
+    """ Statistics of a view split over the shards of the workers, used by the coordinator instead of the data
+
+    PARAMETERS
+    ----------
+    workers: ShardWorkers
+    m: view
+    n_obs: ndarray (G,D)
+        number of observations per group and feature
+    """
+    def __init__(self, workers, m, n_obs):
+        self.workers = workers
+        self.m = m
+        self.n_obs = n_obs
+
+    def residuals(self):
+        """ Method to build the residuals of the view (the workers use the expectations of their nodes) """
+        return ShardedResiduals(self.workers, self.m)
+
+    def sumSquaredErrors(self, Z, ZZ, W, WW):
+        """ Method to compute the expected sum of squared errors per group and feature (from the nodes of the workers) """
+        if self.workers.shards[0][1] is not None:
+            return self.workers.concatenate("sumSquaredErrors", self.m, axis=1)
+        return self.workers.reduce("sumSquaredErrors", self.m)
+
+
+class DistributedBayesNet(BayesNet):
+    """ Bayesian network trained with full-batch variational inference by several worker processes (see the module) """
+    def __init__(self, dim, nodes):
+        super().__init__(dim=dim, nodes=nodes)
+
+        # Function building the model of a shard, state of the entry point and description of the shared data
+        self.shards = None
+
+        # Worker processes, started with the training
+        self.workers = None
+
+        # Group of each sample, used to split the samples into shards
+        groups = [ self.nodes[n] for n in ("AlphaZ", "ThetaZ") if n in self.nodes ] + list(self.nodes["Tau"].getNodes())
+        groups = [ node.groups for node in groups if hasattr(node, "groups") ]
+        self.groups = groups[0] if len(groups) > 0 else s.zeros(self.dim['N'], dtype=int)
+        self.n_per_group = s.bincount(self.groups, minlength=self.dim['G'])
+
+    def __getstate__(self):
+        # the worker processes are not saved with the model (e.g. in the checkpoints)
+        state = super().__getstate__()
+        state['workers'] = None
+        return state
+
+    def setShards(self, build=None, state=None, specs=None):
+        """ Method to set how the workers build the models of their shards (see AsyncStochasticBayesNet.setShards) """
+        self.shards = None if build is None else (build, state, specs)
+
+    def setData(self, data, masks=None):
+        """ Method to bind the data to the Y nodes, precomputed only once the model is trained (see BayesNet.setData) """
+        if masks is None: masks = [None] * len(data)
+        for node, y, mask in zip(self.nodes["Y"].getNodes(), data, masks):
+            node.setData(y, self.options if self.trained else None, mask)
+
+    def releaseData(self):
+        """ Method to release the data of the views once it is shared with the workers """
+        for view in self.nodes["Y"].getNodes():
+            view.value, view.mask, view.stats = None, None, None
+
+    def splitShards(self, n_workers):
+        """ Method to split the samples into shards, returns the samples of each shard (and None for all the features) """
+        return [ (rows, None) for rows in shard_samples(self.groups, n_workers) ]
+
+    def shardParameters(self, shard):
+        """ Method to get the parameters of the nodes for the samples of a shard """
+        params = { n:get_parameters(self.nodes[n]) for n in self.nodes if n not in ("Y", "Z") }
+        params["Z"] = [ { k:v[shard[0]] for k,v in p.items() } for p in get_parameters(self.nodes["Z"], copy=False) ]
+        return params
+
+    def startWorkers(self):
+        """ Method to start the workers and replace the data of the views with the statistics of the workers """
+        self.workers = ShardWorkers(self, self.options['n_workers'])
+        features = self.workers.shards[0][1] is not None
+        offsets = []
+        for m, view in enumerate(self.nodes["Y"].getNodes()):
+            if features:
+                n_obs = self.workers.concatenate("observations", m, axis=1)
+                offsets.append(None)
+            else:
+                n_obs = self.workers.reduce("observations", m)
+                # the sparse views are centered with the means of the groups in all the shards
+                sums = self.workers.call("groupSums", m)
+                offsets.append(None if sums[0] is None else s.sum(sums, axis=0) / self.n_per_group[:,None])
+            view.setStatistics(ShardedStatistics(self.workers, m, n_obs), self.options)
+        if any([ x is not None for x in offsets ]):
+            self.workers.post("setOffsets", offsets)
+
+    def gatherFactors(self):
+        """ Method to update the factors in the workers and gather them """
+        Q = self.nodes["Z"].Q.getParameters()
+        for (rows, _), params in zip(self.workers.shards, self.workers.call("updateFactors")):
+            for k in params:
+                Q[k][rows] = params[k]
+        self.nodes["Z"].updateExpectations()
+
+    def updateNodes(self, i):
+        """ Method to update the nodes in the order of the schedule (iteration i), the factors are updated by the workers """
+        for node in self.options['schedule']:
+            if (node=="ThetaW" or node=="ThetaZ") and i<self.options['start_sparsity']:
+                continue
+            if node == "Z":
+                self.gatherFactors()
+            else:
+                self.nodes[node].update()
+                # the observations of the workers are constant
+                if node == "Y": continue
+                self.workers.post("setLocalParameters", { node:get_parameters(self.nodes[node], copy=False) })
+                if node == "W":
+                    self.workers.post("releaseResiduals")
+
+    def removeInactiveFactors(self, min_r2=None, drop_all=False):
+        """ Method to remove inactive factors (see BayesNet.removeInactiveFactors), in the workers too """
+        drop = super().removeInactiveFactors(min_r2, drop_all)
+        if self.workers is not None and len(drop) > 0:
+            self.workers.post("removeFactors", drop)
+        return drop
+
+    def residual_sum_squares(self, m, total=False):
+        """ Method to calculate the residual sums of squares of view m, reduced over the workers during the training """
+        if self.workers is None:
+            return super().residual_sum_squares(m, total)
+        return self.workers.reduce("residualSumSquares", m, total)
+
+    def iterate(self):
+        """ Method to start the workers, iterate updating the variables using the VB algorithm, and stop the workers """
+        try:
+            self.startWorkers()
+            super().iterate()
+        finally:
+            if self.workers is not None:
+                self.workers.close()
+                self.workers = None
+
+
+class FeatureShardedBayesNet(DistributedBayesNet):
+    """ Bayesian network trained with full-batch variational inference by several worker processes, each holding a
+    shard of the features of every view (see the module) """
+    def splitShards(self, n_workers):
+        """ Method to split the features of every view into shards, returns all the samples and the features of each shard """
+        bounds = [ s.linspace(0, D, n_workers+1).astype(int) for D in self.dim['D'] ]
+        rows = s.arange(self.dim['N'])
+        return [ (rows, [ slice(b[w], b[w+1]) for b in bounds ]) for w in range(n_workers) ]
+
+    def shardParameters(self, shard):
+        """ Method to get the parameters of the nodes for the features of a shard """
+        params = { n:get_parameters(self.nodes[n]) for n in self.nodes if n not in ("Y", "W", "Tau") }
+        params["W"] = [ { k:v[c,:] for k,v in p.items() } for p, c in zip(get_parameters(self.nodes["W"]), shard[1]) ]
+        params["Tau"] = [ { k:v[:,c] for k,v in p.items() } for p, c in zip(get_parameters(self.nodes["Tau"]), shard[1]) ]
+        return params
+
+    def gatherNode(self, node, method, axis):
+        """ Method to update a node split over the features in the workers and gather it """
+        out = self.workers.call(method)
+        params = [ { k:s.concatenate([ x[m][k] for x in out ], axis=axis) for k in out[0][m] } for m in range(len(out[0])) ]
+        set_parameters(self.nodes[node], params)
+
+    def updateNodes(self, i):
+        """ Method to update the nodes in the order of the schedule (iteration i), W and Tau are updated by the workers """
+        for node in self.options['schedule']:
+            if (node=="ThetaW" or node=="ThetaZ") and i<self.options['start_sparsity']:
+                continue
+            if node == "W":
+                self.gatherNode("W", "updateWeights", 0)
+            elif node == "Tau":
+                self.gatherNode("Tau", "updateNoise", 1)
+            else:
+                self.nodes[node].update()
+                # the observations of the workers are constant
+                if node == "Y": continue
+                self.workers.post("setLocalParameters", { node:get_parameters(self.nodes[node], copy=False) })
+                if node == "Z":
+                    self.workers.post("releaseResiduals")
@@ -14,9 +14,44 @@ TO-DO:
 """
 
 import scipy as s
+import numpy as np
 
 from mofapy2.core.utils import *  # TODO prob not necessary ?
 
+def removeElements(x, idx, axis, memo=None):
+    """ Function to remove elements along an axis of an array without allocating a new one
+
+    The remaining elements are moved to the front of the array in place, and a view on them is returned. The original
+    array keeps its capacity. Arrays that are shared between several parameters or expectations are only moved once,
+    'memo' keeps track of the arrays that have been moved within one removal.
+
+    PARAMETERS
+    ----------
+    x: numpy array
+    idx: list or numpy array
+        indices of the elements to remove
+    axis: int
+    memo: dict
+    """
+    if not isinstance(x, np.ndarray) or not x.flags.writeable:
+        return np.delete(x, idx, axis)
+    if memo is None: memo = {}
+    key = (x.__array_interface__['data'][0], x.shape, x.strides)
+    if key in memo:
+        return memo[key]
+    if any(np.may_share_memory(x, y) for y in memo.values()):
+        return np.delete(x, idx, axis)
+
+    keep = np.setdiff1d(np.arange(x.shape[axis]), idx)
+    src, dst = [slice(None)]*x.ndim, [slice(None)]*x.ndim
+    for j, k in enumerate(keep):
+        if j != k:
+            src[axis], dst[axis] = k, j
+            x[tuple(dst)] = x[tuple(src)]
+    dst[axis] = slice(0, len(keep))
+    memo[key] = x[tuple(dst)]
+    return memo[key]
+
 # General class for probability distributions
 class Distribution(object):
     """ General class for a statistical distribution """
@@ -63,7 +98,17 @@ class Distribution(object):
         assert len(e_dim) == 1, "Expectations have different dimensionalities"
         # assert e_dim == p_dim, "Parameters and Expectations have different dimensionality"
 
-    def removeDimensions(self, axis, idx):
+    def astype(self, dtype):
+        """ General method to cast the parameters and the expectations to a given floating point precision
+
+        PARAMETERS
+        ----------
+        dtype: numpy dtype
+        """
+        for k in self.params.keys(): self.params[k] = s.asarray(self.params[k], dtype=dtype)
+        for k in self.expectations.keys(): self.expectations[k] = s.asarray(self.expectations[k], dtype=dtype)
+
+    def removeDimensions(self, axis, idx, memo=None):
         """ General method to remove undesired dimensions
 
         PARAMETERS
@@ -72,11 +117,14 @@ class Distribution(object):
             axis from where to remove the elements
         idx: list or numpy array
             indices of the elements to remove
+        memo: dict
+            arrays already moved within the same removal (see removeElements)
         """
         assert axis <= len(self.dim)
         assert s.all(idx < self.dim[axis])
-        for k in self.params.keys(): self.params[k] = s.delete(self.params[k], idx, axis)
-        for k in self.expectations.keys(): self.expectations[k] = s.delete(self.expectations[k], idx, axis)
+        if memo is None: memo = {}
+        for k in self.params.keys(): self.params[k] = removeElements(self.params[k], idx, axis, memo)
+        for k in self.expectations.keys(): self.expectations[k] = removeElements(self.expectations[k], idx, axis, memo)
         self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
 
     def updateDim(self, axis, new_dim):
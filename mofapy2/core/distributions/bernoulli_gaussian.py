@@ -1,5 +1,5 @@
 import scipy as s
-from .basic_distributions import Distribution
+from .basic_distributions import Distribution, removeElements
 from .bernoulli import Bernoulli
 from .univariate_gaussian import UnivariateGaussian
 
@@ -83,24 +83,35 @@ class BernoulliGaussian(Distribution):
         self.expectations = {'E': E, 'EB': EB, 'EN': EN, 'E2': E2, 'ENN': ENN}
         #self.expectations = {'E':E, 'EB':EB, 'EN':EN, 'E2':E2, 'ENN':ENN, 'EXXT':EXXT }
 
-    def removeDimensions(self, axis, idx):
+    def astype(self, dtype):
+        # Method to cast the constituent distributions to a given floating point precision
+        self.B.astype(dtype)
+        self.N_B0.astype(dtype)
+        self.N_B1.astype(dtype)
+        self.updateParameters()
+        Distribution.astype(self, dtype)
+
+    def removeDimensions(self, axis, idx, memo=None):
 
         # Method to remove undesired dimensions
         # - axis (int): axis from where to remove the elements
         # - idx (numpy array): indices of the elements to remove
+        # - memo (dict): arrays already moved within the same removal (see removeElements)
         assert axis <= len(self.dim)
         assert s.all(idx < self.dim[axis])
-        self.B.removeDimensions(axis,idx)
-        self.N_B0.removeDimensions(axis,idx)
-        self.N_B1.removeDimensions(axis,idx)
+        if memo is None: memo = {}
+        self.B.removeDimensions(axis,idx,memo)
+        self.N_B0.removeDimensions(axis,idx,memo)
+        self.N_B1.removeDimensions(axis,idx,memo)
 
         # TODO : check this add
         dim = list(self.dim)
         dim[1] -= len(idx)
         self.dim = tuple(dim)
 
+        # The expectations of the joint distribution are elementwise, they are moved instead of recomputed
         self.updateParameters()
-        self.updateExpectations()
+        for k in self.expectations.keys(): self.expectations[k] = removeElements(self.expectations[k], idx, axis, memo)
 
     def updateDim(self, axis, new_dim):
         # Function to update the dimensionality of a particular axis
@@ -1,7 +1,7 @@
 import scipy as s
 import numpy.linalg as linalg
 import scipy.stats as stats
-from .basic_distributions import Distribution
+from .basic_distributions import Distribution, removeElements
 
 from mofapy2.core.utils import *
 
@@ -132,15 +132,17 @@ class MultivariateGaussian(Distribution):
 
         return l
 
-    def removeDimensions(self, axis, idx):
+    def removeDimensions(self, axis, idx, memo=None):
         # Method to remove undesired dimensions
         # - axis (int): axis from where to remove the elements
         # - idx (numpy array): indices of the elements to remove
+        # - memo (dict): arrays already moved within the same removal (see removeElements)
         assert axis <= len(self.dim)
         assert s.all(idx < self.dim[axis])
+        if memo is None: memo = {}
 
-        self.params["mean"] = s.delete(self.params["mean"], axis=axis, obj=idx)
-        self.expectations["E"] = s.delete(self.expectations["E"], axis=axis, obj=idx)
+        self.params["mean"] = removeElements(self.params["mean"], idx, axis, memo)
+        self.expectations["E"] = removeElements(self.expectations["E"], idx, axis, memo)
         #self.expectations["E2"] = s.delete(self.expectations["E2"], axis=axis, obj=idx)
 
         if self.axis_cov == 1: #cov has shape (a,b,b) when mean has shape (a,b)
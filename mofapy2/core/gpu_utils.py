@@ -47,6 +47,13 @@ def dot(mat1, mat2):
         return np.dot(mat1, mat2)
 
 
+def outer(vec1, vec2):
+    if gpu_mode:
+        return cp.outer(vec1, vec2)
+    else:
+        return np.outer(vec1, vec2)
+
+
 def divide(mat1, mat2):
     if gpu_mode:
         return cp.divide(mat1, mat2)
@@ -5,6 +5,8 @@ import numpy as np
 import scipy as s
 import scipy.special as special
 
+from mofapy2.core.utils import group_slices, group_counts, group_sum
+
 # Import manually defined functions
 from .variational_nodes import Gamma_Unobserved_Variational_Node
 
@@ -19,9 +21,10 @@ class AlphaW_Node(Gamma_Unobserved_Variational_Node):
     def getExpectations(self, expand=False):
         QExp = self.Q.getExpectations()
         if expand:
+            # read-only broadcast views of shape (D,K)
             D = self.markov_blanket['W'].dim[0]
-            expanded_E = s.repeat(QExp['E'][None, :], D, axis=0)
-            expanded_lnE = s.repeat(QExp['lnE'][None, :], D, axis=0)
+            expanded_E = np.broadcast_to(QExp['E'], (D,) + QExp['E'].shape)
+            expanded_lnE = np.broadcast_to(QExp['lnE'], (D,) + QExp['lnE'].shape)
             return {'E': expanded_E, 'lnE': expanded_lnE}
         else:
             return QExp
@@ -94,14 +97,14 @@ class AlphaZ_Node(Gamma_Unobserved_Variational_Node):
         # Define axis of factors (to drop them)
         self.factors_axis = 1
 
-        self.n_per_group = np.zeros(self.n_groups)
-        for c in range(self.n_groups):
-            self.n_per_group[c] = (self.groups == c).sum()
+        # Samples of each group (slices if the groups are contiguous)
+        self.group_idx = group_slices(self.groups, self.n_groups)
+        self.n_per_group = group_counts(self.group_idx).astype(float)
 
     def getExpectations(self, expand=False):
         QExp = self.Q.getExpectations()
         if expand:
-            return {'E': QExp['E'][self.groups, :], 'lnE': QExp['lnE'][self.groups, :] }
+            return {'E': self.expandGroups('E', QExp['E']), 'lnE': self.expandGroups('lnE', QExp['lnE']) }
         else:
             return {'E': QExp['E'], 'lnE': QExp['lnE']}
 
@@ -137,32 +140,32 @@ class AlphaZ_Node(Gamma_Unobserved_Variational_Node):
 
         # subset mini-batch
         if ix is None:
-            groups = self.groups
+            idx = self.group_idx
         else:
-            groups = self.groups[ix]
+            idx = group_slices(self.groups[ix], self.n_groups)
 
         # compute the updated parameters
-        self._updateParameters(Pa, Pb, ZZ, groups, ro)
+        self._updateParameters(Pa, Pb, ZZ, idx, ro)
 
         # self.Q.setParameters(a=Qa, b=Qb)
 
-    def _updateParameters(self, Pa, Pb, ZZ, groups, ro):
+    def _updateParameters(self, Pa, Pb, ZZ, idx, ro):
         """ Hidden method to compute parameter updates """
 
         Q = self.Q.getParameters()
         Q['a'] *= (1-ro)
         Q['b'] *= (1-ro)
 
+        n_batch = group_counts(idx)
+        ZZ_sum = group_sum(ZZ, idx)
         for c in range(self.n_groups):
-            mask = (groups == c)
 
             # Compute anti-bias coefficient for stochastic inference
-            n_batch = mask.sum()
-            if n_batch == 0: continue
-            coeff = self.n_per_group[c]/n_batch
+            if n_batch[c] == 0: continue
+            coeff = self.n_per_group[c]/n_batch[c]
 
             Q['a'][c,:] += ro * (Pa[c,:] + 0.5 * self.n_per_group[c])  # TODO should be precomputed
-            Q['b'][c,:] += ro * (Pb[c,:] + 0.5 * coeff * ZZ[mask,:].sum(axis=0))
+            Q['b'][c,:] += ro * (Pb[c,:] + 0.5 * coeff * ZZ_sum[c,:])
 
     def calculateELBO(self):
         """ Method to compute ELBO """
@@ -6,6 +6,7 @@ import scipy.special as special
 
 from mofapy2.core.utils import *
 from mofapy2.core import gpu_utils
+from mofapy2.core.product_cache import dotZW
 
 # Import manually defined functions
 from .variational_nodes import Gamma_Unobserved_Variational_Node
@@ -31,18 +32,19 @@ class TauD_Node(Gamma_Unobserved_Variational_Node):
         # Constant ELBO terms
         self.lbconst = s.sum(self.P.params['a']*s.log(self.P.params['b']) - special.gammaln(self.P.params['a']))
 
-        # compute number of samples per group
-        self.n_per_group = np.zeros(self.n_groups)
-        for c in range(self.n_groups):
-            self.n_per_group[c] = (self.groups == c).sum()
+        # compute number of samples per group (slices if the groups are contiguous)
+        self.group_idx = group_slices(self.groups, self.n_groups)
+        self.n_per_group = group_counts(self.group_idx).astype(float)
 
         self.mini_batch = None
+        self.buffers = {}
 
     def getExpectations(self, expand=True):
         QExp = self.Q.getExpectations()
         if expand:
-            expanded_E = QExp['E'][self.groups, :]
-            expanded_lnE = QExp['lnE'][self.groups, :]
+            # read-only expansions of shape (N,D)
+            expanded_E = self.expandGroups('E', QExp['E'])
+            expanded_lnE = self.expandGroups('lnE', QExp['lnE'])
             return {'E': expanded_E, 'lnE': expanded_lnE}
         else:
             return QExp
@@ -50,13 +52,13 @@ class TauD_Node(Gamma_Unobserved_Variational_Node):
     def getExpectation(self, expand=True):
         QExp = self.Q.getExpectation()
         if expand:
-            return QExp[self.groups,:]
+            return self.expandGroups('E', QExp)
         else:
-            return Qexp
+            return QExp
 
     def define_mini_batch(self, ix):
         """ Method to define minibatch for the expectation """
-        self.mini_batch = self.Q.getExpectation()[self.groups[ix],:]
+        self.mini_batch = take_rows(self.Q.getExpectation(), self.groups[ix], self.buffers, "E")
 
     def get_mini_batch(self):
         if self.mini_batch is None:
@@ -73,8 +75,6 @@ class TauD_Node(Gamma_Unobserved_Variational_Node):
         """
 
         # Get expectations from other nodes
-        Y = self.markov_blanket["Y"].get_mini_batch()
-        mask = self.markov_blanket["Y"].getMask()
         Wtmp = self.markov_blanket["W"].getExpectations()
         Ztmp = self.markov_blanket["Z"].get_mini_batch()
         W, WW = Wtmp["E"], Wtmp["E2"]
@@ -84,18 +84,28 @@ class TauD_Node(Gamma_Unobserved_Variational_Node):
         P = self.P.getParameters()
         Pa, Pb = P['a'], P['b']
 
-        # subset mini-batch
-        if ix is None:
-            groups = self.groups
+        # compute the updated parameters
+        stats = self.markov_blanket["Y"].stats if hasattr(self.markov_blanket["Y"], "stats") else None
+        if ix is None and stats is not None:
+            # full-batch update from the sufficient statistics of the data
+            Qa, Qb = self._updateParametersStats(stats, W, WW, Z, ZZ, Pa, Pb, ro)
         else:
-            groups = self.groups[ix]
+            Y = self.markov_blanket["Y"].get_mini_batch()
+            mask = self.markov_blanket["Y"].getMask()
 
-        # compute the updated parameters
-        Qa, Qb = self._updateParameters(Y, W, WW, Z, ZZ, Pa, Pb, mask, ro, groups)
+            # subset mini-batch (the product E[Z]E[W]^T is shared with the other nodes in full-batch mode)
+            if ix is None:
+                idx = self.group_idx
+                ZW = dotZW(self)
+            else:
+                idx = group_slices(self.groups[ix], self.n_groups)
+                ZW = gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(Z), gpu_utils.array(W).T))
+
+            Qa, Qb = self._updateParameters(Y, W, WW, Z, ZZ, ZW, Pa, Pb, mask, ro, idx)
 
         self.Q.setParameters(a=Qa, b=Qb)
 
-    def _updateParameters(self, Y, W, WW, Z, ZZ, Pa, Pb, mask, ro, groups):
+    def _updateParameters(self, Y, W, WW, Z, ZZ, ZW, Pa, Pb, mask, ro, idx):
         """ Hidden method to compute parameter updates """
         Q = self.Q.getParameters()
         Qa, Qb = Q['a'], Q['b']
@@ -104,36 +114,43 @@ class TauD_Node(Gamma_Unobserved_Variational_Node):
         Y_gpu = gpu_utils.array(Y)
         Z_gpu = gpu_utils.array(Z)
         W_gpu = gpu_utils.array(W).T
+        ZW_gpu = gpu_utils.array(ZW)
 
-        # Calculate terms for the update (SPEED EFFICIENT, MEMORY INEFFICIENT)
-        # ZW = Z_gpu.dot(W_gpu)
-        # tmp = gpu_utils.asnumpy( gpu_utils.square(Y_gpu) \
-        #     + gpu_utils.array(ZZ).dot(gpu_utils.array(WW.T)) \
-        #     - gpu_utils.dot(gpu_utils.square(Z_gpu),gpu_utils.square(W_gpu)) + gpu_utils.square(ZW) \
-        #     - 2*ZW*Y_gpu )
-        # tmp[mask] = 0.
-
-        # Calculate terms for the update (SPEED INEFFICIENT, MEMORY EFFICIENT)
+        # Calculate terms for the update, reusing the product E[Z]E[W]^T
         tmp = gpu_utils.asnumpy( gpu_utils.square(Y_gpu) \
             + gpu_utils.array(ZZ).dot(gpu_utils.array(WW.T)) \
-            - gpu_utils.dot(gpu_utils.square(Z_gpu),gpu_utils.square(W_gpu)) + gpu_utils.square(Z_gpu.dot(W_gpu)) \
-            - 2*Z_gpu.dot(W_gpu)*Y_gpu )
+            - gpu_utils.dot(gpu_utils.square(Z_gpu),gpu_utils.square(W_gpu)) + gpu_utils.square(ZW_gpu) \
+            - 2*ZW_gpu*Y_gpu )
         tmp[mask] = 0.
 
-        # Compute updates
+        # Compute updates with segmented sums over the groups
         Qa *= (1-ro)
         Qb *= (1-ro)
+        n_batch = group_counts(idx)
+        n_missing = group_sum(mask, idx)
+        tmp = group_sum(tmp, idx)
         for g in range(self.n_groups):
-            g_mask = (groups == g)
-
-            n_batch = g_mask.sum()
-            if n_batch == 0: continue
+            if n_batch[g] == 0: continue
 
             # Calculate scaling coefficient for mini-batch
-            coeff = self.n_per_group[g]/n_batch
+            coeff = self.n_per_group[g]/n_batch[g]
 
-            Qa[g,:] += ro * (Pa[g,:] + 0.5*coeff*(mask[g_mask,:].shape[0] - mask[g_mask,:].sum(axis=0)))
-            Qb[g,:] += ro * (Pb[g,:] + 0.5*coeff*tmp[g_mask,:].sum(axis=0))
+            Qa[g,:] += ro * (Pa[g,:] + 0.5*coeff*(n_batch[g] - n_missing[g,:]))
+            Qb[g,:] += ro * (Pb[g,:] + 0.5*coeff*tmp[g,:])
+
+        return Qa, Qb
+
+    def _updateParametersStats(self, stats, W, WW, Z, ZZ, Pa, Pb, ro):
+        """ Hidden method to compute parameter updates from the sufficient statistics, without (N,D) computations """
+        Q = self.Q.getParameters()
+        Qa, Qb = Q['a'], Q['b']
+
+        sse = stats.sumSquaredErrors(Z, ZZ, W, WW)
+
+        Qa *= (1-ro)
+        Qb *= (1-ro)
+        Qa += ro * (Pa + 0.5*stats.n_obs)
+        Qb += ro * (Pb + 0.5*sse)
 
         return Qa, Qb
 
@@ -5,6 +5,8 @@ import numpy as np
 import scipy as s
 import scipy.special as special
 
+from mofapy2.core.utils import group_slices, group_counts, group_sum
+
 # Import manually defined functions
 from .variational_nodes import Constant_Variational_Node, Beta_Unobserved_Variational_Node
 
@@ -30,10 +32,11 @@ class ThetaW_Node(Beta_Unobserved_Variational_Node):
     def getExpectations(self, expand=False):
         QExp = self.Q.getExpectations()
         if expand:
+            # read-only broadcast views of shape (D,K)
             D = self.markov_blanket['W'].dim[0]
-            expanded_E = s.repeat(QExp['E'][None, :], D, axis=0)
-            expanded_lnE = s.repeat(QExp['lnE'][None, :], D, axis=0)
-            expanded_lnEInv = s.repeat(QExp['lnEInv'][None, :], D, axis=0)
+            expanded_E = np.broadcast_to(QExp['E'], (D,) + QExp['E'].shape)
+            expanded_lnE = np.broadcast_to(QExp['lnE'], (D,) + QExp['lnE'].shape)
+            expanded_lnEInv = np.broadcast_to(QExp['lnEInv'], (D,) + QExp['lnEInv'].shape)
             return {'E': expanded_E, 'lnE': expanded_lnE, 'lnEInv': expanded_lnEInv}
         else:
             return QExp
@@ -102,14 +105,15 @@ class ThetaZ_Node(Beta_Unobserved_Variational_Node):
 
     def precompute(self, options=None):
         self.Ppar = self.P.getParameters()
-        self.n_per_group = np.zeros(self.n_groups)
-        for c in range(self.n_groups):
-            self.n_per_group[c] = (self.groups == c).sum()
+
+        # Samples of each group (slices if the groups are contiguous)
+        self.group_idx = group_slices(self.groups, self.n_groups)
+        self.n_per_group = group_counts(self.group_idx).astype(float)
 
     def getExpectations(self, expand=False):
         QExp = self.Q.getExpectations()
         if expand:
-            return {'E': QExp['E'][self.groups,:], 'lnE': QExp['lnE'][self.groups,:], 'lnEInv': QExp['lnEInv'][self.groups,:]}
+            return {'E': self.expandGroups('E', QExp['E']), 'lnE': self.expandGroups('lnE', QExp['lnE']), 'lnEInv': self.expandGroups('lnEInv', QExp['lnEInv'])}
         else:
             return QExp
 
@@ -137,17 +141,17 @@ class ThetaZ_Node(Beta_Unobserved_Variational_Node):
         # subset matrices for stochastic inference
         #-----------------------------------------------------------------------
         if ix is None:
-            groups = self.groups
+            idx = self.group_idx
         else:
-            groups = self.groups[ix]
+            idx = group_slices(self.groups[ix], self.n_groups)
 
         # Compute parameter updates
-        Qa,Qb = self._updateParameters(S, groups, ro)
+        Qa,Qb = self._updateParameters(S, idx, ro)
 
         # Save updated parameters of the Q distribution
         self.Q.setParameters(a=Qa, b=Qb)
 
-    def _updateParameters(self, S, groups, ro):
+    def _updateParameters(self, S, idx, ro):
 
         Q = self.Q.getParameters()
         Qa, Qb = Q['a'], Q['b']
@@ -155,19 +159,19 @@ class ThetaZ_Node(Beta_Unobserved_Variational_Node):
         Qb *= (1-ro)
 
         # Perform update
+        n_batch = group_counts(idx)
+        S_sum = group_sum(S, idx)
         for c in range(self.n_groups):
-            mask = (groups == c)
 
             # coeff for stochastic inference
-            n_batch = mask.sum()
-            if n_batch == 0: continue
+            if n_batch[c] == 0: continue
             n_total = self.n_per_group[c]
-            coeff = n_total/n_batch
+            coeff = n_total/n_batch[c]
 
-            tmp1 = S[mask, :].sum(axis=0)
+            tmp1 = S_sum[c,:]
 
             Qa[c,:] += ro * (self.Ppar['a'][c,:] + coeff * tmp1)
-            Qb[c,:] += ro * (self.Ppar['b'][c,:] + coeff * (S[mask, :].shape[0] - tmp1))
+            Qb[c,:] += ro * (self.Ppar['b'][c,:] + coeff * (n_batch[c] - tmp1))
 
         return Qa,Qb
 
@@ -6,6 +6,7 @@ import math
 
 from mofapy2.core.utils import *
 from mofapy2.core import gpu_utils
+from mofapy2.core.residuals import get_residuals
 
 from time import time
 
@@ -35,11 +36,7 @@ class W_Node(UnivariateGaussian_Unobserved_Variational_Node):
         #-----------------------------------------------------------------------
         # get Expectations which are necessarry for the update
         #-----------------------------------------------------------------------
-        Y = self.markov_blanket["Y"].get_mini_batch()
-        mask = self.markov_blanket["Y"].getMask()
         Z = self.markov_blanket["Z"].get_mini_batch()
-        tau = self.markov_blanket["Tau"].get_mini_batch()
-        tau[mask] = 0.
 
         # Collect parameters from the prior or expectations from the markov blanket
         Mu = self.P.getParameters()["mean"]
@@ -52,39 +49,41 @@ class W_Node(UnivariateGaussian_Unobserved_Variational_Node):
         Q = self.Q.getParameters()
         Qmean, Qvar = Q['mean'], Q['var']
 
+        # Residuals of the view (with the weights of the samples of the mini-batch, if any)
+        weights = self.markov_blanket["Z"].mini_weights if ix is not None else None
+        residuals = get_residuals(self.markov_blanket["Y"], self.markov_blanket["Tau"], Z["E"], Qmean, ix, weights)
+
         # compute stochastic "anti-bias" coefficient
         N = self.markov_blanket["Y"].dim[0]
-        coeff = float(N) / float(Y.shape[0])
+        coeff = float(N) / float(Z["E"].shape[0])
 
         # make sure ro is not None
         if ro is None:
             ro = 1.
 
         # compute the update
-        self._updateParameters(Y, Z, tau, Mu, Alpha, Qmean, Qvar, coeff, ro)
-
-    def _updateParameters(self, Y, Z, tau, Mu, Alpha, Qmean, Qvar, coeff, ro):
-
-        for k in range(self.dim[1]):
-            foo = coeff * np.dot(Z["E2"][:,k],tau)
+        self._updateParameters(residuals, Z, Mu, Alpha, Qmean, Qvar, coeff, ro)
 
-            bar_tmp1 = gpu_utils.array(Z["E"][:,k])
+    def _updateParameters(self, residuals, Z, Mu, Alpha, Qmean, Qvar, coeff, ro):
 
-            bar_tmp2 = - gpu_utils.dot(gpu_utils.array(Z["E"][:,s.arange(self.dim[1])!=k]),
-                               gpu_utils.array(Qmean[:,s.arange(self.dim[1])!=k].T))
-            bar_tmp2 += gpu_utils.array(Y)
-            bar_tmp2 *= gpu_utils.array(tau)
+        # Precompute terms
+        foo = coeff * residuals.tauDotZ(Z["E2"])
+        ZZtau = residuals.tauDotZ(s.square(Z["E"]))
 
-            bar = coeff * gpu_utils.asnumpy(gpu_utils.dot(bar_tmp1, bar_tmp2))
+        for k in range(self.dim[1]):
+            bar = coeff * (residuals.dotZ(k) + ZZtau[:,k] * Qmean[:,k])
 
             # stochastic update of W
             Qvar[:,k] *= (1 - ro)
-            Qvar[:,k] += ro/(Alpha[:,k]+foo)
+            Qvar[:,k] += ro/(Alpha[:,k]+foo[:,k])
 
             # NOTE Do not use "Qvar" in the update like we used to because this
             # does not hold for stochastic because of the ro weighting
             Qmean[:,k] *= (1 - ro)
-            Qmean[:,k] += ro * (1/(Alpha[:,k]+foo)) * (bar + Alpha[:,k]*Mu[:,k])
+            Qmean[:,k] += ro * (1/(Alpha[:,k]+foo[:,k])) * (bar + Alpha[:,k]*Mu[:,k])
+
+            # Rank-one update of the residuals
+            residuals.updateW(k, Qmean[:,k])
 
     def calculateELBO(self):
 
@@ -96,7 +95,7 @@ class W_Node(UnivariateGaussian_Unobserved_Variational_Node):
         if "MuW" in self.markov_blanket:
             PE, PE2 = self.markov_blanket['MuW'].getExpectations()['E'], self.markov_blanket['MuW'].getExpectations()['E2']
         else:
-            PE, PE2 = self.P.getParameters()["mean"], s.zeros((self.dim[0],self.dim[1]))
+            PE, PE2 = self.P.getParameters()["mean"], s.zeros((self.dim[0],self.dim[1]), dtype=QE.dtype)
 
         if 'AlphaW' in self.markov_blanket:
             Alpha = self.markov_blanket["AlphaW"].getExpectations(expand=True)
@@ -107,13 +106,13 @@ class W_Node(UnivariateGaussian_Unobserved_Variational_Node):
 
         # compute term from the exponential in the Gaussian
         tmp1 = 0.5 * QE2 - PE * QE + 0.5 * PE2
-        tmp1 = -(tmp1 * Alpha['E']).sum()
+        tmp1 = -(tmp1 * Alpha['E']).sum(dtype=np.float64)
 
         # compute term from the precision factor in front of the Gaussian
         tmp2 = 0.5 * Alpha["lnE"].sum()
 
         lb_p = tmp1 + tmp2
-        lb_q = -(s.log(Qvar).sum() + self.dim[0]*self.dim[1])/2.
+        lb_q = -(s.log(Qvar).sum(dtype=np.float64) + self.dim[0]*self.dim[1])/2.
 
         return lb_p-lb_q
 
@@ -132,10 +131,7 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
     def updateParameters(self, ix=None, ro=1.):
 
         # Collect expectations from other nodes
-        Y = self.markov_blanket["Y"].get_mini_batch()
         Z = self.markov_blanket["Z"].get_mini_batch()
-        tau = self.markov_blanket["Tau"].get_mini_batch()
-        mask = self.markov_blanket["Y"].getMask()
 
         if "AlphaW" in self.markov_blanket:
             Alpha = self.markov_blanket["AlphaW"].getExpectation(expand=True)
@@ -151,54 +147,38 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         Qmean_S1, Qvar_S1, Qvar_S0 = Q['mean_B1'], Q['var_B1'],  Q['var_B0']
         Qtheta = Q['theta']
 
+        # Residuals of the view (with the weights of the samples of the mini-batch, if any)
+        weights = self.markov_blanket["Z"].mini_weights if ix is not None else None
+        residuals = get_residuals(self.markov_blanket["Y"], self.markov_blanket["Tau"], Z["E"], SW, ix, weights)
+
         # Compute stochastic "anti-bias" coefficient
         N = self.markov_blanket["Y"].dim[0]
-        coeff = float(N) / float(Y.shape[0])
+        coeff = float(N) / float(Z["E"].shape[0])
 
         # Compute parameter updates
-        self._updateParameters(Y, Z, tau, mask, Alpha, Qmean_S1, Qvar_S1, Qvar_S0, Qtheta, SW, theta_lnE, theta_lnEInv, coeff, ro)
+        self._updateParameters(residuals, Z, Alpha, Qmean_S1, Qvar_S1, Qvar_S0, Qtheta, SW, theta_lnE, theta_lnEInv, coeff, ro)
     
-    def _updateParameters(self, Y, Z, tau, mask, Alpha, Qmean_S1, Qvar_S1, Qvar_S0, Qtheta, SW, theta_lnE, theta_lnEInv, coeff, ro):
-
-        # Mask matrices
-        tau[mask] = 0.
-
-        # Copy matrices to GPU
-        # Y_gpu = gpu_utils.array(Y)
-        tau_gpu = gpu_utils.array(tau)
-        Z_gpu = gpu_utils.array(Z["E"])
-        ZZ_gpu = gpu_utils.array(Z["E2"])
-        # precompute terms
-        # tauY_gpu = gpu_utils.array(tau*Y).T
-        tauY_gpu = (tau_gpu*gpu_utils.array(Y)).T
-        
-        foo = gpu_utils.asnumpy( gpu_utils.dot(ZZ_gpu.T, tau_gpu).T )
-        term4_tmp1 = gpu_utils.asnumpy( gpu_utils.dot(tauY_gpu, Z_gpu) )
+    def _updateParameters(self, residuals, Z, Alpha, Qmean_S1, Qvar_S1, Qvar_S0, Qtheta, SW, theta_lnE, theta_lnEInv, coeff, ro):
 
-        del tauY_gpu, ZZ_gpu
+        # Precompute terms
+        foo = residuals.tauDotZ(Z["E2"])
+        ZZtau = residuals.tauDotZ(s.square(Z["E"]))
 
         # Update each latent variable in turn
         for k in range(self.dim[1]):
 
             # Compute terms
-            term1 = (theta_lnE-theta_lnEInv)[:,k]
+            term1 = theta_lnE[:,k] - theta_lnEInv[:,k]
 
             term2 = 0.5*s.log(Alpha[:,k])
             term3 = 0.5 * coeff * s.log(foo[:,k] + Alpha[:,k])
 
-            # term4_tmp1 = gpu_utils.dot(tauYT, Zk_cp)
-
-            # term4_tmp2_1 = gpu_utils.array(SW[:,s.arange(self.dim[1])!=k].T)
-            # term4_tmp2_2 = (Z_gpu[:,k] * gpu_utils.array(Z['E'][:,s.arange(self.dim[1])!=k]).T).T
-            # term4_tmp2 = (tau_gpu*gpu_utils.dot(term4_tmp2_2, term4_tmp2_1)).sum(axis=0)
-            term4_tmp2 = gpu_utils.asnumpy( (tau_gpu*gpu_utils.dot(
-                (Z_gpu[:,k] * gpu_utils.array(Z['E'][:,s.arange(self.dim[1])!=k]).T).T, 
-                gpu_utils.array(SW[:,s.arange(self.dim[1])!=k].T))
-            ).sum(axis=0) )
+            # term4_tmp1 - term4_tmp2 = Z[:,k]*tau*(Y - Z[:,-k]SW[:,-k]^T), obtained from the residuals
+            term4_tmp12 = residuals.dotZ(k) + ZZtau[:,k] * SW[:,k]
 
             term4_tmp3 = foo[:,k] + Alpha[:,k]
 
-            term4 = coeff * 0.5*s.divide(s.square(term4_tmp1[:,k]-term4_tmp2),term4_tmp3)
+            term4 = coeff * 0.5*s.divide(s.square(term4_tmp12),term4_tmp3)
 
             # Update S
             Qtheta[:,k] *= (1 - ro)
@@ -210,19 +190,22 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
             Qvar_S1[:,k] += ro * tmp_var
 
             Qmean_S1[:,k] *= (1 - ro)
-            Qmean_S1[:,k] += ro * tmp_var * (term4_tmp1[:,k]-term4_tmp2)
+            Qmean_S1[:,k] += ro * tmp_var * term4_tmp12
 
             # Update Expectations for the next iteration
             SW[:,k] = Qtheta[:,k] * Qmean_S1[:,k]
 
-            del term1, term2, term3, term4_tmp2, term4_tmp3
+            # Rank-one update of the residuals
+            residuals.updateW(k, SW[:,k])
+
+            del term1, term2, term3, term4_tmp12, term4_tmp3
 
         # update of Qvar_S0
         Qvar_S0 *= (1 - ro)
         Qvar_S0 += ro/Alpha
 
         # Save updated parameters of the Q distribution
-        self.Q.setParameters(mean_B0=s.zeros((self.dim[0],self.dim[1])), var_B0=Qvar_S0, mean_B1=Qmean_S1, var_B1=Qvar_S1, theta=Qtheta)
+        self.Q.setParameters(mean_B0=s.zeros((self.dim[0],self.dim[1]), dtype=Qmean_S1.dtype), var_B0=Qvar_S0, mean_B1=Qmean_S1, var_B1=Qvar_S1, theta=Qtheta)
 
     def calculateELBO(self):
         # Collect parameters and expectations
@@ -238,8 +221,8 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
             alpha['lnE'] = s.log(1./self.P.params['var_B1'])
 
         # Calculate ELBO term for W
-        lb_pw = (alpha["lnE"].sum() - s.sum(alpha["E"]*WW))/2.
-        lb_qw = -0.5*self.dim[1]*self.dim[0] - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum()
+        lb_pw = (alpha["lnE"].sum(dtype=np.float64) - s.sum(alpha["E"]*WW, dtype=np.float64))/2.
+        lb_qw = -0.5*self.dim[1]*self.dim[0] - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum(dtype=np.float64)
         lb_w = lb_pw - lb_qw
 
         # Calculate ELBO term for S
@@ -252,6 +235,6 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         lb_ps[s.isnan(lb_ps)] = 0.
         lb_qs[s.isnan(lb_qs)] = 0.
 
-        lb_s = s.sum(lb_ps) - s.sum(lb_qs)
+        lb_s = s.sum(lb_ps, dtype=np.float64) - s.sum(lb_qs, dtype=np.float64)
 
         return lb_w + lb_s
@@ -3,9 +3,13 @@ import numpy.ma as ma
 import numpy as np
 import scipy as s
 import math
+from scipy.sparse import issparse
 
-from mofapy2.core.utils import dotd
+from mofapy2.core.utils import dotd, group_slices, group_counts, group_sum, fill_missing, take_rows, take_mask
 from mofapy2.core import gpu_utils
+from mofapy2.core.residuals import SufficientStatistics
+from mofapy2.core.product_cache import dotZW
+from mofapy2.core.disk_data import DiskView
 
 # Import manually defined functions
 from .variational_nodes import Constant_Variational_Node
@@ -20,12 +24,69 @@ class Y_Node(Constant_Variational_Node):
         self.mini_batch = None
         self.mini_mask = None
 
+        # Buffers of the mini-batches, layout of the samples for contiguous mini-batches and
+        # mini-batch read in advance (only for stochastic inference)
+        self.buffers = {}
+        self.layout = None
+        self.prefetched = None
+        self.parity = 0
+
+    def __getstate__(self):
+        # the data and the buffers are not saved with the model (e.g. in the checkpoints), see setData
+        state = self.__dict__.copy()
+        state['buffers'], state['layout'], state['prefetched'] = {}, None, None
+        state['value'], state['stats'], state['mini_batch'], state['mini_mask'] = None, None, None, None
+        del state['mask']
+        return state
+
+    def setData(self, value, options, mask=None):
+        """ Method to bind the observations to a node saved without them (see __getstate__)
+
+        PARAMETERS
+        ----------
+        value: observations of the view, as given to the node when the model was built
+        options: training options, to precompute the terms that depend on the observations (None to skip it)
+        mask (optional): mask of the missing values, if they have already been filled in the observations
+        """
+        self.value = value
+        if mask is None:
+            # the missing values are masked as in __init__ (the method is shadowed by the mask of an initialised node)
+            mask = Y_Node.mask(self)
+        self.mask = mask
+        if options is not None:
+            self.precompute(options)
+
+    def setStatistics(self, stats, options):
+        """ Method to replace the observations by their statistics, when the observations are held by other processes
+        (see distributed.ShardedStatistics). The updates and the ELBO only use the statistics, the node holds no (N,D) matrices
+
+        PARAMETERS
+        ----------
+        stats: statistics of the observations, with the number of observations per group and feature (n_obs)
+        options: training options
+        """
+        self.value, self.mask = None, None
+        self.stats, self.n_obs = stats, stats.n_obs
+        gpu_utils.gpu_mode = options['gpu_mode']
+        self.TauTrick = options['Y_ELBO_TauTrick']
+        self.likconst = -0.5 * self.n_obs.sum() * s.log(2.*s.pi)
+        groups = self.markov_blanket["Tau"].groups
+        self.group_idx = group_slices(groups, len(np.unique(groups)))
+
     def precompute(self, options=None):
         """ Method to precompute some terms to speed up the calculations """
 
+        # Observations held by other processes, the node only holds their statistics (see setStatistics)
+        if self.value is None:
+            return
+
         # Dimensionalities
-        self.N = self.dim[0] - self.getMask().sum(axis=0)
-        self.D = self.dim[1] - self.getMask().sum(axis=1)
+        if issparse(self.value):
+            self.N = s.repeat(self.dim[0], self.dim[1])
+            self.D = s.repeat(self.dim[1], self.dim[0])
+        else:
+            self.N = self.dim[0] - self.getMask().sum(axis=0)
+            self.D = self.dim[1] - self.getMask().sum(axis=1)
 
         # GPU mode
         gpu_utils.gpu_mode = options['gpu_mode']
@@ -37,10 +98,35 @@ class Y_Node(Constant_Variational_Node):
         # Constant ELBO terms
         self.likconst = -0.5 * s.sum(self.N) * s.log(2.*s.pi)
 
+        # Store the partially observed groups as lists of observed entries if the view has many missing values
+        observed = options['observed_entries'] is not None and not issparse(self.value) \
+            and not isinstance(self.value, DiskView) and self.mask.mean() > options['observed_entries']
+
+        # Sufficient statistics, used when at least one group of samples is fully observed
+        # or when the missing values are handled with the observed entries
+        self.stats = SufficientStatistics(self.value, self.mask, self.markov_blanket["Tau"].groups, observed)
+        if len(self.stats.complete) == 0 and self.stats.observed is None and not self.stats.disk:
+            self.stats = None
+
+        # Samples of each group (slices if the groups are contiguous) and number of observations per group and feature
+        groups = self.markov_blanket["Tau"].groups
+        self.group_idx = group_slices(groups, len(np.unique(groups)))
+        if self.stats is not None:
+            self.n_obs = self.stats.n_obs
+        else:
+            self.n_obs = group_counts(self.group_idx)[:,None] - group_sum(self.mask, self.group_idx)
+
     def mask(self):
         """ Method to mask missing observations """
+        if issparse(self.value):
+            # zeros of sparse matrices are observed values, there are no missing values
+            return np.broadcast_to(False, self.value.shape)
+        if isinstance(self.value, DiskView):
+            # views stored on disk only have missing values for entire samples
+            if self.value.missing is None: self.value.scan()
+            return np.broadcast_to(self.value.missing[:,None], self.value.shape)
         mask = s.isnan(self.value)
-        self.value[mask] = 0.
+        self.value = fill_missing(self.value, mask)
         return mask
 
     def getMask(self, full=False):
@@ -53,10 +139,72 @@ class Y_Node(Constant_Variational_Node):
             else:
                 return self.mini_mask
             
-    def define_mini_batch(self, ix):
-        """ Method to define a mini-batch (only for stochastic inference) """
-        self.mini_batch = self.value[ix,:]
-        self.mini_mask = self.mask[ix,:]
+    def define_mini_batch(self, ix, rows=None):
+        """ Method to define a mini-batch (only for stochastic inference)
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        rows: slice with the position of the mini-batch in the layout set by permuteSamples, if any
+        """
+        if self.prefetched is not None and np.array_equal(self.prefetched[0], ix):
+            # mini-batch read in advance by prefetchMiniBatch, in the buffers that become the current ones
+            _, self.mini_batch, self.mini_mask = self.prefetched
+            self.prefetched = None
+            self.parity = 1 - self.parity
+            return
+        self.prefetched = None
+        if rows is not None and self.layout is not None:
+            # contiguous mini-batches are views of the data
+            self.mini_batch, self.mini_mask = self.layout[0][rows], self.layout[1][rows]
+            return
+        self.mini_batch, self.mini_mask = self.readMiniBatch(ix, str(self.parity))
+
+    def readMiniBatch(self, ix, buffer=""):
+        """ Method to read the observations and the mask of a subset of samples
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples
+        buffer: suffix of the buffers where the rows are gathered (dense views)
+        """
+        if issparse(self.value) or isinstance(self.value, DiskView):
+            Y = self.stats.getDense(ix)
+        else:
+            Y = take_rows(self.value, ix, self.buffers, "Y"+buffer)
+        return Y, take_mask(self.mask, ix, self.buffers, "mask"+buffer)
+
+    def prefetchBuffer(self):
+        """ Method to get the suffix of the buffers not used by the current mini-batch, where the next one is read in advance """
+        return str(1 - self.parity)
+
+    def prefetchMiniBatch(self, ix, buffer):
+        """ Method to read the next mini-batch in advance, while the current one is being used (only for stochastic inference)
+
+        It is called from a background thread and does not modify the node: the rows are gathered in the buffers given
+        by the main thread (see prefetchBuffer), which stores the mini-batch returned in 'prefetched' once it is read.
+        define_mini_batch picks it up if it is called with the same indices ix.
+        Contiguous mini-batches are already views of the data and are not read in advance (None is returned).
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        buffer: suffix of the buffers where the rows are gathered
+        """
+        if self.layout is not None:
+            return None
+        Y, mask = self.readMiniBatch(ix, buffer)
+        return (ix, Y, mask)
+
+    def permuteSamples(self, ix):
+        """ Method to lay out a copy of the data in the order of the samples ix, so that the mini-batches of consecutive
+        samples of ix are contiguous slices of the copy (only for stochastic inference)
+
+        Sparse views and views stored on disk are read by mini-batch and are not laid out
+        """
+        if issparse(self.value) or isinstance(self.value, DiskView):
+            return
+        self.layout = (take_rows(self.value, ix, self.buffers, "layout_Y"), take_mask(self.mask, ix, self.buffers, "layout_mask"))
 
     def get_mini_batch(self):
         """ Method to retrieve a mini-batch (only for stochastic inference) """
@@ -70,33 +218,67 @@ class Y_Node(Constant_Variational_Node):
         mask = self.mask
         Tau = self.markov_blanket["Tau"].getExpectations(expand=False)
         elbo = self.likconst
-        groups = self.markov_blanket["Tau"].groups
 
         if self.TauTrick: 
             tauQ_param = self.markov_blanket["Tau"].getParameters("Q")
             tauP_param = self.markov_blanket["Tau"].getParameters("P")
-            for g in range(len(np.unique(groups))):
-                idx = groups==g
-                foo = (~mask[idx,:]).sum(axis=0)
+            for g in range(len(self.group_idx)):
+                foo = self.n_obs[g,:]
                 elbo += 0.5*(Tau["lnE"][g,:]*foo).sum() - s.dot(Tau["E"][g,:],(tauQ_param["b"][g,:] - tauP_param["b"][g,:]))
 
+        elif self.stats is not None:
+            Wtmp = self.markov_blanket["W"].getExpectations()
+            Ztmp = self.markov_blanket["Z"].getExpectations()
+            tmp = 0.5 * self.stats.sumSquaredErrors(Ztmp["E"], Ztmp["E2"], Wtmp["E"], Wtmp["E2"])
+            elbo += 0.5*(Tau["lnE"]*self.stats.n_obs).sum() - (Tau["E"]*tmp).sum()
+
         else:
             Y = self.getExpectation()
             Wtmp = self.markov_blanket["W"].getExpectations()
             Ztmp = self.markov_blanket["Z"].getExpectations()
             W, WW = Wtmp["E"].T, Wtmp["E2"].T
             Z, ZZ = Ztmp["E"], Ztmp["E2"]
+            ZW = dotZW(self)
 
             tmp = s.square(Y) \
                 + ZZ.dot(WW) \
-                - s.dot(s.square(Z),s.square(W)) + s.square(Z.dot(W)) \
-                - 2*Z.dot(W)*Y 
+                - s.dot(s.square(Z),s.square(W)) + s.square(ZW) \
+                - 2*ZW*Y 
             tmp *= 0.5
             tmp[mask] = 0.
             
-            for g in range(len(np.unique(groups))):
-                idx = groups==g
-                foo = (~mask[idx,:]).sum(axis=0)
-                elbo += 0.5*(Tau["lnE"][g,:]*foo).sum() - (Tau["E"][g,:]*tmp[idx,:]).sum()
+            for g in range(len(self.group_idx)):
+                idx = self.group_idx[g]
+                foo = self.n_obs[g,:]
+                elbo += 0.5*(Tau["lnE"][g,:]*foo).sum() - (Tau["E"][g,:]*tmp[idx,:]).sum(dtype=np.float64)
         return elbo
 
+    def estimateELBO(self, ix):
+        """ Method to estimate the ELBO from the samples ix of the current mini-batch, rescaled to all samples (only for stochastic inference)
+
+        The terms that do not depend on the data are computed exactly from the number of observations, only the
+        expected squared errors are estimated from the mini-batch
+        """
+        Tau = self.markov_blanket["Tau"].getExpectations(expand=False)
+        Y, mask = self.mini_batch, self.mini_mask
+        Wtmp = self.markov_blanket["W"].getExpectations()
+        Ztmp = self.markov_blanket["Z"].get_mini_batch()
+        W, WW = Wtmp["E"].T, Wtmp["E2"].T
+        Z, ZZ = Ztmp["E"], Ztmp["E2"]
+        ZW = s.dot(Z, W)
+
+        tmp = s.square(Y) \
+            + ZZ.dot(WW) \
+            - s.dot(s.square(Z),s.square(W)) + s.square(ZW) \
+            - 2*ZW*Y
+        tmp *= 0.5
+        tmp[mask] = 0.
+
+        # squared errors per group, rescaled to all samples (with the weights of the samples of the mini-batch, if any)
+        if self.markov_blanket["Z"].mini_weights is not None:
+            tmp *= self.markov_blanket["Z"].mini_weights[:,None]
+        idx = group_slices(self.markov_blanket["Tau"].groups[ix], len(self.group_idx))
+        sse = self.dim[0] / len(ix) * group_sum(tmp, idx)
+
+        return self.likconst + 0.5*(Tau["lnE"]*self.n_obs).sum() - (Tau["E"]*sse).sum(dtype=np.float64)
+
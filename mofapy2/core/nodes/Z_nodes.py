@@ -5,6 +5,8 @@ import scipy as s
 import math
 from mofapy2.core.utils import *
 from mofapy2.core import gpu_utils
+from mofapy2.core import parallel
+from mofapy2.core.residuals import get_residuals
 from time import time
 
 
@@ -17,6 +19,8 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         super().__init__(dim=dim, pmean=pmean, pvar=pvar, qmean=qmean, qvar=qvar, qE=qE, qE2=qE2)
 
         self.mini_batch = None
+        self.mini_weights = None
+        self.buffers = {}
         self.factors_axis = 1
         self.weight_views = weight_views
 
@@ -29,10 +33,18 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         super(Z_Node, self).removeFactors(idx, axis)
         # self.dim[1] -= len(idx)
 
-    def define_mini_batch(self, ix):
-        """ Method to define minibatch for the expectation """
+    def define_mini_batch(self, ix, weights=None):
+        """ Method to define minibatch for the expectation
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        weights: weights of the samples of the mini-batch relative to the rescaling N/len(ix) (e.g. for group-stratified
+            mini-batches), None if they all have the same weight
+        """
+        self.mini_weights = weights
         QExp = self.Q.getExpectations()
-        self.mini_batch = {'E': QExp["E"][ix,:], 'E2': QExp["E2"][ix,:]}
+        self.mini_batch = { k: take_rows(QExp[k], ix, self.buffers, k) for k in ['E','E2'] }
 
     def get_mini_batch(self):
         """ Method to fetch minibatch """
@@ -51,9 +63,6 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
 
         # Get expectations from other nodes
         W = self.markov_blanket["W"].getExpectations()
-        Y = self.markov_blanket["Y"].get_mini_batch()
-        tau = self.markov_blanket["Tau"].get_mini_batch()
-        mask = [self.markov_blanket["Y"].nodes[m].getMask() for m in range(len(Y))]
         if "MuZ" in self.markov_blanket:
             Mu =  self.markov_blanket['MuZ'].get_mini_batch()
         else:
@@ -74,8 +83,11 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
             Qmean = Qmean[ix,:]
             Qvar = Qvar[ix,:]
 
+        # Residuals of each view
+        residuals = parallel.map(lambda m: get_residuals(self.markov_blanket["Y"].nodes[m], self.markov_blanket["Tau"].nodes[m], Qmean, W[m]["E"], ix), range(len(W)))
+
         # Compute updates
-        par_up = self._updateParameters(Y, W, tau, Mu, Alpha, Qmean, Qvar, mask)
+        par_up = self._updateParameters(residuals, W, Mu, Alpha, Qmean, Qvar)
 
         # Update parameters
         if ix is None:
@@ -90,85 +102,85 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
 
         self.Q.setParameters(mean=Q['mean'], var=Q['var'])  # NOTE should not be necessary but safer to keep for now
 
-    def _updateParameters(self, Y, W, tau, Mu, Alpha, Qmean, Qvar, mask):
+    def _updateParameters(self, residuals, W, Mu, Alpha, Qmean, Qvar):
         """ Hidden method to compute parameter updates """
         # Speed analysis: the pre-computation part does not benefit from GPU, but the next updates doe
 
-        N = Y[0].shape[0]  # this is different from self.N for minibatch
-        M = len(Y)
+        N = Qmean.shape[0]  # this is different from self.N for minibatch
+        M = len(W)
         K = self.dim[1]
 
-        # Masking
-        for m in range(M):
-            tau[m][mask[m]] = 0.
-
         weights = [1] * M       
         if self.weight_views and M > 1:
-            total_w = np.asarray([Y[m].shape[1] for m in range(M)]).sum()
-            weights = np.asarray([total_w / (M * Y[m].shape[1]) for m in range(M)])
+            total_w = np.asarray([W[m]["E"].shape[0] for m in range(M)]).sum()
+            weights = np.asarray([total_w / (M * W[m]["E"].shape[0]) for m in range(M)])
             weights = weights / weights.sum() * M
             # weights = [(total_w-Y[m].shape[1])/total_w * M / (M-1) for m in range(M)]
 
-        # Precompute terms to speed up GPU computation
-        foo = gpu_utils.array(s.zeros((N,K)))
-        precomputed_bar = gpu_utils.array(s.zeros((N,K)))
+        # Precompute terms to speed up GPU computation (the views are run concurrently if enabled, and reduced in order)
+        tmp = parallel.map(lambda m: (residuals[m].tauDotW(W[m]["E2"]), residuals[m].tauDotW(s.square(W[m]["E"]))), range(M))
+        foo = s.zeros((N,K), dtype=Qmean.dtype)
+        tauWW = s.zeros((N,K), dtype=Qmean.dtype)
         for m in range(M):
-            tau_gpu = gpu_utils.array(tau[m])
-            foo += weights[m] * gpu_utils.dot(tau_gpu, gpu_utils.array(W[m]["E2"]))
-            bar_tmp1 = gpu_utils.array(W[m]["E"])
-            bar_tmp2 = tau_gpu * gpu_utils.array(Y[m])
-            precomputed_bar += weights[m] * gpu_utils.dot(bar_tmp2, bar_tmp1)
-        foo = gpu_utils.asnumpy(foo)
+            foo += weights[m] * tmp[m][0]
+            tauWW += weights[m] * tmp[m][1]
+        del tmp
 
         # Calculate variational updates
         for k in range(K):
-            bar = gpu_utils.array(s.zeros((N,)))
-            tmp_cp1 = gpu_utils.array(Qmean[:, s.arange(K) != k])
-            for m in range(M):
-                tmp_cp2 = gpu_utils.array(W[m]["E"][:, s.arange(K) != k].T)
-
-                bar_tmp1 = gpu_utils.array(W[m]["E"][:,k])
-                bar_tmp2 = gpu_utils.array(tau[m])*(-gpu_utils.dot(tmp_cp1, tmp_cp2))
-
-                bar += weights[m] * gpu_utils.dot(bar_tmp2, bar_tmp1)
-            bar += precomputed_bar[:,k]
-            bar = gpu_utils.asnumpy(bar)
+            bar = tauWW[:,k] * Qmean[:,k]
+            for m, x in enumerate(parallel.map(lambda m: residuals[m].dotW(k), range(M))):
+                bar += weights[m] * x
 
             Qvar[:, k] = 1. / (Alpha[:, k] + foo[:,k])
             Qmean[:, k] = Qvar[:, k] * (bar + Alpha[:, k] * Mu[:, k])
 
+            # Rank-one update of the residuals
+            parallel.map(lambda m: residuals[m].updateZ(k, Qmean[:,k]), range(M))
+
         # Save updated parameters of the Q distribution
         return {'Qmean': Qmean, 'Qvar':Qvar}
 
     def calculateELBO(self):
+        return self._calculateELBO(slice(None))
+
+    def estimateELBO(self, ix):
+        """ Method to estimate the ELBO from the samples ix of a mini-batch, rescaled to all samples (only for stochastic inference) """
+        return self.dim[0] / len(ix) * self._calculateELBO(ix, self.mini_weights)
+
+    def _calculateELBO(self, ix, weights=None):
+        """ Hidden method to calculate the ELBO terms of the samples ix (weighted by sample if weights are given) """
+        w = (lambda X: X) if weights is None else (lambda X: X * weights[:,None])
 
         # Collect parameters and expectations of current node
         Qpar, Qexp = self.Q.getParameters(), self.Q.getExpectations()
-        Qmean, Qvar = Qpar['mean'], Qpar['var']
-        QE, QE2 = Qexp['E'], Qexp['E2']
+        Qmean, Qvar = Qpar['mean'][ix], Qpar['var'][ix]
+        QE, QE2 = Qexp['E'][ix], Qexp['E2'][ix]
 
         if "MuZ" in self.markov_blanket:
-            PE, PE2 = self.markov_blanket['MuZ'].getExpectations()['E'], \
-                      self.markov_blanket['MuZ'].getExpectations()['E2']
+            PE, PE2 = self.markov_blanket['MuZ'].getExpectations()['E'][ix], \
+                      self.markov_blanket['MuZ'].getExpectations()['E2'][ix]
         else:
-            PE, PE2 = self.P.getParameters()["mean"], s.zeros((self.dim[0], self.dim[1]))
+            PE, PE2 = self.P.getParameters()["mean"][ix], s.zeros(QE.shape, dtype=QE.dtype)
 
         if 'AlphaZ' in self.markov_blanket:
             Alpha = self.markov_blanket['AlphaZ'].getExpectations(expand=True)
+            Alpha = {'E': Alpha['E'][ix], 'lnE': Alpha['lnE'][ix]}
         else:
             Alpha = dict()
-            Alpha['E'] = 1./self.P.params['var']
-            Alpha['lnE'] = s.log(1./self.P.params['var'])
+            Alpha['E'] = 1./self.P.params['var'][ix]
+            Alpha['lnE'] = s.log(Alpha['E'])
 
         # compute term from the exponential in the Gaussian
         tmp1 = 0.5 * QE2 - PE * QE + 0.5 * PE2
-        tmp1 = -(tmp1 * Alpha['E']).sum()
+        tmp1 = -w(tmp1 * Alpha['E']).sum(dtype=np.float64)
 
         # compute term from the precision factor in front of the Gaussian
-        tmp2 = 0.5 * Alpha["lnE"].sum()
+        tmp2 = 0.5 * w(Alpha["lnE"]).sum()
 
         lb_p = tmp1 + tmp2
-        lb_q = -(s.log(Qvar).sum() + self.dim[0] * self.dim[1]) / 2.
+        n = QE.shape[0] if weights is None else weights.sum()
+        lb_q = -(w(s.log(Qvar)).sum(dtype=np.float64) + n * QE.shape[1]) / 2.
 
         return lb_p - lb_q
 
@@ -177,6 +189,8 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
         super().__init__(dim, pmean_T0, pmean_T1, pvar_T0, pvar_T1, ptheta, qmean_T0, qmean_T1, qvar_T0, qvar_T1, qtheta, qEZ_T0, qEZ_T1, qET)
 
         self.mini_batch = None
+        self.mini_weights = None
+        self.buffers = {}
         self.factors_axis = 1
         self.weight_views = weight_views
 
@@ -191,16 +205,18 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
         super(SZ_Node, self).removeFactors(idx, axis)
         # self.dim[1] -= len(idx)
 
-    def define_mini_batch(self, ix):
-        """ Method to define minibatch for the expectation """
+    def define_mini_batch(self, ix, weights=None):
+        """ Method to define minibatch for the expectation
+
+        PARAMETERS
+        ----------
+        ix: indices of the samples of the mini-batch
+        weights: weights of the samples of the mini-batch relative to the rescaling N/len(ix) (e.g. for group-stratified
+            mini-batches), None if they all have the same weight
+        """
+        self.mini_weights = weights
         QExp = self.Q.getExpectations()
-        self.mini_batch = {
-        'E': QExp["E"][ix,:], 
-        'E2': QExp["E2"][ix,:],
-        'EB': QExp["EB"][ix,:],
-        'EN': QExp["EN"][ix,:],
-        'ENN': QExp["ENN"][ix,:]
-        }
+        self.mini_batch = { k: take_rows(QExp[k], ix, self.buffers, k) for k in ['E','E2','EB','EN','ENN'] }
 
     def get_mini_batch(self):
         if self.mini_batch is None:
@@ -218,9 +234,6 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
 
         # Get expectations from other nodes
         W = self.markov_blanket["W"].getExpectations()
-        Y = self.markov_blanket["Y"].get_mini_batch()
-        tau = self.markov_blanket["Tau"].get_mini_batch()
-        mask = [self.markov_blanket["Y"].nodes[m].getMask() for m in range(len(Y))]
 
         if "AlphaZ" in self.markov_blanket:
             Alpha = self.markov_blanket['AlphaZ'].get_mini_batch()
@@ -244,8 +257,11 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
             SZ = SZ[ix,:]
 
 
+        # Residuals of each view
+        residuals = parallel.map(lambda m: get_residuals(self.markov_blanket["Y"].nodes[m], self.markov_blanket["Tau"].nodes[m], SZ, W[m]["E"], ix), range(len(W)))
+
         # Compute the updates
-        par_up = self._updateParameters(Y, W, tau, mask, Alpha, Qmean_T1, Qvar_T1, Qtheta, SZ, theta_lnE, theta_lnEInv)
+        par_up = self._updateParameters(residuals, W, Alpha, Qmean_T1, Qvar_T1, Qtheta, SZ, theta_lnE, theta_lnEInv)
 
         # Update the parameters (this is not very clean...)
         if ix is None:
@@ -267,68 +283,42 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
 
         # self.Q.setParameters(mean_B0=s.zeros((self.dim[0], self.dim[1])), var_B0=Q['var_B0'],
         #                      mean_B1=Q['mean_B1'], var_B1=Q['var_B1'], theta=Q['theta'])  # NOTE should not be necessary but safer to keep for now
-    def _updateParameters(self, Y, W, tau, mask, Alpha, Qmean_T1, Qvar_T1, Qtheta, SZ, theta_lnE, theta_lnEInv):
+    def _updateParameters(self, residuals, W, Alpha, Qmean_T1, Qvar_T1, Qtheta, SZ, theta_lnE, theta_lnEInv):
         """ Hidden method to compute parameter updates """
 
-        # Mask matrices
-        for m in range(len(Y)):
-            tau[m][mask[m]] = 0.
-
         # Precompute terms to speed up GPU computation
         N = Qmean_T1.shape[0]
-        M = len(Y)
+        M = len(W)
         K = self.dim[1]
 
         weights = [1] * M       
         if self.weight_views and M > 1:
-            total_w = np.asarray([Y[m].shape[1] for m in range(M)]).sum()
-            # weights = [(total_w-Y[m].shape[1])/total_w * M / (M-1) for m in range(M)]
-            weights = np.asarray([total_w / (M * Y[m].shape[1]) for m in range(M)])
+            total_w = np.asarray([W[m]["E"].shape[0] for m in range(M)]).sum()
+            # weights = [(total_w-W[m]["E"].shape[0])/total_w * M / (M-1) for m in range(M)]
+            weights = np.asarray([total_w / (M * W[m]["E"].shape[0]) for m in range(M)])
             weights = weights / weights.sum() * M
 
 
-        # term4_tmp1 = [ gpu_utils.array(Alpha[:,k]) for k in range(self.dim[1]) ]
-        # term4_tmp2 = [ gpu_utils.array(Alpha[:,k]) for k in range(self.dim[1]) ]
-        # term4_tmp3 = [ gpu_utils.array(Alpha[:,k]) for k in range(self.dim[1]) ]
-        # for m in range(M):
-        #     tau_gpu = gpu_utils.array(tau[m])
-        #     Y_gpu = gpu_utils.array(Y[m])
-        #     for k in range(K):
-        #         Wk_gpu = gpu_utils.array(W[m]["E"][:,k])
-        #         WWk_gpu = gpu_utils.array(W[m]["E2"][:,k])
-        #         term4_tmp1[k] += gpu_utils.dot(tau_gpu*Y_gpu, Wk_gpu)
-        #         term4_tmp3[k] += gpu_utils.dot(tau_gpu, WWk_gpu)
-        # del tau_gpu, Y_gpu, Wk_gpu, WWk_gpu
-
-        term4_tmp1 = gpu_utils.array( s.zeros((N,K))+Alpha )
-        term4_tmp2 = gpu_utils.array( s.zeros((N,K))+Alpha )
-        term4_tmp3 = gpu_utils.array( s.zeros((N,K))+Alpha ) 
-
+        tmp = parallel.map(lambda m: (residuals[m].tauDotW(W[m]["E2"]), residuals[m].tauDotW(s.square(W[m]["E"]))), range(M))
+        term4_tmp3 = s.zeros((N,K), dtype=Qmean_T1.dtype)+Alpha
+        tauWW = s.zeros((N,K), dtype=Qmean_T1.dtype)
         for m in range(M):
-            tau_gpu = gpu_utils.array(tau[m])
-            Y_gpu = gpu_utils.array(Y[m])
-            W_gpu = gpu_utils.array(W[m]["E"])
-            WW_gpu = gpu_utils.array(W[m]["E2"])
-            term4_tmp1 +=  weights[m] * gpu_utils.dot(tau_gpu*Y_gpu, W_gpu)
-            term4_tmp3 +=  weights[m] * gpu_utils.dot(tau_gpu, WW_gpu)
-        del tau_gpu, Y_gpu, W_gpu, WW_gpu
+            term4_tmp3 +=  weights[m] * tmp[m][0]
+            tauWW +=  weights[m] * tmp[m][1]
+        del tmp
 
         # Update each latent variable in turn (notice that the update of Z[,k] depends on the other values of Z!)
         for k in range(K):
-            term1 = (theta_lnE - theta_lnEInv)[:, k]
+            term1 = theta_lnE[:,k] - theta_lnEInv[:,k]
             term2 = 0.5 * s.log(Alpha[:,k])
 
-            for m in range(M):
-                tau_gpu = gpu_utils.array(tau[m])
-                Wk_gpu = gpu_utils.array(W[m]["E"][:,k])
-                term4_tmp2_tmp = (tau_gpu * gpu_utils.dot(gpu_utils.array(SZ[:, s.arange(K) != k]),
-                                (Wk_gpu * gpu_utils.array(W[m]["E"][:, s.arange(K) != k].T)))).sum(axis=1)
-                term4_tmp2[:,k] +=  weights[m] * term4_tmp2_tmp
-                del tau_gpu, Wk_gpu, term4_tmp2_tmp
-            
-            # term4_tmp3[k] += Alpha[:,k]
-            term3 = gpu_utils.asnumpy( 0.5*gpu_utils.log(term4_tmp3[:,k]) )
-            term4 = gpu_utils.asnumpy( 0.5*gpu_utils.divide(gpu_utils.square(term4_tmp1[:,k] - term4_tmp2[:,k]), term4_tmp3[:,k]) )
+            # term4_tmp1 - term4_tmp2 = tau*(Y - SZ[:,-k]W[:,-k]^T)W[:,k], obtained from the residuals
+            term4_tmp12 = tauWW[:,k] * SZ[:,k]
+            for m, x in enumerate(parallel.map(lambda m: residuals[m].dotW(k), range(M))):
+                term4_tmp12 += weights[m] * x
+
+            term3 = 0.5*s.log(term4_tmp3[:,k])
+            term4 = 0.5*s.divide(s.square(term4_tmp12), term4_tmp3[:,k])
 
             # Update S
             # NOTE there could be some precision issues in T --> loads of 1s in result
@@ -336,33 +326,48 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
             Qtheta[:,k] = np.nan_to_num(Qtheta[:,k])
 
             # Update Z
-            Qvar_T1[:, k] = gpu_utils.asnumpy( 1. / term4_tmp3[:,k] )
-            Qmean_T1[:, k] = Qvar_T1[:, k] * gpu_utils.asnumpy(term4_tmp1[:,k] - term4_tmp2[:,k])
+            Qvar_T1[:, k] = 1. / term4_tmp3[:,k]
+            Qmean_T1[:, k] = Qvar_T1[:, k] * term4_tmp12
 
             # Update Expectations for the next iteration
             SZ[:, k] = Qtheta[:, k] * Qmean_T1[:, k]
 
+            # Rank-one update of the residuals
+            parallel.map(lambda m: residuals[m].updateZ(k, SZ[:,k]), range(M))
+
         return {'mean_B1': Qmean_T1, 'var_B1': Qvar_T1, 'theta': Qtheta}
 
     def calculateELBO(self):
+        return self._calculateELBO(slice(None))
+
+    def estimateELBO(self, ix):
+        """ Method to estimate the ELBO from the samples ix of a mini-batch, rescaled to all samples (only for stochastic inference) """
+        return self.dim[0] / len(ix) * self._calculateELBO(ix, self.mini_weights)
+
+    def _calculateELBO(self, ix, weights=None):
+        """ Hidden method to calculate the ELBO terms of the samples ix (weighted by sample if weights are given) """
+        w = (lambda X: X) if weights is None else (lambda X: X * weights[:,None])
 
         # Collect parameters and expectations
         Qpar, Qexp = self.Q.getParameters(), self.Q.getExpectations()
-        T, ZZ = Qexp["EB"], Qexp["ENN"]
-        Qvar = Qpar['var_B1']
+        T, ZZ = Qexp["EB"][ix], Qexp["ENN"][ix]
+        Qvar = Qpar['var_B1'][ix]
         theta = self.markov_blanket['ThetaZ'].getExpectations(expand=True)
+        theta = {'lnE': theta['lnE'][ix], 'lnEInv': theta['lnEInv'][ix]}
 
         # Get ARD sparsity or prior variance
         if "AlphaZ" in self.markov_blanket:
             alpha = self.markov_blanket['AlphaZ'].getExpectations(expand=True)
+            alpha = {'E': alpha['E'][ix], 'lnE': alpha['lnE'][ix]}
         else:
             alpha = dict()
-            alpha['E'] = 1./self.P.params['var_B1']
-            alpha['lnE'] = s.log(1./self.P.params['var_B1'])
+            alpha['E'] = 1./self.P.params['var_B1'][ix]
+            alpha['lnE'] = s.log(alpha['E'])
 
         # Calculate ELBO for Z
-        lb_pz = (alpha["lnE"].sum() - s.sum(alpha["E"] * ZZ)) / 2.
-        lb_qz = -0.5 * self.dim[1] * self.dim[0] - 0.5 * (T * s.log(Qvar) + (1. - T) * s.log(1. / alpha["E"])).sum()
+        lb_pz = (w(alpha["lnE"]).sum(dtype=np.float64) - s.sum(w(alpha["E"] * ZZ), dtype=np.float64)) / 2.
+        n = T.shape[0] if weights is None else weights.sum()
+        lb_qz = -0.5 * T.shape[1] * n - 0.5 * w(T * s.log(Qvar) + (1. - T) * s.log(1. / alpha["E"])).sum(dtype=np.float64)
         lb_z = lb_pz - lb_qz
 
         # Calculate ELBO for T
@@ -375,6 +380,6 @@ class SZ_Node(BernoulliGaussian_Unobserved_Variational_Node):
         lb_pt[s.isnan(lb_pt)] = 0.
         lb_qt[s.isnan(lb_qt)] = 0.
         
-        lb_t = s.sum(lb_pt) - s.sum(lb_qt)
+        lb_t = s.sum(w(lb_pt), dtype=np.float64) - s.sum(w(lb_qt), dtype=np.float64)
 
         return lb_z + lb_t
@@ -10,6 +10,8 @@ All nodes have two main attributes:
 import scipy as s
 import numpy as np
 
+from mofapy2.core.distributions.basic_distributions import removeElements
+
 
 class Node(object):
     """General class for a node in a Bayesian network
@@ -19,6 +21,13 @@ class Node(object):
     dim: tuple
         Dimensionality of the node
     """
+
+    # Number of updates of the expectations, product cache of the network (see ProductCache)
+    # and expansions of the expectations to the samples (see expandGroups)
+    version = 0
+    cache = None
+    expanded = None
+
     def __init__(self, dim):
         self.dim = dim
 
@@ -81,6 +90,21 @@ class Node(object):
     def precompute(self, options=None):
         pass
 
+    def astype(self, dtype):
+        """ General method to cast the node to a given floating point precision """
+        pass
+
+    def setCache(self, cache):
+        """ Method to share the product cache of the network with the node """
+        self.cache = cache
+
+    def touch(self):
+        """ Method to signal that the expectations of the node have changed """
+        self.version += 1
+        self.expanded = None
+        if self.cache is not None:
+            self.cache.invalidate(self)
+
 
 class Constant_Node(Node):
     """ General class for a constant node in a Bayesian network
@@ -99,6 +123,10 @@ class Constant_Node(Node):
         """ Method to return the values of the node """
         return self.value
 
+    def astype(self, dtype):
+        """ Method to cast the values of the node to a given floating point precision """
+        self.value = self.value.astype(dtype, copy=False)
+
     def getExpectation(self):
         """ Method to return the first moment of the node, which just points to the values """
         return self.getValue()
@@ -110,7 +138,7 @@ class Constant_Node(Node):
     def removeFactors(self, idx, axis=None):
         if hasattr(self,"factors_axis"): axis = self.factors_axis
         if axis is not None:
-            self.value = s.delete(self.value, idx, axis)
+            self.value = removeElements(self.value, idx, axis)
             self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
 
     def sample(self, distrib='P'):
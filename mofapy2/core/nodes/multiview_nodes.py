@@ -15,6 +15,7 @@ All multiview nodes have the following main attributes:
 
 import scipy as s
 
+from mofapy2.core import parallel
 from .basic_nodes import Node
 from .variational_nodes import Variational_Node
 
@@ -103,9 +104,17 @@ class Multiview_Node(Node):
         for m in self.activeM:
             self.nodes[m].precompute(options)
 
-    def define_mini_batch(self, ix):
+    def astype(self, dtype):
         for m in self.activeM:
-            self.nodes[m].define_mini_batch(ix)
+            self.nodes[m].astype(dtype)
+
+    def setCache(self, cache):
+        for m in self.activeM:
+            self.nodes[m].setCache(cache)
+
+    def define_mini_batch(self, ix, *args):
+        for m in self.activeM:
+            self.nodes[m].define_mini_batch(ix, *args)
 
     def get_mini_batch(self):
         return [self.nodes[m].get_mini_batch() for m in self.activeM]
@@ -118,22 +127,31 @@ class Multiview_Variational_Node(Multiview_Node, Variational_Node):
         for node in nodes: assert isinstance(node, Variational_Node)
 
     def update(self, ix=None, ro=1.):
-        """ Method to update both parameters and expectations of the node"""
-        for m in self.activeM:
+        """ Method to update both parameters and expectations of the node (the views are run concurrently if enabled) """
+        def update_view(m):
             self.nodes[m].updateParameters(ix, ro)
             self.nodes[m].updateExpectations()
+        parallel.map(update_view, self.activeM)
 
     def updateExpectations(self):
         """Method to update expectations using current estimates of the parameters"""
         for m in self.activeM: self.nodes[m].updateExpectations()
     def updateParameters(self, ix=None, ro=1.):
         """Method to update parameters using current estimates of the expectations"""
-        for m in self.activeM: self.nodes[m].updateParameters(ix, ro)
-    def calculateELBO(self, weights):
-        """Method to calculate variational evidence lower bound"""
-        lb = [ self.nodes[m].calculateELBO() * weights[m] for m in self.activeM ] 
+        parallel.map(lambda m: self.nodes[m].updateParameters(ix, ro), self.activeM)
+    def calculateELBO(self, weights, ix=None):
+        """Method to calculate variational evidence lower bound
+        If ix is given, the lower bound of the views that implement estimateELBO is estimated from the samples ix
+        """
+        lb = parallel.map(lambda m: self.calculateViewELBO(m, ix) * weights[m], self.activeM)
         return sum(lb)
 
+    def calculateViewELBO(self, m, ix=None):
+        """Method to calculate (or estimate from the samples ix) the lower bound of the node of view m"""
+        if ix is not None and hasattr(self.nodes[m], "estimateELBO"):
+            return self.nodes[m].estimateELBO(ix)
+        return self.nodes[m].calculateELBO()
+
 class Multiview_Constant_Node(Multiview_Node):
     """General class for multiview local nodes"""
     def __init__(self, M, *nodes):
@@ -151,15 +169,15 @@ class Multiview_Mixed_Node(Multiview_Constant_Node, Multiview_Variational_Node):
         Multiview_Node.__init__(self, M, *nodes)
 
     def update(self, ix=None, ro=1.):
-        """Method to update values of the nodes"""
-        for m in self.activeM: self.nodes[m].update(ix, ro)
+        """Method to update values of the nodes (the views are run concurrently if enabled)"""
+        parallel.map(lambda m: self.nodes[m].update(ix, ro), self.activeM)
 
-    def calculateELBO(self, weights):
+    def calculateELBO(self, weights, ix=None):
         """Method to calculate variational evidence lower bound
         The lower bound of a multiview node is the sum of the lower bound of its corresponding single view variational nodes
         """
         lb = 0
-        for m in self.activeM:
-            if isinstance(self.nodes[m],Variational_Node):
-                lb += self.nodes[m].calculateELBO() * weights[m]
+        views = [ m for m in self.activeM if isinstance(self.nodes[m],Variational_Node) ]
+        for x in parallel.map(lambda m: self.calculateViewELBO(m, ix) * weights[m], views):
+            lb += x
         return lb
@@ -15,6 +15,7 @@ from __future__ import division
 import scipy as s
 import numpy.ma as ma
 import numpy as np
+from scipy.sparse import issparse, csr_matrix
 
 from .variational_nodes import Unobserved_Variational_Node, Unobserved_Variational_Mixed_Node
 from .basic_nodes import *
@@ -22,7 +23,8 @@ from .Y_nodes import Y_Node
 from .Tau_nodes import TauD_Node
 
 from mofapy2.core import gpu_utils
-from mofapy2.core.utils import sigmoid, lambdafn
+from mofapy2.core.utils import sigmoid, lambdafn, fill_missing, take_rows, take_mask
+from mofapy2.core.product_cache import dotZW
 
 
 ##############################
@@ -44,7 +46,7 @@ class PseudoY(Unobserved_Variational_Node):
 
         # Initialise observed data
         assert obs.shape == dim, "Problems with the dimensionalities"
-        self.obs = obs
+        self.setData(obs)
 
         # Initialise parameters
         if params is not None:
@@ -53,28 +55,93 @@ class PseudoY(Unobserved_Variational_Node):
         else:
             self.params = {}
 
-        # Create a boolean mask of the data to handle missing values
-        self.mask = ma.getmask( ma.masked_invalid(self.obs) )
-        self.obs[np.isnan(self.obs)] = 0.
-
         # Initialise expectation
         if E is not None:
             assert E.shape == dim, "Problems with the dimensionalities"
-            E[self.mask] = 0.
+            E = self.obs if E is obs else fill_missing(E, self.mask)
         self.E = E
 
+        # Samples of the mini-batch and buffers of the mini-batches (only for stochastic inference)
+        self.mini_ix = None
+        self.mini_batch = None
+        self.mini_mask = None
+        self.buffers = {}
+
+    def __getstate__(self):
+        # the observations and the buffers are not saved with the model (e.g. in the checkpoints), see setData.
+        # The pseudodata and the local parameters are kept: they are variational quantities of the model
+        state = self.__dict__.copy()
+        state['obs'], state['mask'], state['buffers'] = None, None, {}
+        state['mini_ix'], state['mini_batch'], state['mini_mask'] = None, None, None
+        return state
+
+    def setData(self, obs, options=None, mask=None):
+        """ Method to set the observations (also to bind them to a node saved without them, see __getstate__)
+
+        PARAMETERS
+        ----------
+        obs: observed data
+        options: training options (not used)
+        mask (optional): mask of the missing values, if they have already been filled in the observations
+        """
+        # Create a boolean mask of the data to handle missing values
+        # (zeros of sparse matrices are observed values, there are no missing values)
+        if issparse(obs):
+            self.obs = csr_matrix(obs)
+            self.obs.sum_duplicates()
+            self.mask = np.broadcast_to(False, self.obs.shape)
+        elif mask is not None:
+            self.obs, self.mask = obs, mask
+        else:
+            self.mask = ma.getmask( ma.masked_invalid(obs) )
+            self.obs = fill_missing(obs, np.isnan(obs))
+
     def updateParameters(self, ix=None, ro=None):
         pass
 
-    def getMask(self, full=True):
-        # Currently always full as stochastic inference not implemented for Gaussian nodes
-        #TODO: change when implementing SVI for non-Gaussian
-        return self.mask
+    def getMask(self, full=False):
+        """ Get method for the mask """
+        if full or self.mini_ix is None:
+            return self.mask
+        return self.mini_mask
+
+    def getRows(self, X):
+        """ Method to get the rows of the mini-batch of a (N,D) matrix (all rows for full-batch updates) """
+        if self.mini_ix is None:
+            return X
+        return X[self.mini_ix,:]
+
+    def setRows(self, X, values):
+        """ Method to replace the rows of the mini-batch of a (N,D) matrix (the whole matrix for full-batch updates)
+
+        The matrix is copied if it is shared (the observations or a read-only product of the network)
+        """
+        if self.mini_ix is None:
+            return values
+        if X is self.obs or not X.flags.writeable:
+            X = X.copy()
+        X[self.mini_ix,:] = values
+        return X
+
+    def setExpectation(self, E):
+        """ Method to set the pseudodata of the samples of the mini-batch (all samples for full-batch updates) """
+        # regress out feature-wise mean from the pseudodata
+        self.means = ma.getdata(E.mean(axis=0))
+        E -= self.means
+        self.E = self.setRows(self.E, E)
+        if self.mini_ix is not None:
+            self.mini_batch = E
+        self.touch()
 
     def precompute(self, options=None):
         # Precompute some terms to speed up the calculations
         pass
 
+    def astype(self, dtype):
+        self.obs = self.obs.astype(dtype)
+        if self.E is not None: self.E = self.E.astype(dtype, copy=False)
+        for k in self.params.keys(): self.params[k] = s.asarray(self.params[k], dtype=dtype)
+
     def updateExpectations(self):
         print("Error: expectation updates for pseudodata node depend on the type of likelihood. They have to be specified in a new class.")
         exit()
@@ -82,14 +149,20 @@ class PseudoY(Unobserved_Variational_Node):
     def getExpectation(self, expand=True):
         return self.E
 
-    def define_mini_batch(self, ix):
-        """ Method to define a mini-batch (only for stochastic inference) """
-        # self.mini_batch = self.E[ix,:]
-        pass
+    def define_mini_batch(self, ix, rows=None):
+        """ Method to define a mini-batch (only for stochastic inference)
+
+        The local parameters and the pseudodata are only updated for the samples of the mini-batch
+        """
+        self.mini_ix = ix
+        self.mini_mask = take_mask(self.mask, ix, self.buffers, "mask")
+        self.mini_batch = take_rows(self.E, ix, self.buffers, "E")
 
-    # TODO change: define a proper mini-batch !!
     def get_mini_batch(self, expand=True):
-        return self.getExpectation(expand)
+        """ Method to retrieve a mini-batch (only for stochastic inference) """
+        if self.mini_batch is None:
+            return self.getExpectation(expand)
+        return self.mini_batch
 
     def getExpectations(self, expand=True):
         return { 'E':self.getExpectation(expand) }
@@ -121,28 +194,35 @@ class PseudoY_Seeger(PseudoY):
         PseudoY.__init__(self, dim=dim, obs=obs, params=params, E=E)
 
     def updateParameters(self, ix=None, ro=None):
-        Z = self.markov_blanket["Z"].getExpectation()
-        W = self.markov_blanket["W"].getExpectation()
         # self.params["zeta"] = s.dot(Z,W.T)
-        self.params["zeta"] = gpu_utils.dot( gpu_utils.array(Z),gpu_utils.array(W).T )
+        if ix is None:
+            self.params["zeta"] = dotZW(self)
+        else:
+            # only the samples of the mini-batch
+            Z = self.markov_blanket["Z"].get_mini_batch()["E"]
+            W = self.markov_blanket["W"].getExpectation()
+            self.params["zeta"] = self.setRows(self.params["zeta"], s.dot(Z, W.T))
 
 class Tau_Seeger(Constant_Node):
     """
     """
     def __init__(self, dim, value):
         Constant_Node.__init__(self, dim=dim, value=value)
+        self.mini_batch = None
+        self.buffers = {}
 
     def getValue(self):
         return self.value
 
     def define_mini_batch(self, ix):
         """ Method to define a mini-batch (only for stochastic inference) """
-        # self.mini_batch = self.value[ix,:]
-        pass
+        self.mini_batch = take_rows(self.value, ix, self.buffers, "value")
 
-    # TODO change: define a proper min-batch !!
     def get_mini_batch(self, expand=True):
-        return self.getExpectation(expand)
+        """ Method to retrieve a mini-batch (only for stochastic inference) """
+        if self.mini_batch is None:
+            return self.getExpectation(expand)
+        return self.mini_batch
 
     def getExpectation(self, expand=True):
         return self.getValue()
@@ -178,8 +258,9 @@ class Poisson_PseudoY(PseudoY_Seeger):
         PseudoY_Seeger.__init__(self, dim=dim, obs=obs, params=params, E=E)
 
         # Initialise the observed data
-        assert s.all(s.mod(self.obs, 1) == 0), "Data must not contain float numbers, only integers"
-        assert s.all(self.obs >= 0), "Data must not contain negative numbers"
+        obs = self.obs.data if issparse(self.obs) else self.obs
+        assert s.all(s.mod(obs, 1) == 0), "Data must not contain float numbers, only integers"
+        assert s.all(obs >= 0), "Data must not contain negative numbers"
 
     def precompute(self, options):
         self.updateParameters()
@@ -194,14 +275,20 @@ class Poisson_PseudoY(PseudoY_Seeger):
         pass
 
     def updateExpectations(self):
-        # Update the pseudodata
-        tau = self.markov_blanket["Tau"].getValue()
-        self.E = self.params["zeta"] - sigmoid(self.params["zeta"])*(1-self.obs/self.ratefn(self.params["zeta"])) / tau
-        self.E[self.mask] = 0.
-
-        # regress out feature-wise mean from the pseudodata
-        self.means = self.E.mean(axis=0).data
-        self.E -= self.means
+        # Update the pseudodata (of the samples of the mini-batch in stochastic inference)
+        tau = self.markov_blanket["Tau"].get_mini_batch()
+        zeta = self.getRows(self.params["zeta"])
+        obs = self.getRows(self.obs)
+        if issparse(obs):
+            # the term in y/rate(zeta) is only non-zero for the non-zero counts
+            E = zeta - sigmoid(zeta) / tau
+            obs = obs.tocoo()
+            i, j = obs.row, obs.col
+            E[i,j] += sigmoid(zeta[i,j]) * obs.data / (self.ratefn(zeta[i,j]) * tau[i,j])
+        else:
+            E = zeta - sigmoid(zeta)*(1-obs/self.ratefn(zeta)) / tau
+            E[self.getMask()] = 0.
+        self.setExpectation(E)
 
     def calculateELBO(self):
         """ Compute Evidence Lower Bound """
@@ -212,25 +299,34 @@ class Poisson_PseudoY(PseudoY_Seeger):
         Z, ZZ = Ztmp["E"], Ztmp["E2"]
         zeta = self.params["zeta"]
         tau = self.markov_blanket["Tau"].getValue()
-        mask = self.getMask()
+        mask = self.getMask(full=True)
 
         # Precompute terms
-        ZW = Z.dot(W.T)
+        ZW = dotZW(self)
         ZZWW = s.square(ZW) - s.dot(s.square(Z),s.square(W).T) + ZZ.dot(WW.T)
 
         # term1 = 0.5*tau*(ZW - zeta)**2
         term1 = 0.5*tau*(ZZWW - 2*ZW*zeta + s.square(zeta))
-        term2 = (ZW - zeta)*(sigmoid(zeta)*(1.-self.obs/self.ratefn(zeta)))
-        term3 = self.ratefn(zeta) - self.obs*s.log(self.ratefn(zeta))
-
-        elbo = -(term1 + term2 + term3)
+        if issparse(self.obs):
+            # the terms in y are only non-zero for the non-zero counts
+            term2 = (ZW - zeta)*sigmoid(zeta)
+            term3 = self.ratefn(zeta)
+            elbo = -(term1 + term2 + term3)
+            obs = self.obs.tocoo()
+            i, j = obs.row, obs.col
+            rate = self.ratefn(zeta[i,j])
+            elbo[i,j] += (ZW[i,j] - zeta[i,j])*sigmoid(zeta[i,j])*obs.data/rate + obs.data*s.log(rate)
+        else:
+            term2 = (ZW - zeta)*(sigmoid(zeta)*(1.-self.obs/self.ratefn(zeta)))
+            term3 = self.ratefn(zeta) - self.obs*s.log(self.ratefn(zeta))
+            elbo = -(term1 + term2 + term3)
         elbo[mask] = 0.
 
         # I AM NOT SURE WHY NAs are generated...
         np.isnan(elbo).sum()
         elbo[np.isnan(elbo)] = 0.
         
-        return elbo.sum()
+        return elbo.sum(dtype=np.float64)
 
 class Bernoulli_PseudoY(PseudoY_Seeger):
     """
@@ -256,26 +352,21 @@ class Bernoulli_PseudoY(PseudoY_Seeger):
         assert s.all( (self.obs==0) | (self.obs==1) ), "Data must be binary"
 
     def updateExpectations(self):
-        # Update the pseudodata
-        self.E = self.params["zeta"] - 4.*(sigmoid(self.params["zeta"]) - self.obs)
-
-        # regress out feature-wise mean from the pseudodata
-        self.means = self.E.mean(axis=0).data
-        self.E -= self.means
+        # Update the pseudodata (of the samples of the mini-batch in stochastic inference)
+        zeta = self.getRows(self.params["zeta"])
+        self.setExpectation(zeta - 4.*(sigmoid(zeta) - self.getRows(self.obs)))
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        W = self.markov_blanket["W"].getExpectation()
-        mask = self.getMask()
+        mask = self.getMask(full=True)
 
         # tmp = s.dot(Z,W.T)
-        tmp = gpu_utils.asnumpy( gpu_utils.dot( gpu_utils.array(Z),gpu_utils.array(W).T ) )
+        tmp = dotZW(self)
 
         lb = self.obs*tmp - s.log(1.+s.exp(tmp))
         lb[mask] = 0.
 
-        return lb.sum()
+        return lb.sum(dtype=np.float64)
 
 
 ####################
@@ -296,17 +387,33 @@ class Tau_Jaakkola(Node):
             assert value.shape == dim, "Dimensionality mismatch"
             self.value = value
 
+        # Samples of the mini-batch and buffer of the mini-batches (only for stochastic inference)
+        self.mini_ix = None
+        self.mini_batch = None
+        self.buffers = {}
+
     def define_mini_batch(self, ix):
         """ Method to define a mini-batch (only for stochastic inference) """
-        # self.mini_batch = self.E[ix,:]
-        pass
+        self.mini_ix = ix
+        self.mini_batch = take_rows(self.value, ix, self.buffers, "value")
 
-    # TODO change: define a proper mini-batch !!
     def get_mini_batch(self, expand=True):
-        return self.getExpectation(expand)
-        
+        """ Method to retrieve a mini-batch (only for stochastic inference) """
+        if self.mini_batch is None:
+            return self.getExpectation(expand)
+        return self.mini_batch
+
     def updateExpectations(self):
-        self.value = 2*lambdafn(self.markov_blanket["Y"].getParameters()["zeta"])
+        zeta = self.markov_blanket["Y"].getParameters()["zeta"]
+        if self.mini_ix is None:
+            self.value = 2*lambdafn(zeta)
+        else:
+            # only the samples of the mini-batch
+            self.mini_batch = 2*lambdafn(zeta[self.mini_ix,:])
+            self.value[self.mini_ix,:] = self.mini_batch
+
+    def astype(self, dtype):
+        self.value = self.value.astype(dtype, copy=False)
 
     def getValue(self):
         return self.value
@@ -348,16 +455,20 @@ class Bernoulli_PseudoY_Jaakkola(PseudoY):
         self.updateExpectations()
 
     def updateExpectations(self):
-        self.E = (2.*self.obs - 1.)/(4.*lambdafn(self.params["zeta"]))
-
-        # regress out feature-wise mean from the pseudodata
-        self.means = self.E.mean(axis=0).data
-        self.E -= self.means
+        # Update the pseudodata (of the samples of the mini-batch in stochastic inference)
+        self.setExpectation((2.*self.getRows(self.obs) - 1.)/(4.*lambdafn(self.getRows(self.params["zeta"]))))
 
     def updateParameters(self, ix=None, ro=None):
-        Z = self.markov_blanket["Z"].getExpectations()
         W = self.markov_blanket["W"].getExpectations()
-        self.params["zeta"] = s.sqrt(s.square(Z["E"].dot(W["E"].T)) - s.dot(s.square(Z["E"]), s.square(W["E"].T)) + s.dot(Z["E2"],W["E2"].T))
+        if ix is None:
+            Z = self.markov_blanket["Z"].getExpectations()
+            ZW = dotZW(self)
+        else:
+            # only the samples of the mini-batch
+            Z = self.markov_blanket["Z"].get_mini_batch()
+            ZW = s.dot(Z["E"], W["E"].T)
+        zeta = s.sqrt(s.square(ZW) - s.dot(s.square(Z["E"]), s.square(W["E"].T)) + s.dot(Z["E2"],W["E2"].T))
+        self.params["zeta"] = self.setRows(self.params.get("zeta"), zeta)
 
     def calculateELBO(self):
         # Compute Evidence Lower Bound using the lower bound to the likelihood
@@ -367,11 +478,10 @@ class Bernoulli_PseudoY_Jaakkola(PseudoY):
         zeta = self.params["zeta"]
         SW, SWW = Wtmp["E"], Wtmp["E2"]
         Z, ZZ = Ztmp["E"], Ztmp["E2"]
-        mask = self.getMask()
+        mask = self.getMask(full=True)
 
         # calculate E(Z)E(W)
-        ZW = Z.dot(SW.T)
-        ZW[mask] = 0.
+        ZW = s.where(mask, 0., dotZW(self))
 
         # Calculate E[(ZW_nd)^2]
         # this is equal to E[\sum_{k != k} z_k w_k z_k' w_k'] + E[\sum_{k} z_k^2 w_k^2]
@@ -387,7 +497,7 @@ class Bernoulli_PseudoY_Jaakkola(PseudoY):
         lb = term1 + term2 + term3
         lb[mask] = 0.
 
-        return lb.sum()
+        return lb.sum(dtype=np.float64)
 
 #-------------------------------------------------------------------------------
 # Zero inflated data: mixed node implementation
@@ -462,6 +572,7 @@ class Zero_Inflated_PseudoY_Jaakkola(Unobserved_Variational_Mixed_Node):
 
     def updateExpectations(self):
         self.jaakola_node.updateExpectations()
+        self.touch()
 
     def getExpectation(self, expand=True):
         E = self.normal_node.getExpectation().copy()
@@ -538,11 +649,9 @@ class Zero_Inflated_Tau_Jaakkola(Unobserved_Variational_Mixed_Node):
         E = self.tau_normal.getExpectations(expand=True)
         tau_jk = self.tau_jaakola.getExpectations(expand=True)
 
-        # Merge
+        # Merge (the expectations of the normal tau are read-only expansions)
         zeros = self.markov_blanket['Y'].zeros
-        E['E'][zeros], E['lnE'][zeros] = tau_jk['E'][zeros], tau_jk['lnE'][zeros]
-
-        return E
+        return {'E': s.where(zeros, tau_jk['E'], E['E']), 'lnE': s.where(zeros, tau_jk['lnE'], E['lnE'])}
 
     def getExpectation(self, expand=True):
         return self.getExpectations(expand)['E']
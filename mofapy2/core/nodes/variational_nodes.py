@@ -1,6 +1,7 @@
 
 from __future__ import division
 import scipy as s
+import numpy as np
 
 from .basic_nodes import *
 from mofapy2.core.distributions import *
@@ -57,6 +58,7 @@ class Unobserved_Variational_Node(Variational_Node):
     def updateExpectations(self, dist="Q"):
         # Method to update expectations of the node
         if dist == "Q": self.Q.updateExpectations()
+        self.touch()
 
     def getExpectation(self, dist="Q"):
         # Method to get the first moment (expectation) of the node
@@ -76,15 +78,38 @@ class Unobserved_Variational_Node(Variational_Node):
         elif dist == "P": params = self.P.getParameters()
         return params
 
+    def expandGroups(self, name, X):
+        """ Method to expand an expectation defined per group (G,K) to the samples (N,K), using the groups of the node
+
+        The expansion is read-only: a broadcast view if there is a single group, and otherwise a copy
+        that is kept until the expectations of the node change
+        """
+        if self.n_groups == 1:
+            return np.broadcast_to(X, (len(self.groups),) + X.shape[1:])
+        if self.expanded is None:
+            self.expanded = {}
+        if name not in self.expanded or self.expanded[name][0] is not X:
+            Xexp = X[self.groups,:]
+            Xexp.setflags(write=False)
+            self.expanded[name] = (X, Xexp)
+        return self.expanded[name][1]
+
+    def astype(self, dtype):
+        """ Method to cast the P and Q distributions to a given floating point precision """
+        self.P.astype(dtype)
+        self.Q.astype(dtype)
+
     def removeFactors(self, idx, axis=None):
         # Method to remove entire factors from the nodes
 
         if hasattr(self,"factors_axis"): axis = self.factors_axis
         if hasattr(self,"covariates"): self.covariates = self.covariates[s.arange(len(self.covariates)) != idx]
         if axis is not None:
-            self.P.removeDimensions(axis=axis, idx=idx)
-            self.Q.removeDimensions(axis=axis, idx=idx)
+            memo = {}
+            self.P.removeDimensions(axis=axis, idx=idx, memo=memo)
+            self.Q.removeDimensions(axis=axis, idx=idx, memo=memo)
             self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
+            self.touch()
 
     def sample(self, distrib='P'):
         self.samp = self.P.sample()
@@ -107,6 +132,14 @@ class Unobserved_Variational_Mixed_Node(Variational_Node):
         for node in self.nodes:
             node.precompute(options)
 
+    def astype(self, dtype):
+        for node in self.nodes:
+            node.astype(dtype)
+
+    def setCache(self, cache):
+        for node in self.nodes:
+            node.setCache(cache)
+
 #######################################################
 ## Specific classes for unobserved variational nodes ##
 #######################################################
@@ -0,0 +1,80 @@
+"""
+Module to run the computations of the views concurrently in a pool of threads (numpy and BLAS release the GIL)
+"""
+
+import os
+import sys
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from threadpoolctl import ThreadpoolController
+except ImportError:
+    ThreadpoolController = None
+
+# --------------------------------------------------------
+# Default is to run the views sequentially
+# --------------------------------------------------------
+executor = None
+controller = None
+blas_threads = None
+local = threading.local()
+
+def setup(n_threads=1):
+    """ Method to set up the pool of threads used to run the views
+
+    PARAMETERS
+    ----------
+    n_threads: int
+        number of views to run concurrently (1 to run them sequentially)
+    """
+    global executor, controller, blas_threads
+    shutdown()
+    if n_threads > 1:
+        # the BLAS libraries are limited to their share of the cores while the pool is busy
+        executor = ThreadPoolExecutor(max_workers=n_threads)
+        blas_threads = max(1, (os.cpu_count() or 1) // n_threads)
+        if ThreadpoolController is not None:
+            controller = ThreadpoolController()
+        else:
+            print("Warning: threadpoolctl is not installed, the number of BLAS threads can not be limited while the views run concurrently")
+            sys.stdout.flush()
+
+def shutdown():
+    """ Method to release the pool of threads """
+    global executor, controller
+    if executor is not None:
+        executor.shutdown()
+    executor = None
+    controller = None
+
+def blas_limits(n):
+    """ Method to limit the number of BLAS threads within a context (does nothing without threadpoolctl) """
+    if ThreadpoolController is None:
+        return contextlib.nullcontext()
+    return ThreadpoolController().limit(limits=n, user_api="blas")
+
+def _run(f, x):
+    local.busy = True
+    try:
+        return f(x)
+    finally:
+        local.busy = False
+
+def map(f, items):
+    """ Method to apply a function to each view, concurrently if a pool of threads is set up
+
+    PARAMETERS
+    ----------
+    f: function
+    items: indices of the views (the results are returned in the same order)
+    """
+    items = list(items)
+    # calls from within the pool are run sequentially
+    if executor is None or len(items) < 2 or getattr(local, "busy", False):
+        return [ f(x) for x in items ]
+    if controller is None:
+        return list(executor.map(_run, [f]*len(items), items))
+    with controller.limit(limits=blas_threads, user_api="blas"):
+        return list(executor.map(_run, [f]*len(items), items))
@@ -0,0 +1,65 @@
+"""
+Module to share the products E[Z]E[W]^T of each view between the nodes of a Bayesian network, until Z or W are updated
+"""
+
+import threading
+
+from mofapy2.core import gpu_utils
+
+
+def dotZW(node):
+    """ Method to compute E[Z]E[W]^T for a single-view node, from the cache of the network if there is one (read-only)
+
+    PARAMETERS
+    ----------
+    node: node with Z and W in its markov blanket
+    """
+    Z, W = node.markov_blanket["Z"], node.markov_blanket["W"]
+    if node.cache is None:
+        return gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(Z.getExpectation()), gpu_utils.array(W.getExpectation()).T))
+    return node.cache.dotZW(Z, W)
+
+
+class ProductCache(object):
+    """ Cache of the products E[Z]E[W]^T of each view """
+    def __init__(self):
+        self.products = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # the products and the lock are not pickled (e.g. to send a trained model between processes)
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def dotZW(self, Z, W):
+        """ Method to get the product E[Z]E[W]^T, computed once per version of the nodes
+
+        PARAMETERS
+        ----------
+        Z: node of the factors
+        W: node of the weights of a single view
+        """
+        key = id(W)
+        versions = (Z.version, W.version)
+        with self.lock:
+            entry = self.products.get(key)
+        if entry is None or entry[2] != versions:
+            ZW = gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(Z.getExpectation()), gpu_utils.array(W.getExpectation()).T))
+            ZW.setflags(write=False)
+            entry = (Z, W, versions, ZW)
+            with self.lock:
+                self.products[key] = entry
+        return entry[3]
+
+    def invalidate(self, node):
+        """ Method to release the products that depend on a node """
+        with self.lock:
+            for key in [ k for k, v in self.products.items() if v[0] is node or v[1] is node ]:
+                del self.products[key]
+
+    def clear(self):
+        """ Method to release all products """
+        with self.lock:
+            self.products = {}
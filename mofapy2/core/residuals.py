@@ -0,0 +1,432 @@
+"""
+Module to keep track of the tau-weighted residuals of a view, tau*(Y - ZW^T)
+
+The coordinate updates of the factors and the weights (Z, SZ, W and SW nodes) need, for each factor k,
+the predictions of the data using all factors but k. Instead of recomputing Z[:,-k]W[:,-k]^T for every factor
+(O(NDK^2) per sweep), the residuals are computed once at the beginning of the update and corrected with a
+rank-one term every time a factor (or the corresponding weights) changes (O(NDK) per sweep).
+
+For Gaussian views where a group of samples is fully observed the precision is constant across the samples
+of the group, and the projections of the residuals only depend on the sufficient statistics YW, Y^TZ, W^TW
+and Z^TZ of the group. In that case the residuals are never formed explicitly (see GroupResiduals).
+
+For views with a large fraction of missing values, the partially observed groups can be stored as lists of
+observed entries (see ObservedEntries), so that the cost of the updates scales with the number of observations
+instead of N*D.
+
+For views stored on disk (see DiskView) the products with the data are computed by streaming blocks of samples,
+so that only (N,K) and (D,K) matrices are kept in memory.
+"""
+
+import numpy as np
+import scipy as s
+from scipy.sparse import issparse, csr_matrix
+
+from mofapy2.core import gpu_utils
+from mofapy2.core.utils import group_slices, group_counts
+from mofapy2.core.disk_data import DiskView
+
+
+def get_residuals(Y, Tau, Z, W, ix=None, weights=None):
+    """ Method to build the residuals of a single view
+
+    PARAMETERS
+    ----------
+    Y: Y_Node or PseudoY node of the view
+    Tau: noise node of the view
+    Z: ndarray (N,K)
+        expectation of the factors (subset to the mini-batch in stochastic inference)
+    W: ndarray (D,K)
+        expectation of the weights
+    ix: list of indices of the minibatch (None for full-batch updates)
+    weights: weights of the samples of the minibatch (see Z_Node.define_mini_batch), None if they all have the same weight
+    """
+    stats = Y.stats if hasattr(Y, "stats") else None
+    if hasattr(stats, "residuals"):
+        # statistics of samples held by other processes (see distributed.ShardedStatistics)
+        return stats.residuals()
+    if ix is None and stats is not None:
+        return GroupResiduals(stats, Tau.getExpectation(expand=False), Z, W)
+
+    tau = s.where(Y.getMask(), 0., Tau.get_mini_batch())
+    if weights is not None:
+        tau *= weights[:,None]
+    return Residuals(Y.get_mini_batch(), tau, Z, W)
+
+
+class Residuals(object):
+    """ Tau-weighted residuals of a single view
+
+    PARAMETERS
+    ----------
+    Y: ndarray (N,D)
+        observations (or pseudodata)
+    tau: ndarray (N,D)
+        precision of the noise, with missing values set to zero
+    Z: ndarray (N,K)
+        expectation of the factors
+    W: ndarray (D,K)
+        expectation of the weights
+    """
+    def __init__(self, Y, tau, Z, W):
+        self.Z = s.array(Z)
+        self.W = s.array(W)
+        self.tau = gpu_utils.array(tau)
+        self.tauR = self.tau * (gpu_utils.array(Y) - gpu_utils.dot(gpu_utils.array(Z), gpu_utils.array(W).T))
+
+    def tauDotW(self, A):
+        """ Method to compute tau·A for a (D,K) matrix A, (N,K) """
+        return gpu_utils.asnumpy(gpu_utils.dot(self.tau, gpu_utils.array(A)))
+
+    def tauDotZ(self, A):
+        """ Method to compute tau^T·A for a (N,K) matrix A, (D,K) """
+        return gpu_utils.asnumpy(gpu_utils.dot(self.tau.T, gpu_utils.array(A)))
+
+    def dotW(self, k):
+        """ Method to project the residuals on the weights of factor k, tauR·W[:,k] (N,) """
+        return gpu_utils.asnumpy(gpu_utils.dot(self.tauR, gpu_utils.array(self.W[:,k])))
+
+    def dotZ(self, k):
+        """ Method to project the residuals on the values of factor k, Z[:,k]·tauR (D,) """
+        return gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(self.Z[:,k]), self.tauR))
+
+    def updateZ(self, k, z):
+        """ Method to replace the values of factor k with a rank-one correction of the residuals """
+        self.tauR -= self.tau * gpu_utils.outer(gpu_utils.array(z - self.Z[:,k]), gpu_utils.array(self.W[:,k]))
+        self.Z[:,k] = z
+
+    def updateW(self, k, w):
+        """ Method to replace the weights of factor k with a rank-one correction of the residuals """
+        self.tauR -= self.tau * gpu_utils.outer(gpu_utils.array(self.Z[:,k]), gpu_utils.array(w - self.W[:,k]))
+        self.W[:,k] = w
+
+
+class ObservedEntries(object):
+    """ Observed entries of a subset of samples, stored as (row, column, value) triplets sorted by row
+
+    PARAMETERS
+    ----------
+    Y: ndarray (N,D)
+        observations
+    mask: ndarray (N,D)
+        missing values
+    idx: ndarray
+        indices of the samples
+    """
+    def __init__(self, Y, mask, idx):
+        self.shape = (len(idx), Y.shape[1])
+        self.rows, self.cols = s.nonzero(~mask[idx,:])
+        self.values = Y[idx[self.rows], self.cols]
+        self.indptr = s.concatenate([[0], s.cumsum(s.bincount(self.rows, minlength=len(idx)))])
+
+    def matrix(self, data):
+        """ Method to build a sparse (N,D) matrix with the given values at the observed entries """
+        return csr_matrix((data, self.cols, self.indptr), shape=self.shape)
+
+    def predict(self, Z, W, block_size=8192):
+        """ Method to compute ZW^T at the observed entries (by blocks of entries, to stay in cache) """
+        out = s.empty(len(self.rows), dtype=Z.dtype)
+        for i in range(0, len(self.rows), block_size):
+            out[i:i+block_size] = s.einsum('ij,ij->i', Z[self.rows[i:i+block_size],:], W[self.cols[i:i+block_size],:])
+        return out
+
+    def squaredErrors(self, Z, ZZ, W, WW):
+        """ Method to compute the expected squared errors E[(y_nd - z_n w_d)^2] at the observed entries """
+        ZW = self.predict(Z, W)
+        return s.square(self.values) + self.predict(ZZ, WW) - self.predict(s.square(Z), s.square(W)) \
+            + s.square(ZW) - 2.*ZW*self.values
+
+
+class ObservedResiduals(object):
+    """ Tau-weighted residuals of a view, evaluated only at the observed entries
+
+    PARAMETERS
+    ----------
+    entries: ObservedEntries
+        observed entries of the samples
+    tau: ndarray
+        precision of the noise at the observed entries
+    Z: ndarray (N,K)
+        expectation of the factors
+    W: ndarray (D,K)
+        expectation of the weights
+    """
+    def __init__(self, entries, tau, Z, W):
+        self.entries = entries
+        self.Z = s.array(Z)
+        self.W = s.array(W)
+        self.tau = entries.matrix(tau)
+        self.tauR = entries.matrix(tau * (entries.values - entries.predict(Z, W)))
+
+    def tauDotW(self, A):
+        """ Method to compute tau·A for a (D,K) matrix A, (N,K) """
+        return self.tau.dot(A)
+
+    def tauDotZ(self, A):
+        """ Method to compute tau^T·A for a (N,K) matrix A, (D,K) """
+        return self.tau.T.dot(A)
+
+    def dotW(self, k):
+        """ Method to project the residuals on the weights of factor k, tauR·W[:,k] (N,) """
+        return self.tauR.dot(self.W[:,k])
+
+    def dotZ(self, k):
+        """ Method to project the residuals on the values of factor k, Z[:,k]·tauR (D,) """
+        return self.tauR.T.dot(self.Z[:,k])
+
+    def updateZ(self, k, z):
+        """ Method to replace the values of factor k with a rank-one correction of the residuals """
+        self.tauR.data -= self.tau.data * (z - self.Z[:,k])[self.entries.rows] * self.W[self.entries.cols,k]
+        self.Z[:,k] = z
+
+    def updateW(self, k, w):
+        """ Method to replace the weights of factor k with a rank-one correction of the residuals """
+        self.tauR.data -= self.tau.data * self.Z[self.entries.rows,k] * (w - self.W[:,k])[self.entries.cols]
+        self.W[:,k] = w
+
+
+class SufficientStatistics(object):
+    """ Constant statistics of a Gaussian view, used to avoid (N,D) computations in the fully observed groups
+
+    Sparse views (scipy.sparse matrices, where zeros are observed values) are always fully observed and are
+    never densified: they are centered implicitly, using the feature means per group as offsets.
+
+    Views stored on disk (DiskView) only have missing values for entire samples, which are left out of the samples
+    of their group, and the products with the data are computed by blocks of samples.
+
+    PARAMETERS
+    ----------
+    Y: ndarray, sparse matrix or DiskView (N,D)
+        observations, with missing values set to zero
+    mask: ndarray (N,D)
+        missing values
+    groups: ndarray (N,)
+        group of each sample
+    observed: bool
+        store the partially observed groups as lists of observed entries
+    """
+    def __init__(self, Y, mask, groups, observed=False):
+        self.sparse = issparse(Y)
+        self.disk = isinstance(Y, DiskView)
+        self.Y = csr_matrix(Y) if self.sparse else Y
+        self.mask = mask
+        self.groups = groups
+        self.n_groups = len(np.unique(groups))
+
+        # Samples of each group (slices if the groups are contiguous)
+        self.samples = group_slices(groups, self.n_groups)
+        if self.disk and Y.missing.any():
+            # the samples without observations are left out
+            self.samples = [ s.arange(len(groups))[idx][~Y.missing[idx]] for idx in self.samples ]
+        self.n_samples = group_counts(self.samples)
+        if self.sparse or self.disk:
+            n_missing = [0] * self.n_groups
+        else:
+            n_missing = [ mask[idx,:].sum() for idx in self.samples ]
+
+        # Fully observed groups use the statistics, partially observed groups use the explicit residuals
+        # and fully missing groups do not contribute
+        self.complete = [ g for g in range(self.n_groups) if n_missing[g]==0 and self.n_samples[g]>0 ]
+        self.partial = [ g for g in range(self.n_groups) if 0<n_missing[g]<mask[self.samples[g],:].size ]
+        self.partial_samples = s.concatenate([s.arange(len(groups))[self.samples[g]] for g in self.partial] + [s.zeros(0, dtype=int)])
+
+        # Observed entries of the partially observed groups
+        self.observed = None
+        if observed and len(self.partial) > 0:
+            self.observed = ObservedEntries(Y, mask, self.partial_samples)
+            self.observed_groups = groups[self.partial_samples][self.observed.rows]
+
+        # Offsets, number of observations and sum of squares per group and feature
+        D = Y.shape[1]
+        self.offsets = s.zeros((self.n_groups, D), dtype=Y.dtype)
+        self.n_obs = s.zeros((self.n_groups, D))
+        self.YY = s.zeros((self.n_groups, D))
+        for g in range(self.n_groups):
+            idx = self.samples[g]
+            if self.sparse:
+                Yg = self.Y[idx,:]
+                self.offsets[g,:] = np.asarray(Yg.mean(axis=0)).flatten()
+                self.n_obs[g,:] = self.n_samples[g]
+                self.YY[g,:] = np.asarray(Yg.multiply(Yg).sum(axis=0)).flatten() - self.n_samples[g]*s.square(self.offsets[g,:])
+            elif self.disk:
+                self.n_obs[g,:] = self.n_samples[g]
+                for _, Yb in Y.blocks(idx):
+                    self.YY[g,:] += s.square(Yb).sum(axis=0)
+            else:
+                self.n_obs[g,:] = (~mask[idx,:]).sum(axis=0)
+                if g in self.complete:
+                    self.YY[g,:] = s.square(Y[idx,:]).sum(axis=0)
+
+    def setOffsets(self, offsets):
+        """ Method to center the observations of a sparse view with the given offsets per group and feature, e.g. the
+        means of the groups in all the samples for the model of a shard of samples """
+        for g in range(self.n_groups):
+            Yg = self.Y[self.samples[g],:]
+            self.YY[g,:] = np.asarray(Yg.multiply(Yg).sum(axis=0)).flatten() \
+                - 2.*offsets[g,:]*np.asarray(Yg.sum(axis=0)).flatten() + self.n_samples[g]*s.square(offsets[g,:])
+        self.offsets = s.array(offsets, dtype=self.offsets.dtype)
+
+    def getSamples(self, g):
+        """ Method to get the (dense) observations of a group """
+        return self.getDense(self.samples[g])
+
+    def getDense(self, ix):
+        """ Method to get the (dense) observations of a subset of samples """
+        if self.sparse:
+            return self.Y[ix,:].toarray() - self.offsets[self.groups[ix],:]
+        return self.Y[ix,:]
+
+    def dotY(self, g, A):
+        """ Method to compute Y_g·A for a (D,K) matrix A, (N_g,K) """
+        idx = self.samples[g]
+        if self.sparse:
+            return self.Y[idx,:].dot(A) - s.dot(self.offsets[g,:], A)[None,:]
+        if self.disk:
+            out = s.empty((group_counts([idx])[0], A.shape[1]), dtype=A.dtype)
+            for b, Yb in self.Y.blocks(idx):
+                out[b,:] = s.dot(Yb, A)
+            return out
+        return gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(self.Y[idx,:]), gpu_utils.array(A)))
+
+    def tdotY(self, g, A):
+        """ Method to compute Y_g^T·A for a (N_g,K) matrix A, (D,K) """
+        idx = self.samples[g]
+        if self.sparse:
+            return self.Y[idx,:].T.dot(A) - s.outer(self.offsets[g,:], A.sum(axis=0))
+        if self.disk:
+            out = s.zeros((self.Y.shape[1], A.shape[1]), dtype=A.dtype)
+            for b, Yb in self.Y.blocks(idx):
+                out += s.dot(Yb.T, A[b,:])
+            return out
+        return gpu_utils.asnumpy(gpu_utils.dot(gpu_utils.array(self.Y[idx,:]).T, gpu_utils.array(A)))
+
+    def sumSquaredResiduals(self, g, Z, W):
+        """ Method to compute the residual sum of squares of a fully observed group, sum (y_nd - z_n w_d)^2 """
+        Zg = Z[self.samples[g],:]
+        return self.YY[g,:].sum() - 2.*(W*self.tdotY(g, Zg)).sum() + (s.dot(W.T, W)*s.dot(Zg.T, Zg)).sum()
+
+    def sumSquaredErrors(self, Z, ZZ, W, WW):
+        """ Method to compute the expected sum of squared errors per group and feature, sum_n E[(y_nd - z_n w_d)^2] (G,D) """
+        sse = s.zeros((self.n_groups, W.shape[0]))
+        for g in self.complete:
+            idx = self.samples[g]
+            YtZ = self.tdotY(g, Z[idx,:])
+            ZtZ = s.dot(Z[idx,:].T, Z[idx,:])
+            sse[g,:] = self.YY[g,:] - 2.*(W*YtZ).sum(axis=1) + (s.dot(W, ZtZ)*W).sum(axis=1) \
+                + s.dot(WW, ZZ[idx,:].sum(axis=0)) - s.dot(s.square(W), s.square(Z[idx,:]).sum(axis=0))
+        if self.observed is not None:
+            idx = self.partial_samples
+            tmp = self.observed.squaredErrors(Z[idx,:], ZZ[idx,:], W, WW)
+            sse += s.bincount(self.observed_groups*W.shape[0] + self.observed.cols, weights=tmp,
+                minlength=self.n_groups*W.shape[0]).reshape(self.n_groups, W.shape[0])
+            return sse
+        for g in self.partial:
+            idx = self.samples[g]
+            Yg = self.getSamples(g)
+            ZW = s.dot(Z[idx,:], W.T)
+            tmp = s.square(Yg) + s.dot(ZZ[idx,:], WW.T) - s.dot(s.square(Z[idx,:]), s.square(W.T)) + s.square(ZW) - 2*ZW*Yg
+            tmp[self.mask[idx,:]] = 0.
+            sse[g,:] = tmp.sum(axis=0)
+        return sse
+
+
+class GroupResiduals(object):
+    """ Tau-weighted residuals of a Gaussian view, obtained from the sufficient statistics of the fully observed groups
+
+    PARAMETERS
+    ----------
+    stats: SufficientStatistics
+        statistics of the view
+    tau: ndarray (G,D)
+        precision of the noise per group and feature
+    Z: ndarray (N,K)
+        expectation of the factors
+    W: ndarray (D,K)
+        expectation of the weights
+    """
+    def __init__(self, stats, tau, Z, W):
+        self.stats = stats
+        self.tau = tau
+        self.Z = s.array(Z)
+        self.W = s.array(W)
+
+        # Projections of the residuals on W and on Z (computed when needed)
+        self.YtW, self.WtW = None, None
+        self.YtZ, self.ZtZ = None, None
+
+        # Explicit residuals for the partially observed groups
+        self.partial = None
+        if stats.observed is not None:
+            idx = stats.partial_samples
+            tau_partial = tau[stats.observed_groups, stats.observed.cols]
+            self.partial = ObservedResiduals(stats.observed, tau_partial, Z[idx,:], W)
+        elif len(stats.partial) > 0:
+            idx = stats.partial_samples
+            tau_partial = tau[stats.groups[idx],:]
+            tau_partial[stats.mask[idx,:]] = 0.
+            self.partial = Residuals(stats.getDense(idx), tau_partial, Z[idx,:], W)
+
+    def tauDotW(self, A):
+        """ Method to compute tau·A for a (D,K) matrix A, (N,K) """
+        out = s.zeros((self.Z.shape[0], A.shape[1]), dtype=A.dtype)
+        for g in self.stats.complete:
+            out[self.stats.samples[g],:] = s.dot(self.tau[g,:], A)
+        if self.partial is not None:
+            out[self.stats.partial_samples,:] = self.partial.tauDotW(A)
+        return out
+
+    def tauDotZ(self, A):
+        """ Method to compute tau^T·A for a (N,K) matrix A, (D,K) """
+        out = s.zeros((self.W.shape[0], A.shape[1]), dtype=A.dtype)
+        for g in self.stats.complete:
+            out += s.outer(self.tau[g,:], A[self.stats.samples[g],:].sum(axis=0))
+        if self.partial is not None:
+            out += self.partial.tauDotZ(A[self.stats.partial_samples,:])
+        return out
+
+    def dotW(self, k):
+        """ Method to project the residuals on the weights of factor k, tauR·W[:,k] (N,) """
+        if self.YtW is None:
+            self.YtW, self.WtW = {}, {}
+            for g in self.stats.complete:
+                tauW = self.tau[g,:][:,None] * self.W
+                self.YtW[g] = self.stats.dotY(g, tauW)
+                self.WtW[g] = s.dot(tauW.T, self.W)
+
+        out = s.zeros(self.Z.shape[0], dtype=self.Z.dtype)
+        for g in self.stats.complete:
+            idx = self.stats.samples[g]
+            out[idx] = self.YtW[g][:,k] - s.dot(self.Z[idx,:], self.WtW[g][:,k])
+        if self.partial is not None:
+            out[self.stats.partial_samples] = self.partial.dotW(k)
+        return out
+
+    def dotZ(self, k):
+        """ Method to project the residuals on the values of factor k, Z[:,k]·tauR (D,) """
+        if self.YtZ is None:
+            self.YtZ, self.ZtZ = {}, {}
+            for g in self.stats.complete:
+                Zg = self.Z[self.stats.samples[g],:]
+                self.YtZ[g] = self.stats.tdotY(g, Zg)
+                self.ZtZ[g] = s.dot(Zg.T, Zg)
+
+        out = s.zeros(self.W.shape[0], dtype=self.W.dtype)
+        for g in self.stats.complete:
+            out += self.tau[g,:] * (self.YtZ[g][:,k] - s.dot(self.W, self.ZtZ[g][:,k]))
+        if self.partial is not None:
+            out += self.partial.dotZ(k)
+        return out
+
+    def updateZ(self, k, z):
+        """ Method to replace the values of factor k """
+        if self.partial is not None:
+            self.partial.updateZ(k, z[self.stats.partial_samples])
+        self.Z[:,k] = z
+        self.YtZ, self.ZtZ = None, None
+
+    def updateW(self, k, w):
+        """ Method to replace the weights of factor k """
+        if self.partial is not None:
+            self.partial.updateW(k, w)
+        self.W[:,k] = w
+        self.YtW, self.WtW = None, None
@@ -0,0 +1,138 @@
+"""
+Module to share the data of the views between processes without copying it
+
+Dense views are stored in a block of shared memory each, and scipy.sparse views as the three arrays of the CSR format.
+The processes attach to the blocks by name and get read-only arrays backed by the shared memory. Views stored on disk
+(DiskView) are passed by reference and read by each process.
+
+The views can also be split into shards of samples and/or features (share_shards), each shard in its own blocks, so that
+the process holding a shard uses its blocks without copying them, and the process that shared them can gather the
+views back shard by shard (gather).
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+from scipy.sparse import issparse, csr_matrix
+
+from mofapy2.core.disk_data import DiskView
+
+
+def _share_array(X, blocks, rows=None, cols=None):
+    """ Method to copy an array (or its rows and its columns cols) to a new block of shared memory """
+    if cols is not None:
+        X = X[:,cols]
+    shape = X.shape if rows is None else (len(rows),) + X.shape[1:]
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*X.itemsize, 1))
+    out = np.ndarray(shape, dtype=X.dtype, buffer=shm.buf)
+    if rows is None:
+        out[...] = X
+    else:
+        np.take(X, rows, axis=0, out=out)
+    blocks.append(shm)
+    return (shm.name, shape, X.dtype.str)
+
+def _attach_array(spec, blocks):
+    """ Method to get a read-only array backed by a block of shared memory """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    blocks.append(shm)
+    X = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    X.setflags(write=False)
+    return X
+
+def _share_view(Y, blocks, rows=None, cols=None):
+    """ Method to copy a view (or its samples rows and its features cols) to shared memory, returns its description """
+    if Y is None:
+        return ("none", None, None)
+    if isinstance(Y, DiskView):
+        return ("disk", Y.shape, Y)
+    if issparse(Y):
+        Y = csr_matrix(Y)
+        if cols is not None: Y = Y[:,cols]
+        if rows is not None: Y = Y[rows,:]
+        return ("csr", Y.shape, [ _share_array(x, blocks) for x in (Y.data, Y.indices, Y.indptr) ])
+    spec = _share_array(Y, blocks, rows, cols)
+    return ("dense", spec[1], spec)
+
+def share(data):
+    """ Method to copy the views to shared memory
+
+    PARAMETERS
+    ----------
+    data: list of ndarrays, scipy.sparse matrices or DiskViews, one per view (None entries are kept)
+
+    Returns the blocks of shared memory, which have to be released with release(blocks, unlink=True) once the
+    processes are done, and the picklable description of the views to be passed to attach()
+    """
+    blocks = []
+    specs = [ _share_view(Y, blocks) for Y in data ]
+    return blocks, specs
+
+def share_shards(data, shards):
+    """ Method to copy the shards of the views to shared memory, each shard in its own blocks
+
+    PARAMETERS
+    ----------
+    data: list of ndarrays, scipy.sparse matrices or DiskViews (None entries are kept)
+    shards: list with the samples (indices) and the features of each view (slices, or None for all the features) of
+        each shard
+
+    Returns the blocks of shared memory of each shard (see share) and the description of the views of each shard. The
+    views of a shard only hold its samples and features, except the DiskViews that are passed by reference
+    """
+    blocks, specs = [], []
+    for rows, cols in shards:
+        if cols is None: cols = [None] * len(data)
+        blocks.append([])
+        specs.append([ _share_view(Y, blocks[-1], rows, c) for Y, c in zip(data, cols) ])
+    return blocks, specs
+
+def gather(data, shapes, shards, specs, blocks):
+    """ Method to copy the dense views shared by shards (see share_shards) back to arrays of the process, freeing the
+    blocks of each shard once it is copied
+
+    PARAMETERS
+    ----------
+    data: list of the views that were shared, with None for the dense views to gather
+    shapes: shape of each view
+    shards, specs, blocks: shards given to share_shards and its output
+
+    Returns the list of the views, with the dense views gathered (the other views of data are kept)
+    """
+    out = list(data)
+    for (rows, cols), spec, shm in zip(shards, specs, blocks):
+        if cols is None: cols = [None] * len(data)
+        attached, views = attach(spec)
+        for i, (X, c) in enumerate(zip(views, cols)):
+            if data[i] is not None or spec[i][0] != "dense": continue
+            if out[i] is None: out[i] = np.empty(shapes[i], dtype=X.dtype)
+            (out[i] if c is None else out[i][:,c])[rows] = X
+        views = X = None
+        release(attached)
+        release(shm, unlink=True)
+        del shm[:]
+    return out
+
+def attach(specs):
+    """ Method to get the views from their description in shared memory
+
+    Returns the blocks of shared memory, which have to be released with release(blocks) once the views are not used
+    anymore, and the list of read-only views
+    """
+    blocks, data = [], []
+    for kind, shape, spec in specs:
+        if kind == "none":
+            data.append(None)
+        elif kind == "disk":
+            data.append(spec)
+        elif kind == "csr":
+            data.append(csr_matrix(tuple( _attach_array(x, blocks) for x in spec ), shape=shape))
+        else:
+            data.append(_attach_array(spec, blocks))
+    return blocks, data
+
+def release(blocks, unlink=False):
+    """ Method to close the blocks of shared memory (and to free them, by the process that created them) """
+    for shm in blocks:
+        shm.close()
+        if unlink: shm.unlink()
@@ -125,6 +125,104 @@ def corr(A,B):
     return np.dot(A_mA, B_mB.T)/np.sqrt(np.dot(ssA[:,None],ssB[None]))
 
 
+def group_slices(groups, n_groups=None, names=None):
+    """ Method to get the samples of each group, as slices if the samples of every group are contiguous
+    (which is the layout created by the entry point) and as arrays of indices otherwise
+
+    PARAMETERS
+    ---------
+    groups: array with the group of each sample, either integers from 0 to G-1 or names
+    n_groups: number of groups (by default the largest group plus one)
+    names: list with the names of the groups, if the groups are given by names
+    """
+    if names is not None:
+        groups = pd.Index(names).get_indexer(np.asarray(groups))
+        n_groups = len(names)
+    groups = np.asarray(groups, dtype=int)
+    G = n_groups if n_groups is not None else (groups.max()+1 if len(groups) > 0 else 0)
+
+    # Runs of consecutive samples from the same group
+    starts = np.flatnonzero(np.diff(groups, prepend=-1) != 0)
+    if len(starts) == len(np.unique(groups)):
+        idx = [ slice(0,0) for g in range(G) ]
+        ends = np.append(starts[1:], len(groups))
+        for i, j in zip(starts, ends):
+            idx[groups[i]] = slice(int(i), int(j))
+        return idx
+    return [ np.flatnonzero(groups==g) for g in range(G) ]
+
+def fill_missing(X, mask, value=0.):
+    """ Method to fill the missing values of a matrix, in place unless the matrix is read-only (e.g. shared between processes) """
+    if not mask.any():
+        return X
+    if X.flags.writeable:
+        X[mask] = value
+        return X
+    return np.where(mask, value, X)
+
+def take_rows(X, ix, buffers, key):
+    """ Method to gather some rows of a matrix into a buffer that is reused across calls (e.g. for the mini-batches of
+    stochastic inference), instead of allocating a new matrix every time
+
+    PARAMETERS
+    ---------
+    X: np array
+    ix: indices of the rows
+    buffers: dictionary with the buffers of the caller
+    key: name of the buffer in the dictionary (it is reallocated if it is too small or does not match the matrix)
+    """
+    buf = buffers.get(key)
+    if buf is None or buf.shape[0] < len(ix) or buf.shape[1:] != X.shape[1:] or buf.dtype != X.dtype:
+        buf = buffers[key] = np.empty((len(ix),) + X.shape[1:], dtype=X.dtype)
+    out = buf[:len(ix)]
+    # numpy makes an intermediate copy when writing to out with the default mode="raise", so the range of the indices is
+    # checked here instead of letting mode="clip" clamp them silently
+    ix = np.asarray(ix)
+    if len(ix) > 0 and (ix.min() < 0 or ix.max() >= X.shape[0]):
+        raise IndexError("row indices out of range for a matrix with %d rows" % X.shape[0])
+    np.take(X, ix, axis=0, out=out, mode="clip")
+    return out
+
+def take_mask(mask, ix, buffers, key):
+    """ Method to gather some rows of a mask of missing values (see take_rows), masks of entire samples stay broadcast """
+    if mask.ndim == 2 and mask.strides[1] == 0:
+        return np.broadcast_to(mask[ix,:1], (len(ix), mask.shape[1]))
+    return take_rows(mask, ix, buffers, key)
+
+def group_order(groups, names):
+    """ Method to get the permutation of the samples that makes every group contiguous, with the groups in the order of names
+    and the samples of each group in their original order
+
+    PARAMETERS
+    ---------
+    groups: array with the name of the group of each sample
+    names: list with the names of the groups
+    """
+    return np.argsort(pd.Index(names).get_indexer(np.asarray(groups)), kind='stable')
+
+def group_counts(idx):
+    """ Method to get the number of samples of each group from the output of group_slices """
+    return np.array([ i.stop-i.start if isinstance(i, slice) else len(i) for i in idx ], dtype=int)
+
+def group_sum(X, idx):
+    """ Method to sum the rows of a matrix within each group, using a segmented reduction when the groups are contiguous
+
+    PARAMETERS
+    ---------
+    X: np array with one row per sample
+    idx: output of group_slices
+    """
+    dtype = np.int64 if X.dtype == bool else X.dtype
+    out = np.zeros((len(idx),) + X.shape[1:], dtype=dtype)
+    if all(isinstance(i, slice) for i in idx):
+        runs = sorted([ g for g in range(len(idx)) if idx[g].stop > idx[g].start ], key=lambda g: idx[g].start)
+        if len(runs) > 0:
+            out[runs] = np.add.reduceat(X, [idx[g].start for g in runs], axis=0, dtype=dtype)
+    else:
+        for g in range(len(idx)):
+            out[g] = X[idx[g]].sum(axis=0)
+    return out
+
 def infer_platform():
     if platform == "linux" or platform == "linux2":
         return 1e3
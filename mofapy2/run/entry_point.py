@@ -2,16 +2,27 @@ import numpy as np
 import pandas as pd
 import scipy as s
 import sys
+import os
+import gc
+import pickle
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from time import sleep
 from time import time
 from typing import List, Optional, Union
 from itertools import chain
 
 from mofapy2.core.BayesNet import *
+from mofapy2.core.distributed import AsyncStochasticBayesNet, DistributedBayesNet, FeatureShardedBayesNet, ShardBayesNet
 from mofapy2.core import gpu_utils
+from mofapy2.core import parallel, shared_data
+from mofapy2.core.disk_data import DiskView, is_disk
 from mofapy2.build_model.build_model import *
 from mofapy2.build_model.save_model import *
-from mofapy2.build_model.utils import guess_likelihoods
+from mofapy2.build_model.utils import guess_likelihoods, feature_means, load_expectations
+from mofapy2.core.utils import group_slices, group_order
+from scipy.sparse import issparse, csr_matrix, vstack
 from mofapy2.build_model.train_model import train_model
 
 class entry_point(object):
@@ -49,6 +60,12 @@ class entry_point(object):
         ----------
         data: a nested list, first dimension for views, second dimension for groups.
               The dimensions of each matrix must be (samples,features)
+              Matrices can be scipy.sparse matrices (gaussian or poisson views), in which case zeros
+              are observed values and the data is never densified
+              Matrices can also be stored on disk, as memory-mapped arrays (np.load(file, mmap_mode="r")) or
+              h5py datasets, in which case gaussian views are trained without loading them in memory. Views stored
+              on disk can only have missing values for entire samples, views with partially observed samples are
+              loaded in memory
         """
 
         if not hasattr(self, 'data_opts'): 
@@ -62,18 +79,24 @@ class entry_point(object):
             # if providing a single matrix, treat it as G=1 and M=1
             elif isinstance(data, pd.DataFrame):
                 data = [[data.values]]
-            elif isinstance(data, np.ndarray):
+            elif isinstance(data, np.ndarray) or issparse(data) or is_disk(data):
                 data = [[data]]
             else:
                 print("Error: Data not recognised"); sys.stdout.flush(); sys.exit()
         if len(data)==0:
             print("Error: Data is empty"); sys.stdout.flush(); sys.exit()
 
-        # Convert input data to numpy array float64 format
+        # Convert input data to numpy array (or sparse CSR matrix) float64 format
         for m in range(len(data)):
             if isinstance(data[m], dict):
                 data[m] = list(data[m].values())
             for p in range(len(data[m])):
+                if issparse(data[m][p]):
+                    data[m][p] = csr_matrix(data[m][p], dtype=np.float64)
+                    continue
+                if is_disk(data[m][p]):
+                    # matrices stored on disk are read in blocks of samples (see DiskView)
+                    continue
                 if not isinstance(data[m][p], np.ndarray):
                     if isinstance(data[m][p], pd.DataFrame):
                         data[m][p] = data[m][p].values
@@ -151,10 +174,24 @@ class entry_point(object):
         print("\n")
 
         # Store intercepts
-        self.intercepts = [ [ np.nanmean(data[m][g],axis=0) for g in range(G)] for m in range(M) ]
+        self.intercepts = [None for m in range(M)]
+        for m in range(M):
+            if any([is_disk(x) for x in data[m]]):
+                # concatenate the groups of the views stored on disk, which are read in blocks of samples
+                data[m] = DiskView(data[m])
+                n, s1, _ = data[m].scan()
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    self.intercepts[m] = list(s1 / n)
+            else:
+                self.intercepts[m] = [ feature_means(data[m][g]) for g in range(G) ]
 
         # Concatenate groups
         for m in range(len(data)):
+            if isinstance(data[m], DiskView):
+                continue
+            if any([issparse(x) for x in data[m]]):
+                data[m] = vstack([csr_matrix(x) for x in data[m]]).tocsr()
+                continue
             data[m] = np.concatenate(data[m])
             # Convert data to numpy.ndarray.
             # This is required since some matrix operations
@@ -315,7 +352,9 @@ class entry_point(object):
         # Get the respective data slot
         if use_layer:
             if use_layer in adata.layers.keys():
-                if callable(getattr(adata.layers[use_layer], "todense", None)):
+                if issparse(adata.layers[use_layer]):
+                    data = [csr_matrix(adata.layers[use_layer], dtype=np.float64)]
+                elif callable(getattr(adata.layers[use_layer], "todense", None)):
                     data = [np.array(adata.layers[use_layer].todense())]    
                 else:
                     data = [adata.layers[use_layer]]
@@ -325,13 +364,18 @@ class entry_point(object):
             else:
                 print("Error: Layer {} does not exist".format(use_layer)); sys.stdout.flush(); sys.exit()
         elif use_raw:
-            adata_raw_dense = np.array(adata.raw[:,adata.var_names].X.todense())
-            data = [adata_raw_dense]
+            adata_raw = adata.raw[:,adata.var_names].X
+            if issparse(adata_raw):
+                data = [csr_matrix(adata_raw, dtype=np.float64)]
+            else:
+                data = [np.array(adata_raw)]
             # Subset features if required
             if features_subset is not None:
                 data[0] = data[0][:,adata.raw.var[features_subset].values]
         else:
-            if callable(getattr(adata.X, "todense", None)):
+            if issparse(adata.X):
+                data = [csr_matrix(adata.X, dtype=np.float64)]
+            elif callable(getattr(adata.X, "todense", None)):
                 data = [np.array(adata.X.todense())]
             else:
                 data = [adata.X]
@@ -367,6 +411,12 @@ class entry_point(object):
             # List of names of groups for samples ordered as they are in the oridinal data, i.e. [group2, group1, group1, ...]
             self.data_opts['samples_groups'] = adata.obs[groups_label].apply(str).values
 
+            # Store the samples group-contiguously (as in samples_names) and keep the permutation to map results back to adata
+            order = group_order(self.data_opts['samples_groups'], self.data_opts['groups_names'])
+            if np.any(order != np.arange(N)):
+                self.data_opts['samples_order'] = order
+                self.data_opts['samples_groups'] = self.data_opts['samples_groups'][order]
+                data[0] = data[0][order,:]
 
         # If everything successful, print verbose message
         for m in range(M):
@@ -388,9 +438,8 @@ class entry_point(object):
         self.likelihoods = likelihoods
 
         # Process the data (center, scaling, etc.)
-        for g in self.data_opts['groups_names']:
-            samples_idx = np.where(np.array(self.data_opts['samples_groups']) == g)[0]
-            self.intercepts[0] = np.nanmean(data[0][samples_idx,:], axis=0)
+        samples_idx = group_slices(self.data_opts['samples_groups'], names=self.data_opts['groups_names'])
+        self.intercepts[0] = [feature_means(data[0][idx,:]) for idx in samples_idx]
         self.data = process_data(data, likelihoods, self.data_opts, self.data_opts['samples_groups'])
 
     def set_data_from_loom(self, loom, groups_label=None, layer=None, cell_id="CellID"):
@@ -448,6 +497,11 @@ class entry_point(object):
             self.data_opts['samples_names'] = loom_metadata.groupby(groups_label)[cell_id].apply(list).tolist()
             # List of names of groups for samples ordered as they are in the oridinal data, i.e. [group2, group1, group1, ...]
             self.data_opts['samples_groups'] = loom_metadata[groups_label].values
+            # Permutation that stores the samples group-contiguously (as in samples_names)
+            order = group_order(self.data_opts['samples_groups'], self.data_opts['groups_names'])
+            if np.any(order != np.arange(N)):
+                self.data_opts['samples_order'] = order
+                self.data_opts['samples_groups'] = self.data_opts['samples_groups'][order]
 
         # If everything successful, print verbose message
         for m in range(M):
@@ -464,6 +518,8 @@ class entry_point(object):
             data = [loom.layers[layer][:,:].T]
         else:
             data = [loom[:,:].T]
+        if 'samples_order' in self.data_opts:
+            data[0] = data[0][self.data_opts['samples_order'],:]
 
         # Define likelihoods
         if likelihoods is None:
@@ -475,13 +531,16 @@ class entry_point(object):
         self.likelihoods = likelihoods
 
         # Process the data (center, scaling, etc.)
-        self.intercepts[0] = [np.nanmean(x, axis=0) for x in [data[0][np.where(np.array(self.data_opts['samples_groups']) == g)[0],:] for g in self.data_opts['groups_names']]]
+        samples_idx = group_slices(self.data_opts['samples_groups'], names=self.data_opts['groups_names'])
+        self.intercepts[0] = [np.nanmean(data[0][idx,:], axis=0) for idx in samples_idx]
         self.data = process_data(data, self.data_opts, self.data_opts['samples_groups'])
 
     def set_train_options(self,
         iter=1000, startELBO=1, freqELBO=1, startSparsity=100, tolerance=None, convergence_mode="medium",
         startDrop=1, freqDrop=1, dropR2=None, nostop=False, verbose=False, quiet=False, seed=None,
-        schedule=None, gpu_mode=False, Y_ELBO_TauTrick=True, weight_views = False
+        schedule=None, gpu_mode=False, Y_ELBO_TauTrick=True, weight_views = False, observed_entries=0.7, dtype="float64",
+        drop_all=False, n_threads=1, checkpoint=None, checkpoint_freq=None, checkpoint_time=None, n_workers=1,
+        shard_features=False
         ):
         """ Set training options """
 
@@ -525,16 +584,13 @@ class entry_point(object):
         if dropR2 is not None:
             dropR2 = float(dropR2)
             if dropR2 < 0: dropR2 = None
-        self.train_opts['drop'] = { "min_r2":dropR2 }
-        self.train_opts['start_drop'] = int(startDrop)
+        # Drop all inactive factors at once instead of a single random one
+        self.train_opts['drop'] = { "min_r2":dropR2, "drop_all":bool(drop_all) }
+        # dropping all the inactive factors requires W and Z to be updated at least once (the first iteration is 1)
+        self.train_opts['start_drop'] = max(int(startDrop), 2) if drop_all else int(startDrop)
         self.train_opts['freq_drop'] = int(freqDrop)
         if ((dropR2 is not None) & (verbose is True)): print("\nDropping factors with minimum threshold of {0}% variance explained\n".format(dropR2))
 
-        if ((dropR2 is not None) & (self.dimensionalities["N"]>1e4)):
-            print("Warning: actively dropping factors during model training can be slow in large data sets.")
-            print("Consider training the model with set drop_factor_threshold = -1 and prune them a posteriori")
-
-
         # Tolerance level for convergence
         if tolerance is not None:
             print("Warning: tolerance argument is depreciated, use the 'convergence_mode' argument instead")
@@ -594,7 +650,66 @@ class entry_point(object):
         # Weight the views to avoid imbalance problems?
         self.train_opts['weight_views'] = weight_views
 
-    def set_stochastic_options(self, learning_rate=1., forgetting_rate=0., batch_size=1., start_stochastic=1):
+        # Fraction of missing values above which a view is stored as a list of observed entries (None to disable)
+        if observed_entries is not None:
+            assert 0 <= observed_entries <= 1, 'observed_entries must range from 0 to 1'
+            observed_entries = float(observed_entries)
+        self.train_opts['observed_entries'] = observed_entries
+
+        # Floating point precision of the data and the nodes. In float32 mode the ELBO is still accumulated in float64,
+        # and the expectations of Z and W agree with the float64 solution up to a relative error of ~1e-5
+        assert dtype in ["float32", "float64"], "dtype has to be 'float32' or 'float64'"
+        self.train_opts['dtype'] = np.dtype(dtype)
+
+        # Number of views updated concurrently, in a pool of threads. While the views run in parallel, the BLAS libraries
+        # are limited to their share of the cores (this requires the threadpoolctl package)
+        assert int(n_threads) >= 1, "n_threads has to be a positive integer"
+        self.train_opts['n_threads'] = int(n_threads)
+
+        # Save the model and the training state to the checkpoint file every checkpoint_freq iterations and/or every
+        # checkpoint_time minutes, to resume an interrupted training with resume()
+        if checkpoint is not None:
+            assert checkpoint_freq is not None or checkpoint_time is not None, "checkpoint_freq or checkpoint_time has to be defined to save checkpoints"
+            if checkpoint_freq is not None: assert int(checkpoint_freq) >= 1, "checkpoint_freq has to be a positive integer"
+            if checkpoint_time is not None: assert checkpoint_time > 0, "checkpoint_time has to be positive"
+        self.train_opts['checkpoint'] = checkpoint
+        self.train_opts['checkpoint_freq'] = int(checkpoint_freq) if checkpoint_freq is not None else None
+        self.train_opts['checkpoint_time'] = float(checkpoint_time) if checkpoint_time is not None else None
+
+        # Number of worker processes, each holding a shard of the samples and updating its factors, while the main
+        # process updates the weights and Tau from the sums reduced over the shards (see DistributedBayesNet).
+        # With shard_features, each worker holds a shard of the features of every view and updates its weights and Tau,
+        # while the main process updates the factors (see FeatureShardedBayesNet). Only gaussian likelihoods are supported
+        assert int(n_workers) >= 1, "n_workers has to be a positive integer"
+        if n_workers > 1 and shard_features:
+            assert min(self.dimensionalities['D']) >= n_workers, 'Every view must have at least as many features as workers'
+        elif n_workers > 1:
+            _, counts = np.unique(self.data_opts['samples_groups'], return_counts=True)
+            assert counts.min() >= n_workers, 'Every group must have at least as many samples as workers'
+        self.train_opts['n_workers'] = int(n_workers)
+        self.train_opts['shard_features'] = bool(shard_features)
+
+    def set_stochastic_options(self, learning_rate=1., forgetting_rate=0., batch_size=1., start_stochastic=1, contiguous_batches=False, prefetch=False,
+        minibatch_elbo=False, elbo_smoothing=0.9, exact_elbo_epochs=None, stratified=False, n_workers=None, staleness=2):
+        """ Set stochastic inference options
+
+        PARAMETERS
+        ----------
+        contiguous_batches: lay out a copy of the (dense) gaussian views in the order of the samples of each epoch,
+            so that the mini-batches are slices of the copy instead of being gathered at every iteration
+        prefetch: read the data of the next mini-batch in a background thread while the current one is used
+            (mostly useful for sparse views and views stored on disk)
+        minibatch_elbo: estimate the ELBO from the samples of the mini-batch instead of computing it on all samples
+            (the terms of the gaussian views and of the factors are rescaled to all samples)
+        elbo_smoothing: decay of the exponential moving average of the ELBO estimates used to assess convergence
+        exact_elbo_epochs: compute the exact ELBO at the end of every 'exact_elbo_epochs' epochs (with minibatch_elbo)
+        stratified: draw the same fraction of samples from each group in every mini-batch, so that small groups are not
+            missing from the mini-batches, and weight the samples accordingly
+        n_workers: number of worker processes, each training on a shard of the samples and pushing its updates of the
+            weights and Tau to the main process asynchronously (see AsyncStochasticBayesNet). By default, the number
+            of workers of the training options
+        staleness: maximum number of updates that a worker can push ahead of the slowest worker (with n_workers > 1)
+        """
 
         # Sanity checks
         assert hasattr(self, 'train_opts'), "Train options not defined"
@@ -602,10 +717,14 @@ class entry_point(object):
         # assert 0 < forgetting_rate <= 1, 'Forgetting rate must range from 0 and 1'
         assert 0 < batch_size <= 1, 'Batch size must range from 0 to 1'
         assert start_stochastic >= 1, 'start_stochastic must be >= 1'
-
-        if self.train_opts['drop']["min_r2"] is not None:
-            print("Dropping factors is currently disabled with stochastic inference...")
-            self.train_opts['drop']["min_r2"] = None
+        assert 0 <= elbo_smoothing < 1, 'elbo_smoothing must range from 0 to 1'
+        assert exact_elbo_epochs is None or exact_elbo_epochs >= 1, 'exact_elbo_epochs must be >= 1'
+        if n_workers is None: n_workers = self.train_opts.get('n_workers', 1)
+        assert n_workers >= 1, 'n_workers must be >= 1'
+        assert staleness >= 0, 'staleness must be >= 0'
+        if n_workers > 1:
+            _, counts = np.unique(self.data_opts['samples_groups'], return_counts=True)
+            assert counts.min() >= n_workers, 'Every group must have at least as many samples as workers'
 
         # Edit schedule: Z should come first (after Y) in the training schedule
         # (THIS IS DONE IN THE BAYESNET CLASS)
@@ -618,8 +737,14 @@ class entry_point(object):
         self.train_opts['forgetting_rate'] = forgetting_rate
         self.train_opts['start_stochastic'] = start_stochastic
         self.train_opts['batch_size'] = batch_size
-
-        self.train_opts['drop']["min_r2"] = None
+        self.train_opts['contiguous_batches'] = contiguous_batches
+        self.train_opts['prefetch'] = prefetch
+        self.train_opts['minibatch_elbo'] = minibatch_elbo
+        self.train_opts['elbo_smoothing'] = elbo_smoothing
+        self.train_opts['exact_elbo_epochs'] = int(exact_elbo_epochs) if exact_elbo_epochs is not None else None
+        self.train_opts['stratified'] = stratified
+        self.train_opts['n_workers'] = int(n_workers)
+        self.train_opts['staleness'] = int(staleness)
 
     def set_model_options(self, factors=10, spikeslab_factors=False, spikeslab_weights=True, ard_factors=False, ard_weights=True):
         """ Set model options """
@@ -673,8 +798,16 @@ class entry_point(object):
         self.data_opts['scale_groups'] = scale_groups
         if (scale_groups): print("Scaling groups to unit variance...\n")
 
-    def build(self):
-        """ Build the model """
+    def build(self, warm_start=None):
+        """ Build the model
+
+        PARAMETERS
+        ----------
+        warm_start: str
+            hdf5 file of a model saved with save() to initialise Z, W, Tau, Alpha and Theta from its expectations (only the
+            nodes saved in the file, see the 'expectations' argument of save()). Samples, features, groups and views are
+            matched by name, new ones (and factors beyond the ones of the saved model) use the default initialisation.
+        """
 
         # Sanity checks
         assert hasattr(self, 'train_opts'), "Training options not defined"
@@ -688,12 +821,28 @@ class entry_point(object):
         if np.any(counts<15):
             print("\nWarning: some group(s) have less than 15 samples, MOFA won't be able to learn meaningful factors for these group(s)...\n")
 
+        # Cast the data to the floating point precision of the model
+        self.data = [ y.astype(self.train_opts['dtype'], copy=False) for y in self.data ]
+
+        # Expectations of a previous model to initialise the nodes
+        expectations = None
+        if warm_start is not None:
+            expectations = load_expectations(warm_start, self.data_opts, self.model_opts, self.dimensionalities['K'])
+
         # Build the nodes
-        tmp = buildBiofam(self.data, self.data_opts, self.model_opts, self.dimensionalities, self.train_opts['seed'],  self.train_opts['weight_views'])
+        tmp = buildBiofam(self.data, self.data_opts, self.model_opts, self.dimensionalities, self.train_opts['seed'],  self.train_opts['weight_views'], self.train_opts['dtype'], expectations)
 
         # Create BayesNet class
-        if self.train_opts['stochastic']:
+        if self.train_opts['stochastic'] and self.train_opts.get('n_workers', 1) > 1:
+            self.model = AsyncStochasticBayesNet(self.dimensionalities, tmp.get_nodes())
+        elif self.train_opts['stochastic']:
             self.model = StochasticBayesNet(self.dimensionalities, tmp.get_nodes())
+        elif self.train_opts.get('n_workers', 1) > 1:
+            assert all([ x == "gaussian" for x in self.likelihoods ]), "Only gaussian likelihoods can be trained with several workers in full-batch mode"
+            if self.train_opts.get('shard_features', False):
+                self.model = FeatureShardedBayesNet(self.dimensionalities, tmp.get_nodes())
+            else:
+                self.model = DistributedBayesNet(self.dimensionalities, tmp.get_nodes())
         else:
             self.model = BayesNet(self.dimensionalities, tmp.get_nodes())
 
@@ -715,7 +864,187 @@ class entry_point(object):
         self.model.setTrainOptions(self.train_opts)
 
         # Train the model
-        train_model(self.model)
+        self.train()
+
+    def train(self):
+        """ Method to train the model, sharing the data with the worker processes of a distributed training """
+        if not isinstance(self.model, (AsyncStochasticBayesNet, DistributedBayesNet)):
+            train_model(self.model)
+            return
+
+        # The missing values of the data have been filled by the nodes, their masks are shared with the data
+        masks = [ node.getMask(full=True) for node in self.model.nodes["Y"].getNodes() ]
+        masks = [ x if np.ndim(x) == 2 and x.strides[1] != 0 and x.any() else None for x in masks ]
+
+        # Each worker gets the samples (or the features) of its shard in its own blocks of shared memory
+        state = { k:v for k,v in self.__dict__.items() if k not in ["data", "model", "models"] }
+        shards = self.model.splitShards(self.train_opts['n_workers'])
+        blocks, specs = shared_data.share_shards(self.data + masks, [ (rows, None if cols is None else cols + cols) for rows, cols in shards ])
+        self.model.setShards(_build_shard, state, specs)
+
+        # In full-batch training the main process does not hold the data: the dense views and the masks are released
+        # once they are shared, and gathered back from the shards after the training
+        release = isinstance(self.model, DistributedBayesNet)
+        if release:
+            shapes = [ y.shape for y in self.data ] * 2
+            self.model.releaseData()
+            self.data = [ None if isinstance(y, np.ndarray) else y for y in self.data ]
+            masks = [ None ] * len(masks)
+        try:
+            train_model(self.model)
+        finally:
+            self.model.setShards()
+            if release:
+                views = shared_data.gather(self.data + masks, shapes, shards, specs, blocks)
+                self.data, masks = views[:len(self.data)], views[len(self.data):]
+            for x in blocks:
+                shared_data.release(x, unlink=True)
+            if release:
+                self.model.setData(self.data, masks)
+
+    def resume(self, checkpoint):
+        """ Resume an interrupted training from a checkpoint (see the checkpoint options of set_train_options)
+
+        The training continues from the iteration after the checkpoint exactly as it would have without the interruption.
+        The data and the data and model options have to be defined as in the interrupted training (the data is not saved
+        in the checkpoint), but the model does not have to be built: the model and the training options are restored
+        from the checkpoint.
+
+        PARAMETERS
+        ----------
+        checkpoint: str
+            checkpoint file
+        """
+
+        # Sanity checks
+        assert hasattr(self, 'data'), "Data has to be defined before resuming the training"
+        assert hasattr(self, 'model_opts'), "Model options not defined"
+        assert hasattr(self, 'data_opts'), "Data options not defined"
+
+        with open(checkpoint, "rb") as f:
+            model = pickle.load(f)
+        assert isinstance(model, BayesNet) and model.state is not None, "%s is not a checkpoint of a training" % checkpoint
+
+        self.model = model
+        self.train_opts = model.getTrainingOpts()
+
+        # Set training options (this restores the pool of threads)
+        self.model.setTrainOptions(self.train_opts)
+
+        # Bind the data to the model, cast to its floating point precision as in build
+        self.data = [ y.astype(self.train_opts['dtype'], copy=False) for y in self.data ]
+        self.model.setData(self.data)
+
+        # Train the model
+        self.train()
+
+    def run_restarts(self, n=None, seeds=None, n_jobs=1, keep="best", outfile=None, cancel_margin=None, cancel_start=10):
+        """ Train the model from several seeds in parallel processes and select the one with the highest ELBO
+
+        The processed data is shared with the processes through shared memory. The restarts start from random factors
+        drawn with their seed (the PCA initialisation would give the same model for every seed). The ELBO traces are
+        reported while the restarts are trained, and the restarts that are clearly behind the others can be stopped early.
+
+        PARAMETERS
+        ----------
+        n (optional): number of restarts (by default the number of seeds)
+        seeds (optional): list of seeds (by default n consecutive seeds starting from the seed of the training options)
+        n_jobs: number of restarts trained at the same time
+        keep: "best" to keep only the model with the highest ELBO (in self.model),
+            or "all" to also keep every trained model (in self.models, by seed)
+        outfile (optional): file to save the best model, or every model if keep="all" (with the seed appended to the file name)
+        cancel_margin (optional): stop a restart if its ELBO is below the best ELBO of the other (not stopped) restarts
+            at the same iteration by more than this fraction
+        cancel_start: first iteration at which the restarts can be stopped
+
+        Returns a pd.DataFrame with the ELBO traces of the restarts (one column per seed)
+        """
+
+        # Sanity checks
+        assert hasattr(self, 'data'), "Data has to be defined before training the model"
+        assert hasattr(self, 'model_opts'), "Model options not defined"
+        assert hasattr(self, 'train_opts'), "Train options not defined"
+        assert keep in ["best", "all"], "keep has to be 'best' or 'all'"
+        assert self.train_opts['start_elbo'] < self.train_opts['maxiter'], "The ELBO has to be computed to select the best restart"
+        if seeds is None:
+            assert n is not None, "Either the number of restarts or the seeds have to be provided"
+            seeds = [ self.train_opts['seed'] + r for r in range(int(n)) ]
+        seeds = [ int(x) for x in seeds ]
+        if n is not None: assert len(seeds) == n, "The number of seeds does not match the number of restarts"
+        assert len(set(seeds)) == len(seeds), "The seeds have to be different"
+
+        # Cast the data to the floating point precision of the model and share it with the processes
+        self.data = [ y.astype(self.train_opts['dtype'], copy=False) for y in self.data ]
+        state = { k:v for k,v in self.__dict__.items() if k not in ["data", "model", "models"] }
+        blocks, specs = shared_data.share(self.data)
+
+        print("Training %d restarts with seeds %s in %d processes...\n" % (len(seeds), ", ".join([str(x) for x in seeds]), n_jobs))
+        sys.stdout.flush()
+
+        elbo = pd.DataFrame(index=pd.Index([], name="iteration"), columns=seeds, dtype=float)
+        final_elbo = {}
+        models = {}
+        best = None
+        masks = None
+        manager = multiprocessing.Manager()
+        try:
+            queue, cancel = manager.Queue(), manager.dict()
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                pending = set([ pool.submit(_train_restart, state, specs, seed, n_jobs, queue, cancel) for seed in seeds ])
+                while len(pending) > 0:
+                    done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+
+                    # Collect the ELBO traces and stop the restarts that are clearly behind
+                    while not queue.empty():
+                        seed, i, x = queue.get()
+                        elbo.loc[i, seed] = x
+                        if not self.train_opts['quiet']:
+                            print("Seed %d: iteration %d, ELBO=%.2f" % (seed, i, x))
+                        others = elbo.loc[i].drop([seed] + list(cancel.keys()), errors="ignore")
+                        if cancel_margin is not None and i >= cancel_start and others.notna().any() and not cancel.get(seed, False):
+                            leader = others.max()
+                            if x < leader - cancel_margin*abs(leader):
+                                print("Seed %d: stopped at iteration %d, its ELBO is behind the other restarts" % (seed, i))
+                                cancel[seed] = True
+
+                    # Keep the best model so far (or every model)
+                    for future in done:
+                        seed, x, model = future.result()
+                        if model is None: continue
+                        final_elbo[seed] = x
+                        if best is None or x > final_elbo[best]:
+                            best = seed
+                            if keep == "best": models = {}
+                        if keep == "all" or best == seed:
+                            models[seed] = pickle.loads(model)
+                            # the data is not sent with the model: the models share the data of the entry point, whose
+                            # missing values are filled by the first model bound to it (the masks are taken from it)
+                            models[seed].setData(self.data, masks)
+                            if masks is None: masks = [ node.getMask(full=True) for node in models[seed].nodes["Y"].getNodes() ]
+                        del model
+                    sys.stdout.flush()
+        finally:
+            manager.shutdown()
+            shared_data.release(blocks, unlink=True)
+
+        assert best is not None, "All the restarts were stopped"
+        print("\nFinal ELBO per seed: " + ", ".join([ "%d: %.2f" % (k,v) for k,v in final_elbo.items() ]))
+        print("Selected the model trained with seed %d\n" % best)
+
+        # Save the models
+        if outfile is not None:
+            if keep == "all":
+                root, ext = os.path.splitext(outfile)
+                for seed in models:
+                    self.model, self.train_opts['seed'] = models[seed], seed
+                    self.save("%s_seed%d%s" % (root, seed, ext))
+            else:
+                self.model, self.train_opts['seed'] = models[best], best
+                self.save(outfile)
+
+        self.model, self.train_opts['seed'] = models[best], best
+        if keep == "all": self.models = models
+        return elbo.sort_index()
 
     def mask_outliers(self):
 
@@ -723,9 +1052,10 @@ class entry_point(object):
         zscore_cutoff = 3 * 1.96   # z-score cutoff
         value_cutoff = 1       # max factor value
 
+        samples_idx = group_slices(self.data_opts["samples_groups"], names=self.data_opts['groups_names'])
         for g in range(len(self.data_opts['groups_names'])):
-            idx = np.where(np.array(self.data_opts["samples_groups"]) == self.data_opts['groups_names'][g])[0]
-            Ztmp = Z[idx,:] # is this by reference? apparently not
+            idx = samples_idx[g]
+            Ztmp = Z[idx,:] # by reference if the groups are contiguous
 
             # calculate outlier score
             z_score = np.absolute((Ztmp-Ztmp.mean(axis=0))) / np.std(Ztmp, axis=0)
@@ -845,6 +1175,92 @@ class entry_point(object):
 
 
 
+def _train_restart(state, specs, seed, n_jobs, queue, cancel):
+    """ Method to train one restart in a worker process (see entry_point.run_restarts)
+
+    Returns the seed, the final ELBO and the pickled model (None if the restart was stopped)
+    """
+    blocks, data = shared_data.attach(specs)
+    try:
+        ent = entry_point.__new__(entry_point)
+        ent.__dict__.update(state)
+        ent.data = data
+        ent.train_opts = dict(ent.train_opts, seed=seed, checkpoint=None)
+        ent.model_opts = dict(ent.model_opts, init_factors="random")
+
+        def callback(i, elbo):
+            queue.put((seed, i, elbo))
+            return cancel.get(seed, False)
+
+        # Train with the share of the cores of this process, without printing the training log
+        with parallel.blas_limits(max(1, (os.cpu_count() or 1) // n_jobs)), open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            ent.build()
+            ent.model.callback = callback
+            ent.run()
+        ent.model.callback = None
+
+        if cancel.get(seed, False):
+            return seed, None, None
+        elbo = ent.model.train_stats['elbo']
+        return seed, elbo[~np.isnan(elbo)][-1], pickle.dumps(ent.model, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        # the arrays backed by the shared memory have to be released before detaching from it
+        ent = data = None
+        gc.collect()
+        shared_data.release(blocks)
+
+
+def _build_shard(state, views, rows, n_per_group, K, cols=None):
+    """ Method to build the model of a shard of samples or features in a worker process (see AsyncStochasticBayesNet,
+    DistributedBayesNet and FeatureShardedBayesNet)
+
+    PARAMETERS
+    ----------
+    state: state of the entry point
+    views: the views of the shard, followed by their masks of missing values (None for views without missing values or
+        with masks of entire samples), see shared_data.share_shards
+    rows: samples of the shard
+    n_per_group: number of samples of each group in all the shards
+    K: number of factors
+    cols: features of each view in the shard (slices), None for all the features
+
+    The model uses the views of the shard in the shared memory without copying them (the samples of views stored on
+    disk are read in memory), and its factors are set by the main process
+    """
+    def take(Y, c):
+        if not isinstance(Y, DiskView):
+            return Y
+        if c is None:
+            X = Y.read(rows)
+        else:
+            # read by blocks of samples, keeping the features of the shard
+            X = np.empty((len(rows), c.stop-c.start), dtype=Y.dtype)
+            for b, Yb in Y.blocks(rows): X[b,:] = Yb[:,c]
+        if Y.missing is not None: X[Y.missing[rows],:] = np.nan
+        return X
+
+    ent = entry_point.__new__(entry_point)
+    ent.__dict__.update(state)
+    M = len(views) // 2
+    if cols is None: cols = [None] * M
+    ent.data = [ take(Y, c) for Y, c in zip(views[:M], cols) ]
+    ent.data_opts = dict(ent.data_opts, samples_groups=ent.data_opts['samples_groups'][rows])
+    if 'features_names' in ent.data_opts:
+        ent.data_opts['features_names'] = [ x if c is None else x[c] for x, c in zip(ent.data_opts['features_names'], cols) ]
+    ent.dimensionalities = dict(ent.dimensionalities, N=len(rows), K=K, D=[ Y.shape[1] for Y in ent.data ])
+    ent.model_opts = dict(ent.model_opts, factors=K, init_factors=0)
+    ent.train_opts = dict(ent.train_opts, checkpoint=None, n_workers=1, stratified=True)
+    ent.build()
+
+    # the missing values are filled in the shared data, their masks are shared with it
+    for node, mask in zip(ent.model.nodes["Y"].getNodes(), views[M:]):
+        if mask is not None: node.mask = mask
+
+    model = ShardBayesNet(ent.dimensionalities, ent.model.getNodes(), n_per_group)
+    model.setTrainOptions(ent.train_opts)
+    return model
+
+
 def mofa(adata, groups_label: bool = None, use_raw: bool = False, use_layer: bool = None, 
          features_subset: Optional[str] = None,
          likelihood: Optional[Union[str, List[str]]] = None, n_factors: int = 10,
@@ -918,7 +1334,11 @@ def mofa(adata, groups_label: bool = None, use_raw: bool = False, use_layer: boo
         f = h5py.File(outfile)
         if copy:
             adata = adata.copy()
-        adata.obsm['X_mofa'] = np.concatenate([v[:,:] for k, v in f['expectations']['Z'].items()], axis=1).T
+        # Z is saved per group, in the order of groups_names
+        Z = np.concatenate([f['expectations']['Z'][g][:,:] for g in ent.data_opts['groups_names']], axis=1).T
+        if 'samples_order' in ent.data_opts:
+            Z = Z[np.argsort(ent.data_opts['samples_order']),:]
+        adata.obsm['X_mofa'] = Z
         if features_subset is None:
             # Loadings can be saved only if all the features were used in training
             adata.varm['LFs'] = np.concatenate([v[:,:] for k, v in f['expectations']['W'].items()], axis=1).T
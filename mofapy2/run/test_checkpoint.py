@@ -0,0 +1,61 @@
+"""
+Regression check for the checkpoints: a training interrupted after a checkpoint and resumed from it has to reproduce
+the uninterrupted training on the same seed.
+Run with: python -m pytest mofapy2/run/test_checkpoint.py
+"""
+
+import os
+import io
+import contextlib
+import pickle
+import numpy as np
+import pytest
+
+from mofapy2.run.entry_point import entry_point
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class Interrupt(Exception):
+    pass
+
+
+def setup(**train_opts):
+    data = [np.loadtxt(os.path.join(datadir, "view_%d.txt" % m)) for m in range(3)]
+    data = [np.split(y, [60]) for y in data]
+    ent = entry_point()
+    ent.set_data_options(scale_views=False, scale_groups=False)
+    ent.set_data_matrix(data, likelihoods=["gaussian"]*3)
+    ent.set_model_options(factors=5, spikeslab_weights=True, ard_weights=True, ard_factors=True)
+    ent.set_train_options(iter=20, convergence_mode="slow", startELBO=1, freqELBO=1, seed=1, dropR2=0.01, **train_opts)
+    return ent
+
+
+def test_resume_matches_uninterrupted_training(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.pkl")
+    with contextlib.redirect_stdout(io.StringIO()):
+        ref = setup()
+        ref.build()
+        ref.run()
+
+        # interrupt the training after a checkpoint (the training resumes from iteration 9)
+        ent = setup(checkpoint=checkpoint, checkpoint_freq=4)
+        ent.build()
+        def interrupt(i, elbo):
+            if i == 10: raise Interrupt()
+        ent.model.callback = interrupt
+        with pytest.raises(Interrupt):
+            ent.run()
+        with open(checkpoint, "rb") as f:
+            assert pickle.load(f).state["i"] == 9
+
+        ent = setup()
+        ent.resume(checkpoint)
+
+    # the factors dropped before and after the checkpoint are the same
+    assert ref.model.dim["K"] < 5
+    np.testing.assert_array_equal(ent.model.train_stats["number_factors"], ref.model.train_stats["number_factors"])
+    np.testing.assert_allclose(ent.model.train_stats["elbo"], ref.model.train_stats["elbo"], rtol=1e-12)
+    np.testing.assert_allclose(ent.model.nodes["Z"].getExpectation(), ref.model.nodes["Z"].getExpectation(), rtol=0, atol=1e-12)
+    for W, W_ref in zip(ent.model.nodes["W"].getExpectation(), ref.model.nodes["W"].getExpectation()):
+        np.testing.assert_allclose(W, W_ref, rtol=0, atol=1e-12)
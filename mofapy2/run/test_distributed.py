@@ -0,0 +1,51 @@
+"""
+Regression check for the distributed training: a training over shards of the data in worker processes has to
+reproduce the training in a single process on the same seed.
+Run with: python -m pytest mofapy2/run/test_distributed.py
+"""
+
+import os
+import io
+import contextlib
+import numpy as np
+
+from mofapy2.run.entry_point import entry_point
+from mofapy2.core.distributed import DistributedBayesNet, FeatureShardedBayesNet
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+def train(**train_opts):
+    data = [np.loadtxt(os.path.join(datadir, "view_%d.txt" % m)) for m in range(3)]
+    # the second group of the first view is partially observed
+    data[0][60:,:][np.random.RandomState(1).rand(40, data[0].shape[1]) < 0.2] = np.nan
+    data = [np.split(y, [60]) for y in data]
+    ent = entry_point()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ent.set_data_options(scale_views=False, scale_groups=False)
+        ent.set_data_matrix(data, likelihoods=["gaussian"]*3)
+        ent.set_model_options(factors=5, spikeslab_weights=True, ard_weights=True, ard_factors=True)
+        ent.set_train_options(iter=15, convergence_mode="slow", startELBO=1, freqELBO=1, seed=1, dropR2=0.01, **train_opts)
+        ent.build()
+        ent.run()
+    return ent.model
+
+
+def check_same_training(model, ref):
+    np.testing.assert_array_equal(model.train_stats["number_factors"], ref.train_stats["number_factors"])
+    np.testing.assert_allclose(model.train_stats["elbo"], ref.train_stats["elbo"], rtol=1e-10)
+    np.testing.assert_allclose(model.nodes["Z"].getExpectation(), ref.nodes["Z"].getExpectation(), rtol=0, atol=1e-10)
+    for W, W_ref in zip(model.nodes["W"].getExpectation(), ref.nodes["W"].getExpectation()):
+        np.testing.assert_allclose(W, W_ref, rtol=0, atol=1e-10)
+
+
+def test_sample_shards_match_single_process():
+    model = train(n_workers=2)
+    assert type(model) is DistributedBayesNet
+    check_same_training(model, train())
+
+
+def test_feature_shards_match_single_process():
+    model = train(n_workers=2, shard_features=True)
+    assert type(model) is FeatureShardedBayesNet
+    check_same_training(model, train())
@@ -0,0 +1,58 @@
+"""
+Regression check for the float32 training mode: on a fixed seed, a float32 run
+has to reproduce the float64 run up to single precision round-off.
+Run with: python -m pytest mofapy2/run/test_dtype.py
+"""
+
+import os
+import io
+import contextlib
+import numpy as np
+
+from mofapy2.run.entry_point import entry_point
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+# Tolerances, relative to the float64 run (measured on this data after 50 iterations:
+# ~3e-7 on the ELBO and ~1.5e-5 on the expectations, relative to their largest entry)
+ELBO_RTOL = 1e-5
+EXPECTATION_RTOL = 1e-4
+
+
+def train(dtype):
+    data = [np.loadtxt(os.path.join(datadir, "view_%d.txt" % m)) for m in range(3)]
+    data = [np.split(y, [60]) for y in data]
+    ent = entry_point()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ent.set_data_options(scale_views=False, scale_groups=False)
+        ent.set_data_matrix(data, likelihoods=["gaussian"]*3)
+        ent.set_model_options(factors=5, spikeslab_weights=True, ard_weights=True, ard_factors=True)
+        ent.set_train_options(iter=50, convergence_mode="slow", startELBO=1, freqELBO=1, seed=1, dtype=dtype)
+        ent.build()
+        ent.run()
+    return ent.model
+
+
+def test_float32_matches_float64():
+    m64 = train("float64")
+    m32 = train("float32")
+
+    # expectations are kept in single precision
+    assert m32.nodes["Z"].getExpectation().dtype == np.float32
+    assert all(w.dtype == np.float32 for w in m32.nodes["W"].getExpectation())
+
+    # same number of active factors
+    assert m32.dim["K"] == m64.dim["K"]
+
+    # ELBO trace
+    elbo64 = np.asarray(m64.getTrainingStats()["elbo"], dtype=np.float64)
+    elbo32 = np.asarray(m32.getTrainingStats()["elbo"], dtype=np.float64)
+    assert elbo32.shape == elbo64.shape
+    mask = ~np.isnan(elbo64)
+    assert np.all(np.abs(elbo32[mask] - elbo64[mask]) <= ELBO_RTOL * np.abs(elbo64[mask]))
+
+    # expectations of the factors and the weights
+    Z32, Z64 = m32.nodes["Z"].getExpectation(), m64.nodes["Z"].getExpectation()
+    np.testing.assert_allclose(Z32, Z64, rtol=0, atol=EXPECTATION_RTOL*np.abs(Z64).max())
+    for W32, W64 in zip(m32.nodes["W"].getExpectation(), m64.nodes["W"].getExpectation()):
+        np.testing.assert_allclose(W32, W64, rtol=0, atol=EXPECTATION_RTOL*np.abs(W64).max())
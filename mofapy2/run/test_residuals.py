@@ -0,0 +1,44 @@
+"""
+Regression check for the residual-based coordinate updates: the projections obtained from the rank-one corrections
+of the residuals have to match the per-factor computation of the original updates, where the prediction of the data
+with all factors but k is recomputed for every factor.
+Run with: python -m pytest mofapy2/run/test_residuals.py
+"""
+
+import numpy as np
+
+from mofapy2.core.residuals import Residuals
+
+N, D, K = 40, 30, 4
+
+
+def setup():
+    rng = np.random.RandomState(1)
+    Y = rng.normal(size=(N,D))
+    tau = rng.gamma(2., size=(N,D))
+    tau[rng.rand(N,D) < 0.2] = 0.  # missing values
+    Z = rng.normal(size=(N,K))
+    W = rng.normal(size=(D,K))
+    return rng, Y, tau, Z, W
+
+
+def test_residuals_match_per_factor_updates():
+    rng, Y, tau, Z, W = setup()
+    res = Residuals(Y, tau, Z, W)
+    Z, W = Z.copy(), W.copy()
+    for k in range(K):
+        # updates of the factors: tau*(Y - Z[:,-k]W[:,-k]^T)·W[:,k]
+        others = np.arange(K) != k
+        bar = (tau * (Y - Z[:,others].dot(W[:,others].T))).dot(W[:,k])
+        np.testing.assert_allclose(res.dotW(k) + res.tauDotW(np.square(W))[:,k] * Z[:,k], bar, rtol=1e-10, atol=1e-10)
+        Z[:,k] = rng.normal(size=N)
+        res.updateZ(k, Z[:,k])
+
+        # updates of the weights: Z[:,k]·tau*(Y - Z[:,-k]W[:,-k]^T)
+        bar = Z[:,k].dot(tau * (Y - Z[:,others].dot(W[:,others].T)))
+        np.testing.assert_allclose(res.dotZ(k) + res.tauDotZ(np.square(Z))[:,k] * W[:,k], bar, rtol=1e-10, atol=1e-10)
+        W[:,k] = rng.normal(size=D)
+        res.updateW(k, W[:,k])
+
+    # the corrected residuals match the residuals of the final values
+    np.testing.assert_allclose(res.tauR, tau * (Y - Z.dot(W.T)), rtol=1e-10, atol=1e-10)
@@ -0,0 +1,47 @@
+"""
+Regression check for the sufficient-statistics mode: the projections of the residuals obtained from the statistics
+of the fully observed groups (and from the explicit residuals of the partially observed group) have to match the
+projections of the residuals computed on the full data.
+Run with: python -m pytest mofapy2/run/test_sufficient_statistics.py
+"""
+
+import numpy as np
+import pytest
+
+from mofapy2.core.residuals import Residuals, SufficientStatistics, GroupResiduals
+
+N, D, K, G = 60, 30, 4, 3
+
+
+@pytest.mark.parametrize("observed", [False, True])
+def test_statistics_match_full_data(observed):
+    rng = np.random.RandomState(1)
+    groups = rng.permutation(np.arange(N) % G)
+    Y = rng.normal(size=(N,D))
+    mask = np.zeros((N,D), dtype=bool)
+    mask[groups == 2,:] = rng.rand((groups == 2).sum(), D) < 0.3  # the last group is partially observed
+    Y[mask] = 0.
+    tau = rng.gamma(2., size=(G,D))
+    Z = rng.normal(size=(N,K))
+    W = rng.normal(size=(D,K))
+
+    stats = SufficientStatistics(Y, mask, groups, observed)
+    assert stats.complete == [0, 1] and stats.partial == [2]
+    res = GroupResiduals(stats, tau, Z, W)
+
+    tau_full = np.where(mask, 0., tau[groups,:])
+    ref = Residuals(Y, tau_full, Z, W)
+
+    A = rng.normal(size=(D,K))
+    np.testing.assert_allclose(res.tauDotW(A), ref.tauDotW(A), rtol=1e-10, atol=1e-10)
+    A = rng.normal(size=(N,K))
+    np.testing.assert_allclose(res.tauDotZ(A), ref.tauDotZ(A), rtol=1e-10, atol=1e-10)
+    for k in range(K):
+        np.testing.assert_allclose(res.dotW(k), ref.dotW(k), rtol=1e-10, atol=1e-10)
+        z = rng.normal(size=N)
+        res.updateZ(k, z)
+        ref.updateZ(k, z)
+        np.testing.assert_allclose(res.dotZ(k), ref.dotZ(k), rtol=1e-10, atol=1e-10)
+        w = rng.normal(size=D)
+        res.updateW(k, w)
+        ref.updateW(k, w)
@@ -0,0 +1,50 @@
+"""
+Regression check for the variance explained per factor: the vectorised computation has to match the original loop,
+where the prediction of the data is computed for every factor, both in fully and in partially observed groups.
+Run with: python -m pytest mofapy2/run/test_variance_explained.py
+"""
+
+import os
+import io
+import contextlib
+import numpy as np
+
+from mofapy2.run.entry_point import entry_point
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+def train():
+    data = [np.loadtxt(os.path.join(datadir, "view_%d.txt" % m)) for m in range(3)]
+    # the second group of the first view is partially observed
+    data[0][60:,:][np.random.RandomState(1).rand(40, data[0].shape[1]) < 0.2] = np.nan
+    data = [np.split(y, [60]) for y in data]
+    ent = entry_point()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ent.set_data_options(scale_views=False, scale_groups=False)
+        ent.set_data_matrix(data, likelihoods=["gaussian"]*3)
+        ent.set_model_options(factors=5)
+        ent.set_train_options(iter=10, seed=1)
+        ent.build()
+        ent.run()
+    return ent.model
+
+
+def test_variance_explained_matches_per_factor_loop():
+    model = train()
+    Z = model.nodes["Z"].getExpectation()
+    W = model.nodes["W"].getExpectation()
+    groups = model.nodes["AlphaZ"].groups if "AlphaZ" in model.nodes else np.zeros(model.dim['N'], dtype=int)
+
+    r2 = model.calculate_variance_explained()
+    for m, Y_m in enumerate(model.nodes["Y"].getNodes()):
+        Y = np.asarray(Y_m.getExpectation())
+        mask = Y_m.getMask(full=True)
+        for g in range(model.dim['G']):
+            gg = groups == g
+            SS = np.square(np.where(mask[gg,:], 0., Y[gg,:])).sum()
+            for k in range(model.dim['K']):
+                Ypred = np.outer(Z[gg,k], W[m][:,k])
+                Ypred[mask[gg,:]] = 0.
+                Res = np.sum((np.where(mask[gg,:], 0., Y[gg,:]) - Ypred)**2.)
+                np.testing.assert_allclose(r2[g][m,k], 1. - Res/SS, rtol=1e-10, atol=1e-12)